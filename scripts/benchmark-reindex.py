@@ -0,0 +1,112 @@
+"""
+Micro-benchmark of the reactant re-indexing in Program.init_rxns/run_rxn_tree on a real depth-2 program:
+the vectorized ProductTable.reactant_counts + Program.reindex_reactants vs. the former per-product Python loops
+"""
+import argparse
+import tempfile
+import timeit
+from copy import copy, deepcopy
+
+import networkx as nx
+import numpy as np
+
+import synnet.utils.data_utils as data_utils
+from synnet.data_generation.preprocessing import BuildingBlockFileHandler, ReactionTemplateFileHandler
+from synnet.utils.data_utils import Program, Reaction
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--building-blocks-file", default="tests/assets/building_blocks_matched.csv.gz")
+    parser.add_argument("--rxn-templates-file", default="data/assets/reaction-templates/hb.txt")
+    parser.add_argument("--rxn-ids", type=int, nargs=2, help="reactions of the child and the root, picked by number of available reactants by default")
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+def loop_reindex(res, entries, rxn_map):
+    """
+    The former implementation: count per product, then re-index by appending one reactant at a time
+    """
+    all_reactant_indices = []
+    for e in entries:
+        if isinstance(e, tuple):
+            all_reactant_indices.append([[0 for _ in rxn_map[e[0]].available_reactants[e[1]]]])
+        else:
+            all_reactant_indices.append([[0 for _ in reactants] for reactants in rxn_map[e].available_reactants])
+    for _, idxes in res:
+        for i in range(len(all_reactant_indices)):
+            for j in range(len(idxes[i])):
+                all_reactant_indices[i][j][idxes[i][j]] += 1
+    new_rxn_map = deepcopy(rxn_map)
+    for i, e in enumerate(entries):
+        if isinstance(e, tuple):
+            e, idx = e
+            reactant_indices = [idx]
+        else:
+            reactant_indices = range(len(all_reactant_indices[i]))
+        available_reactants = list(new_rxn_map[e].available_reactants)
+        for j in reactant_indices:
+            available_reactants[j] = []
+        new_rxn_map[e].available_reactants = tuple(available_reactants)
+        for idx, j in enumerate(reactant_indices):
+            c = 0
+            idxes = all_reactant_indices[i][idx]
+            for k in range(len(idxes)):
+                if idxes[k]:
+                    new_rxn_map[e].available_reactants[j].append(rxn_map[e].available_reactants[j][k])
+                    idxes[k] = c
+                    c += 1
+                else:
+                    idxes[k] = -1
+    return all_reactant_indices, new_rxn_map
+
+
+def vectorized_reindex(table, entries, rxn_map):
+    all_reactant_indices = table.reactant_counts(Program.entry_radices(entries, rxn_map))
+    new_rxn_map = {n: copy(rxn) for n, rxn in rxn_map.items()}
+    Program.reindex_reactants(entries, all_reactant_indices, rxn_map, new_rxn_map)
+    return all_reactant_indices, new_rxn_map
+
+
+def depth_2_program(rxns, i, j):
+    g = nx.DiGraph()
+    g.add_node(0, rxn_id=i)
+    g.nodes[0]['depth'] = 1
+    p = Program(g, keep_prods=2)
+    p.init_rxns(rxns)
+    p.run_rxn_tree()
+    q = p.copy()
+    q.combine_bi_mol(j, 'left')
+    q.init_rxns(rxns)
+    q.run_rxn_tree()
+    return q
+
+
+if __name__ == "__main__":
+    args = get_args()
+    data_utils.PRODUCT_DIR = tempfile.mkdtemp()
+    bblocks = BuildingBlockFileHandler().load(args.building_blocks_file)
+    rxn_templates = ReactionTemplateFileHandler().load(args.rxn_templates_file)
+    rxns = [Reaction(template=tmplt).set_available_reactants(bblocks) for tmplt in rxn_templates]
+    if args.rxn_ids:
+        i, j = args.rxn_ids
+    else:
+        good = [r for r, rxn in enumerate(rxns) if all(len(a) for a in rxn.available_reactants)]
+        i = max(good, key=lambda r: np.prod([len(a) for a in rxns[r].available_reactants]))
+        j = max([r for r in good if rxns[r].num_reactant == 2], key=lambda r: len(rxns[r].available_reactants[1]))
+    q = depth_2_program(rxns, i, j)
+    # re-run the root's re-indexing on q's (already re-indexed) products, as run_rxn_tree does
+    q.product_map.load()
+    table = q.product_map[(len(q.rxn_tree)-1,)]
+    res = [(interm, [table[interm][e] for e in table.entries]) for interm in table]
+    print(f"program {i} -> {j}: {len(table)} products, {Program.input_length(q)} reactant combinations")
+
+    loop_indices, loop_map = loop_reindex(res, table.entries, q.rxn_map)
+    vec_indices, vec_map = vectorized_reindex(table, table.entries, q.rxn_map)
+    assert [[list(idxes) for idxes in e] for e in loop_indices] == [[idxes.tolist() for idxes in e] for e in vec_indices]
+    assert all(loop_map[n].available_reactants == vec_map[n].available_reactants for n in q.rxn_map)
+
+    loop_time = min(timeit.repeat(lambda: loop_reindex(res, table.entries, q.rxn_map), number=1, repeat=args.repeat))
+    vec_time = min(timeit.repeat(lambda: vectorized_reindex(table, table.entries, q.rxn_map), number=1, repeat=args.repeat))
+    print(f"loop: {loop_time*1000:.2f}ms, vectorized: {vec_time*1000:.2f}ms, speedup {loop_time/vec_time:.1f}x")
@@ -0,0 +1,13 @@
+"""
+(Re-)builds the index of an existing hash directory (see synnet.utils.hash_index), 
+used by RxnPolicy.action_mask, filter_imposs, fill_in and get_return instead of probing the .json files
+"""
+import argparse
+from synnet.utils.hash_index import HashIndex
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hash-dir', required=True)
+    args = parser.parse_args()
+    print(f"indexed {HashIndex.build(args.hash_dir)} files of {args.hash_dir}")
@@ -4,10 +4,14 @@ from synnet.data_generation.preprocessing import (
     BuildingBlockFilter,
     ReactionTemplateFileHandler,
 )
-from synnet.utils.data_utils import Skeleton, Program, ProductMap, ProductMapLink
+from synnet.utils.data_utils import Skeleton, Program, ProductMap, ProductMapLink, product_store
 from synnet.utils.logging import create_logger
+from synnet.utils.scheduler import TaskLedger, run_tasks
+from synnet.utils.program_catalog import ProgramCatalog, CatalogPrograms, cache_references
+from synnet.utils.hash_index import HashIndex
 from synnet.utils.analysis_utils import count_bbs, count_rxns
 import pickle
+import itertools
 import logging
 import os
 import networkx as nx
@@ -69,6 +73,8 @@ def get_args():
     parser.add_argument("--step", choices=['expand', 'init', 'run', 'migrate'])
     parser.add_argument("--d", default=1, type=int)
     parser.add_argument("--batch", default=-1, type=int, help='which batch, i.e. expand_batch_size (expand), init_batch_size (init), run_batch_size (run)')
+    parser.add_argument("--scheduler", choices=['batch', 'local'], default='batch', 
+                        help="batch: fixed --*_batch_size batches (for --step/--batch jobs), local: one cost-ordered pool per step, resumable from cache-dir/tasks.db")
     # Hash table args
     parser.add_argument("--ncpu", type=int, default=1, help="Number of cpus")
     parser.add_argument("--expand_batch_size", type=int, default=100, help="Number of pargs to batch for expand")
@@ -150,14 +156,104 @@ def get_programs(rxns, keep_prods=0, size=1):
     return all_progs
 
 
+def get_fingerprint(args, bblocks, rxn_templates):
+    """
+    Stamp of the cached artifacts: the building blocks and templates (after --top-bb/--top-rxn), 
+    --keep-prods and the code version of Program; the depth is part of each artifact's name
+    """
+    return Program.hash_json({
+        "bblocks": bblocks,
+        "rxn_templates": rxn_templates,
+        "top_bb": args.top_bb,
+        "top_rxn": args.top_rxn,
+        "keep_prods": args.keep_prods,
+        "code": Program.code_version(),
+    })
+
+
+def is_cached(fpath):
+    """
+    fpath exists and was written for the current fingerprint
+    """
+    stamp = f"{fpath}.fingerprint"
+    return os.path.exists(fpath) and os.path.exists(stamp) and open(stamp).read() == args.fingerprint
+
+
+def dump_cached(obj, fpath):
+    pickle.dump(obj, open(fpath, 'wb+'))
+    with open(f"{fpath}.fingerprint", 'w+') as f:
+        f.write(args.fingerprint)
+
+
+def load_memo(step, prog):
+    """
+    Incremental builds: init/run results are also cached per program under prog.input_fingerprint,
+    so when only some reactions or building blocks change, only the affected programs are recomputed
+    Returns (key, hit, result)
+    """
+    if not args.cache_dir:
+        return None, False, None
+    key = prog.input_fingerprint(bbf.rxns)
+    fpath = os.path.join(args.cache_dir, "memo", step, f"{key}.pkl")
+    if not os.path.exists(fpath):
+        return key, False, None
+    res = pickle.load(open(fpath, 'rb'))
+    if res is None:
+        return key, True, None
+    if res.keep_prods and not all(os.path.exists(f) for f in res.product_map.files()):
+        return key, False, None # swept by clean_cache
+    res.rxn_tree = prog.rxn_tree # same tree, keep the current rxn_id numbering
+    return key, True, res
+
+
+def save_memo(step, key, res):
+    if key is None:
+        return
+    fpath = os.path.join(args.cache_dir, "memo", step, f"{key}.pkl")
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    with open(f"{fpath}.tmp", 'wb+') as f:
+        pickle.dump(res, f)
+    os.replace(f"{fpath}.tmp", fpath)
+
+
+def save_stage(stage, all_progs, d):
+    """
+    Checkpoints all_progs[d] as (stage, d) of the program catalog, replacing the {d}_pre/{d}_init/{d}.pkl pickles
+    all_progs[d] then loads its programs on demand
+    """
+    logger = logging.getLogger('global_logger')
+    logger.info(f"begin cataloging {len(all_progs[d])} {stage} depth-{d} programs")
+    catalog.add(stage, d, all_progs[d], rxns=bbf.rxns, fingerprint=args.fingerprint)
+    all_progs[d] = catalog.programs(stage, d)
+    logger.info(f"done cataloging {stage} depth-{d} programs")
+
+
+def load_stage(stage, d):
+    """
+    all_progs as checkpointed at (stage, d), the earlier depths are their filtered "run" programs
+    (their "migrate" ones once depth keep_prods+1 is reached)
+    """
+    assert catalog.has(stage, d, args.fingerprint)
+    all_progs = {}
+    for k in range(1, d):
+        all_progs[k] = catalog.programs("migrate" if k <= args.keep_prods < d else "run", k, good=True)
+    all_progs[d] = catalog.programs(stage, d)
+    return all_progs
+
+
 def init_program(prog):    
     """
     Then runs the programs, returning validity and (if prog.keep_prods) storing intermediates
     """   
     logger = logging.getLogger('global_logger')
+    key, hit, res = load_memo('init', prog)
+    if hit:
+        logger.info(f"reusing init program {prog.logging_info()}")
+        return res
     logger.info(f"begin init program {prog.logging_info()}")
     prog.init_rxns(bbf.rxns)
     logger.info(f"done init program {prog.logging_info()}")
+    save_memo('init', key, prog)
     return prog
     
 
@@ -167,14 +263,20 @@ def run_program(prog):
     Then runs the programs, returning validity and (if prog.keep_prods) storing intermediates
     """    
     logger = logging.getLogger('global_logger')
+    key, hit, res = load_memo('run', prog)
+    if hit:
+        logger.info(f"reusing run program {prog.logging_info()}")
+        return res
     logger.info(f"begin run program {prog.logging_info()}")
-    start_len, res = prog.run_rxn_tree()
+    start_len, num_pass = prog.run_rxn_tree(checkpoint_dir=os.path.join(PRODUCT_DIR, "checkpoints"))
     logger.info(f"done run program {prog.logging_info()}")
     if start_len:
-        print(f"{len(res)}/{start_len} pass")
-        return prog
+        print(f"{num_pass}/{start_len} pass")
+        res = prog
     else:
-        return None
+        res = None
+    save_memo('run', key, res)
+    return res
 
 
 
@@ -234,41 +336,107 @@ def expand_program(i, a, b=None):
         
 
 
+def expand_parg(parg):
+    return expand_program(*parg)
+
+
+
+def run_local(args, job, func, tasks, costs):
+    """
+    --scheduler local: runs all tasks of a step on one pool of args.ncpu, most expensive first
+    Finished tasks are recorded in cache_dir/tasks.db, so a crashed step resumes where it stopped
+    """
+    ledger = TaskLedger(os.path.join(args.cache_dir, "tasks.db"), os.path.join(args.cache_dir, "tasks"))
+    job = f"{job}_{args.fingerprint[:8]}"
+    return run_tasks(func, tasks, costs, ledger, job, processes=args.ncpu, serial_cost=MP_MIN_COMBINATIONS)
+
+
+
+def product_signature(prog):
+    return prog.product_signature(bbf.rxns)
+
+
+def iter_pargs(prev_progs, signatures, size):
+    """
+    Lazily enumerates the expansions (rxn_id, a, b) into size-{size} programs, see expand_program
+    Skips those filter_programs would drop after init_rxns: a child whose kept products cannot fill its
+    reactant slot of the new reaction (see Program.product_signature), or a building block slot without reactants
+    """
+    fills = lambda k, a, i, j: signatures[k][a] is None or signatures[k][a][i, j]
+    for i, r in enumerate(bbf.rxns):
+        if r.num_reactant == 1:
+            A = prev_progs[size-1]
+            for a in range(len(A)):
+                if fills(size-1, a, i, 0):
+                    yield (i, A[a])
+        else:
+            for j in range(1, size-1):
+                A = prev_progs[j]
+                B = prev_progs[size-1-j]
+                for a in range(len(A)):
+                    if not fills(j, a, i, 0):
+                        continue
+                    for b in range(len(B)):   
+                        if fills(size-1-j, b, i, 1):
+                            yield (i, A[a], B[b])
+            A = prev_progs[size-1]
+            for a in range(len(A)):
+                if len(r.available_reactants[1]) and fills(size-1, a, i, 0):
+                    yield (i, A[a], []) # a is left child
+                if len(r.available_reactants[0]) and fills(size-1, a, i, 1):
+                    yield (i, [], A[a]) # a is right child
+            # TODO: add all the cases of only one reaction, but i is also entry
+
+
 def expand_programs(args, all_progs, size):
     logger = logging.getLogger('global_logger')
     prefix = f"{size}_expand"
     progs = []
-    parg_path = os.path.join(args.cache_dir, f"{prefix}_pargs.pkl")
-    if os.path.exists(parg_path):
-        pargs = pickle.load(open(parg_path, 'rb'))
+    # catalog programs are loaded on demand, through the catalog's LRU
+    prev_progs = {k: all_progs[k].cached_view() if isinstance(all_progs[k], CatalogPrograms) else all_progs[k] for k in range(1, size)}
+    sig_path = os.path.join(args.cache_dir, f"{prefix}_signatures.pkl")
+    if is_cached(sig_path):
+        signatures = pickle.load(open(sig_path, 'rb'))
     else:
-        pargs = []
-        for i, r in tqdm(enumerate(bbf.rxns)):
-            if r.num_reactant == 1:
-                A = all_progs[size-1]
-                for a in range(len(A)):
-                    pargs.append((i, A[a]))
+        signatures = {}
+        for k in prev_progs:
+            if args.ncpu > 1:
+                with mp.Pool(args.ncpu) as p:
+                    signatures[k] = p.map(product_signature, tqdm(prev_progs[k], desc=f"depth-{k} product signatures"))
             else:
-                for j in range(1, size-1):
-                    A = all_progs[j]
-                    B = all_progs[size-1-j]
-                    for a in range(len(A)):
-                        for b in range(len(B)):   
-                            pargs.append((i, A[a], B[b]))
-                A = all_progs[size-1]
-                for a in range(len(A)):
-                    pargs.append((i, A[a], [])) # a is left child
-                    pargs.append((i, [], A[a])) # a is right child
-                # TODO: add all the cases of only one reaction, but i is also entry
-        pickle.dump(pargs, open(parg_path, 'wb+'))    
-        if args.step == 'expand' and args.batch == -1: # job to create pargs
-            logger.info(f"prepared {len(pargs)} pargs")
-            raise
+                signatures[k] = [product_signature(p) for p in tqdm(prev_progs[k], desc=f"depth-{k} product signatures")]
+        dump_cached(signatures, sig_path)
+    # counted once, batch jobs read it instead of re-walking the cross product
+    count_path = os.path.join(args.cache_dir, f"{prefix}_num_pargs.pkl")
+    if is_cached(count_path):
+        num_pargs = pickle.load(open(count_path, 'rb'))
+    else:
+        num_pargs = sum(1 for _ in iter_pargs(prev_progs, signatures, size))
+        dump_cached(num_pargs, count_path)
+    if args.step == 'expand' and args.batch == -1 and args.scheduler == 'batch': # job to create signatures
+        logger.info(f"prepared {num_pargs} pargs")
+        raise
+    num_all = 0
+    for r in bbf.rxns:
+        if r.num_reactant == 1:
+            num_all += len(prev_progs[size-1])
+        else:
+            num_all += sum(len(prev_progs[j])*len(prev_progs[size-1-j]) for j in range(1, size-1)) + 2*len(prev_progs[size-1])
+    logger.info(f"pruned {num_all}->{num_pargs} pargs by product signatures")
+    if args.scheduler == 'local':
+        # streamed in chunks of expand_batch_size, copies share the product map files so every expansion costs about the same
+        pargs_iter = iter_pargs(prev_progs, signatures, size)
+        all_progs[size] = []
+        for c in itertools.count():
+            pargs = list(itertools.islice(pargs_iter, args.expand_batch_size))
+            if not pargs:
+                break
+            all_progs[size] += run_local(args, f"{prefix}_{c}", expand_parg, pargs, [1 for _ in pargs])
+        return all_progs
     """
-    Create a hash of args, all_progs, size
-    Only if EVERYTHING is the same, use checkpointing
+    Batches are only reused if they were written for the same fingerprint (see get_fingerprint)
     """                
-    num_batches = (len(pargs)+args.expand_batch_size-1)//args.expand_batch_size
+    num_batches = (num_pargs+args.expand_batch_size-1)//args.expand_batch_size
     logger.info(f"{num_batches} batches to expand")    
     if args.step is None or (args.step == 'expand' and args.batch == -1):
         batch_iter = range(num_batches)
@@ -276,9 +444,12 @@ def expand_programs(args, all_progs, size):
         assert args.step == 'expand'
         batch_iter = [args.batch]
     all_progs[size] = []
+    # batches are consecutive slices of one enumeration, batch_iter is increasing
+    pargs_iter = iter_pargs(prev_progs, signatures, size)
+    pos = 0
     for j in batch_iter:
         expand = False
-        if os.path.exists(os.path.join(args.cache_dir, f"{prefix}_{j}.pkl")):
+        if is_cached(os.path.join(args.cache_dir, f"{prefix}_{j}.pkl")):
             logger.info(f"loading {prefix}_{j}.pkl")
             progs = pickle.load(open(os.path.join(args.cache_dir, f"{prefix}_{j}.pkl"), 'rb'))
             # check all the paths exist
@@ -287,13 +458,16 @@ def expand_programs(args, all_progs, size):
                     if not os.path.exists(p.product_map.fpath):
                         expand = True
                 else:
-                    for fpath in p.product_map.fpaths.values():
+                    for fpath in p.product_map.files():
                         if not os.path.exists(fpath):
                             expand = True
         else:
             expand = True
         if expand:
-            pargs_batch = pargs[j*args.expand_batch_size:(j+1)*args.expand_batch_size]        
+            # skip the batches before j, then take this one
+            deque(itertools.islice(pargs_iter, j*args.expand_batch_size-pos), maxlen=0)
+            pargs_batch = list(itertools.islice(pargs_iter, args.expand_batch_size))
+            pos = j*args.expand_batch_size+len(pargs_batch)
             logger.info(f"=====expanding {len(pargs_batch)} programs (batch {j}/{num_batches})=====")
             if args.ncpu > 1:
                 with mp.Pool(args.ncpu) as p:
@@ -303,7 +477,7 @@ def expand_programs(args, all_progs, size):
                 for i, parg in enumerate(tqdm(pargs_batch, desc="expanding progs")):       
                     progs.append(expand_program(*parg))      
             logger.info(f"dumping {prefix}_{j}.pkl")
-            pickle.dump(progs, open(os.path.join(args.cache_dir, f"{prefix}_{j}.pkl"), 'wb+'))
+            dump_cached(progs, os.path.join(args.cache_dir, f"{prefix}_{j}.pkl"))
         all_progs[size] += progs
     
     return all_progs
@@ -317,6 +491,10 @@ def filter_programs(progs):
     """
     logger = logging.getLogger('global_logger')
     logger.info(f"begin filtering {len(progs)} programs")
+    if isinstance(progs, CatalogPrograms):
+        ids = [i for i, good in zip(progs.ids, progs.good()) if good]
+        logger.info(f"done filtering {len(progs)}->{len(ids)} programs")
+        return CatalogPrograms(progs.catalog, progs.stage, progs.depth, ids)
     new_progs = []
     for p in progs:
         if p is None:
@@ -339,10 +517,19 @@ def filter_programs(progs):
 
 
 
+def input_lengths(progs, rxns=None):
+    """
+    Catalog programs are not loaded, their input lengths were stored when cataloged
+    """
+    if isinstance(progs, CatalogPrograms):
+        return list(progs.input_lengths())
+    return [Program.input_length(p, rxns) for p in progs]
+
+
 def strategy(progs, rxns):
     easy_prog_inds, hard_prog_inds = [], []
-    for i, p in enumerate(progs):
-        if Program.input_length(p, rxns) <= MP_MIN_COMBINATIONS:
+    for i, input_length in enumerate(input_lengths(progs, rxns)):
+        if input_length <= MP_MIN_COMBINATIONS:
             easy_prog_inds.append(i)
         else:
             hard_prog_inds.append(i)
@@ -353,8 +540,9 @@ def get_descr(all_progs):
     descr = "\nLet's summarize the current status of all programs\n"
     for d in all_progs:
         descr += f"{len(all_progs[d])} depth-{d} programs\n"
-        avg_input_length = Program.avg_input_length(all_progs[d])
-        max_input_length = max([Program.input_length(p) for p in all_progs[d]])
+        lengths = input_lengths(all_progs[d])
+        avg_input_length = np.mean(lengths) if len(lengths) else 0
+        max_input_length = max(lengths)
         descr += f"with average input length {avg_input_length}\n"
         descr += f"and maximum input length {max_input_length}\n"
     descr += "\n"
@@ -364,6 +552,13 @@ def get_descr(all_progs):
 def get_cache_fpaths(all_progs):
     fpaths = []
     for d in all_progs:
+        if isinstance(all_progs[d], CatalogPrograms):
+            for fpath in all_progs[d].files():
+                if not os.path.exists(fpath):
+                    print(fpath)
+                    raise
+                fpaths.append(fpath)
+            continue
         for p in all_progs[d]:
             if isinstance(p.product_map, ProductMap):
                 fpath = p.product_map.fpath
@@ -372,7 +567,7 @@ def get_cache_fpaths(all_progs):
                     raise
                 fpaths.append(fpath)
             else:
-                for fpath in p.product_map.fpaths.values():
+                for fpath in p.product_map.files():
                     if not os.path.exists(fpath):
                         print(fpath)
                         raise
@@ -381,16 +576,16 @@ def get_cache_fpaths(all_progs):
 
 
 def clean_cache(args, all_progs):
+    """
+    Ref-count sweep of the product store, only the files referenced by all_progs
+    and the rest of the cache dir (other stages, task and memo results) are kept
+    """
     logger = logging.getLogger('global_logger')
-    fpath_set = set(get_cache_fpaths(all_progs))    
-    logger.info(f"begin cleaning cache, keep {len(fpath_set)} fpaths")
-    removed = 0
-    for f in os.listdir(args.cache_dir):        
-        if '.pkl' in f:
-            continue
-        if os.path.join(args.cache_dir, f) not in fpath_set:
-            os.remove(os.path.join(args.cache_dir, f))
-            removed += 1
+    store = product_store()
+    fpaths = get_cache_fpaths(all_progs) + cache_references(args.cache_dir)
+    logger.info(f"begin cleaning cache, keep {len(set(fpaths))} fpaths")
+    store.recount(fpaths)
+    removed = store.sweep()
     logger.info(f"finish cleaning cache, removed {removed}")       
 
 
@@ -408,42 +603,36 @@ def migrate(args, all_progs):
             with mp.Pool(args.ncpu) as p:
                 all_progs[depth] = p.map(Program.migrate, tqdm(all_progs[depth]))
         else:
-            for p in tqdm(all_progs[depth]):
-                Program.migrate(p)                
+            all_progs[depth] = [Program.migrate(p) for p in tqdm(all_progs[depth])]
+        if args.cache_dir:
+            save_stage("migrate", all_progs, depth)
         logger.info(f"done migrating depth {depth}")          
     logger.info(f"done migrating depth")     
 
 
 def expand(args, all_progs, d):
     logger = logging.getLogger('global_logger')   
-    cache_fpath_pre = os.path.join(args.cache_dir, f"{d}_pre.pkl")
     if d == 1: 
-        progs = get_programs(bbf.rxns, args.keep_prods, size=1)
-        all_progs = progs
+        all_progs.update(get_programs(bbf.rxns, args.keep_prods, size=1))
         if args.cache_dir:
             if args.step is None or (args.step == 'expand' and args.batch == -1):
-                logger.info(f"begin cache-dumping all pre-programs at {cache_fpath_pre}")                     
-                pickle.dump(all_progs, open(cache_fpath_pre, 'wb'))
-                logger.info(f"done cache-dumping all pre-programs at {cache_fpath_pre}")         
+                save_stage("pre", all_progs, d)
     else:          
-        if args.cache_dir and os.path.exists(cache_fpath_pre):
-            all_progs = pickle.load(open(cache_fpath_pre, 'rb'))
+        if args.cache_dir and catalog.has("pre", d, args.fingerprint):
+            all_progs.update(load_stage("pre", d))
         else:
             logger.info(f"begin expanding size-{d} programs")                
             expand_programs(args, all_progs, d)
             logger.info(f"done expanding size-{d} programs")
             if args.cache_dir:
                 if args.step is None or (args.step == 'expand' and args.batch == -1):
-                    logger.info(f"begin cache-dumping all pre-programs at {cache_fpath_pre}")                     
-                    pickle.dump(all_progs, open(cache_fpath_pre, 'wb'))
-                    logger.info(f"done cache-dumping all pre-programs at {cache_fpath_pre}")                   
+                    save_stage("pre", all_progs, d)
         logger.info(f"created {len(all_progs[d])} size-{d} programs")    
 
 
 def load_and_filter(args, all_progs, d):
     logger = logging.getLogger('global_logger')   
-    cache_fpath = os.path.join(args.cache_dir, f"{d}.pkl")
-    all_progs = pickle.load(open(cache_fpath, 'rb'))
+    all_progs = load_stage("run", d)
     logger.info(f"loaded {len(all_progs[d])} size-{d} programs")
     all_progs[d] = filter_programs(all_progs[d])
     assert d in all_progs
@@ -464,10 +653,15 @@ def init_and_filter(args, all_progs, d):
     """    
     logger = logging.getLogger('global_logger')   
     logger.info(f"strategize how to init {len(all_progs[d])} depth-{d} programs")  
+    if args.scheduler == 'local':
+        costs = input_lengths(all_progs[d], bbf.rxns)
+        all_progs[d] = filter_programs(run_local(args, f"{d}_init", init_program, all_progs[d], costs))
+        save_stage("init", all_progs, d)
+        logger.info(f"done init and filter, {len(all_progs[d])} programs")
+        return
     progs = [None for _ in all_progs[d]] 
     easy_prog_inds, hard_prog_inds = strategy(all_progs[d], bbf.rxns)
     logger.info(f"parallel run easy programs {easy_prog_inds}")          
-    cache_fpath_init = os.path.join(args.cache_dir, f"{d}_init.pkl")
     # Batch using init_batch_size
     num_batches = (len(easy_prog_inds)+args.init_batch_size-1)//args.init_batch_size
     logger.info(f"prepared {num_batches} batches to init")
@@ -488,7 +682,7 @@ def init_and_filter(args, all_progs, d):
     if args.step is None or (args.step == 'init' and args.batch == -1):
         # Filter after init prunes the input space
         all_progs[d] = filter_programs(progs)       
-        pickle.dump(all_progs, open(cache_fpath_init, 'wb'))
+        save_stage("init", all_progs, d)
         logger.info(f"done init and filter, {len(all_progs[d])} programs")
 
 
@@ -505,11 +699,11 @@ def run_or_init_batch(prefix, d_progs, inds, easy_prog_inds, hard_prog_inds):
         func = run_program
     else:
         func = init_program
-    if os.path.exists(batch_path):
+    if is_cached(batch_path):
         logger.info(f"loading {prefix}.pkl")
         progs_batch = pickle.load(open(batch_path, 'rb'))
     else:
-        if os.path.exists(easy_batch_path):
+        if is_cached(easy_batch_path):
             easy_progs_batch = pickle.load(open(easy_batch_path, 'rb'))
         else:
             if args.ncpu > 1:
@@ -519,15 +713,15 @@ def run_or_init_batch(prefix, d_progs, inds, easy_prog_inds, hard_prog_inds):
             else:
                 easy_progs_batch = [func(d_progs[i]) for i in easy_prog_inds_batch]                
             logger.info(f"begin dumping easy programs batch at {easy_batch_path}")
-            pickle.dump(easy_progs_batch, open(easy_batch_path, 'wb+'))
+            dump_cached(easy_progs_batch, easy_batch_path)
             logger.info(f"done dumping easy programs batch at {easy_batch_path}")
-        if os.path.exists(hard_batch_path):
+        if is_cached(hard_batch_path):
             hard_progs_batch = pickle.load(open(hard_batch_path, 'rb'))
         else:
             hard_progs_batch = []
             for i in tqdm(hard_prog_inds_batch):
                 hard_path_i = os.path.join(args.cache_dir, f"{prefix}_hard_{i}.pkl")            
-                if os.path.exists(hard_path_i):
+                if is_cached(hard_path_i):
                     logger.info(f"hard program {hard_path_i} exists")
                     p = pickle.load(open(hard_path_i, 'rb'))
                 else:
@@ -536,11 +730,11 @@ def run_or_init_batch(prefix, d_progs, inds, easy_prog_inds, hard_prog_inds):
                     p = func(p)    
                     if args.cache_dir:
                         logger.info(f"begin cache-dumping hard program at {hard_path_i}")  
-                        pickle.dump(p, open(hard_path_i, 'wb'))
+                        dump_cached(p, hard_path_i)
                         logger.info(f"done cache-dumping hard program at {hard_path_i}")             
                 hard_progs_batch.append(p)                
             logger.info(f"begin dumping hard batch programs at {hard_batch_path}")
-            pickle.dump(hard_progs_batch, open(hard_batch_path, 'wb+'))
+            dump_cached(hard_progs_batch, hard_batch_path)
             logger.info(f"done dumping hard batch programs at {hard_batch_path}")
         progs_batch = []
         for ind in inds:
@@ -550,17 +744,12 @@ def run_or_init_batch(prefix, d_progs, inds, easy_prog_inds, hard_prog_inds):
                 p = hard_progs_batch[hard_prog_inds_batch.index(ind)]
             progs_batch.append(p)
         logger.info(f"begin dumping batch programs at {batch_path}")
-        pickle.dump(progs_batch, open(batch_path, 'wb+'))
+        dump_cached(progs_batch, batch_path)
         logger.info(f"done dumping batch programs at {batch_path}")    
     return progs_batch
 
 
-def run(args, all_progs, d):
-    """
-    Strategy: use mp to run easy programs in parallel
-    Run hard programs sequentially, use mp among the input combinations
-    """
-    cache_fpath = os.path.join(args.cache_dir, f"{d}.pkl")
+def run_batches(args, all_progs, d):
     logger = logging.getLogger('global_logger')   
     progs = [None for _ in all_progs[d]]    
     easy_prog_inds, hard_prog_inds = strategy(all_progs[d], bbf.rxns)
@@ -580,14 +769,26 @@ def run(args, all_progs, d):
         progs_batch = run_or_init_batch(f"{prefix}_{j}", all_progs[d], inds, easy_prog_inds, hard_prog_inds)
         for i, p in zip(inds, progs_batch):
             progs[i] = p 
+    return progs
+
+
+def run(args, all_progs, d):
+    """
+    Strategy: use mp to run easy programs in parallel
+    Run hard programs sequentially, use mp among the input combinations
+    """
+    logger = logging.getLogger('global_logger')   
+    if args.scheduler == 'local':
+        costs = input_lengths(all_progs[d])
+        progs = run_local(args, f"{d}_run", run_program, all_progs[d], costs)
+    else:
+        progs = run_batches(args, all_progs, d)
     if args.step is None or (args.step == 'run' and args.batch == -1):
         # Filter after reaction is run          
         all_progs[d] = filter_programs(progs) 
         if args.cache_dir:   
+            save_stage("run", all_progs, d)
             logger.info(get_descr(all_progs))  
-            logger.info(f"begin cache-dumping all programs at {cache_fpath}")  
-            pickle.dump(all_progs, open(cache_fpath, 'wb'))
-            logger.info(f"done cache-dumping all programs at {cache_fpath}")           
             logger.info(f"done! {len(all_progs[d])} size-{d} programs")
             # Eliminate unnecessary cache and save
             clean_cache(args, all_progs)
@@ -602,8 +803,7 @@ def create_run_programs(args, bbf, size=3):
     for d in range(1, size+1):      
         if args.step is not None and d > args.d:
             break
-        cache_fpath = os.path.join(args.cache_dir, f"{d}.pkl")
-        exist = os.path.exists(cache_fpath)
+        exist = catalog.has("run", d, args.fingerprint)
         if args.step is not None:
             if d < args.d:
                 assert exist
@@ -621,11 +821,11 @@ def create_run_programs(args, bbf, size=3):
             expand(args, all_progs, d)
         if args.step is None or args.step == 'init':
             if args.step == 'init':
-                all_progs = pickle.load(open(os.path.join(args.cache_dir, f"{d}_pre.pkl"), "rb"))
+                all_progs = load_stage("pre", d)
             init_and_filter(args, all_progs, d)        
         if args.step is None or args.step == 'run':            
             if args.step == 'run':
-                all_progs = pickle.load(open(os.path.join(args.cache_dir, f"{d}_init.pkl"), "rb"))
+                all_progs = load_stage("init", d)
             logger.info(f"running {len(all_progs[d])} size-{d} programs")
             run(args, all_progs, d)
     return all_progs
@@ -793,7 +993,9 @@ if __name__ == "__main__":
     # rxn_templates = [rxn_templates[r.rxn_id] for r in test_st.reactions]
 
 
-    if os.path.exists(os.path.join(args.cache_dir, "bbf.pkl")):
+    args.fingerprint = get_fingerprint(args, bblocks, rxn_templates)
+    catalog = ProgramCatalog(os.path.join(args.cache_dir, "programs.db"))
+    if is_cached(os.path.join(args.cache_dir, "bbf.pkl")):
         bbf = pickle.load(open(os.path.join(args.cache_dir, "bbf.pkl"), 'rb'))
     else:
         bbf = BuildingBlockFilter(
@@ -806,7 +1008,7 @@ if __name__ == "__main__":
         # Count number of unique (uni-reaction, building block) pairs
         bbf._init_rxns_with_reactants()
         bbf.filter()        
-        pickle.dump(bbf, open(os.path.join(args.cache_dir, "bbf.pkl"), 'wb+'))
+        dump_cached(bbf, os.path.join(args.cache_dir, "bbf.pkl"))
 
     # Run programs      
     # progs = get_programs(bbf.rxns, size=2)
@@ -826,27 +1028,27 @@ if __name__ == "__main__":
                     ax.set_ylabel('number of programs')
                 elif stat == 'input-length':
                     ax = fig.add_subplot(1,1,1)
-                    input_lengths = [Program.avg_input_length(all_progs[d]) for d in all_progs]
-                    ax.plot(input_lengths)
+                    avg_lengths = [np.mean(input_lengths(all_progs[d])) for d in all_progs]
+                    ax.plot(avg_lengths)
                     ax.set_xlabel("depth")
                     ax.set_ylabel('number of building block input sets')
                 elif stat == 'input-lengths':
-                    input_lengths = [Program.input_length(p) for p in all_progs[args.depth]]
+                    lengths = input_lengths(all_progs[args.depth])
                     if args.depth == 2:
                         ax = fig.add_subplot(1,2,1)
                         ax2 = fig.add_subplot(1,2,2)                
-                        ax2.hist(input_lengths, bins=100)
+                        ax2.hist(lengths, bins=100)
                         ax2.set_title("depth 2")
                         ax2.set_xlabel('#inputs')                            
 
-                        input_lengths = [Program.input_length(p) for p in all_progs[1]]                    
-                        ax.hist(input_lengths)
+                        lengths = input_lengths(all_progs[1])                    
+                        ax.hist(lengths)
                         ax.set_title("depth 1")
                         ax.set_xscale('log')
                         ax.set_xlabel('#inputs')  
                     else:
                         ax = fig.add_subplot(1,1,1)
-                        ax.hist(input_lengths, bins=100)
+                        ax.hist(lengths, bins=100)
                         ax.set_xscale('log')
                         ax.set_xlabel('number of building block input sets')                            
                                         
@@ -855,6 +1057,7 @@ if __name__ == "__main__":
         
         if args.output_dir:
             hash_programs(all_progs, args.output_dir)
+            print(f"indexed {HashIndex.build(args.output_dir)} files of {args.output_dir}")
 
 
 
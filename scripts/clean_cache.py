@@ -1,30 +1,35 @@
+"""
+Ref-count sweep of the product store: removes the product map files nothing in the cache dir references
+(cataloged programs, ledger task results and memoized results, see cache_references)
+Don't run it while a build writes to the same store on a network filesystem (see ProductStore)
+"""
 import argparse
 import os
-import pickle
-from synnet.utils.data_utils import ProductMap, ProductMapLink
+import sys
+from synnet.utils.data_utils import ProductStore
+from synnet.utils.program_catalog import cache_references
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--dir')
+    parser.add_argument('--dir', help="cache dir of build-hash-table.py, holding programs.db and the product store")
+    parser.add_argument('--scan', action='store_true', help="also remove unreferenced files written before the store (directory scan)")
+    parser.add_argument('--force', action='store_true', help="sweep even if nothing references any file (never scans then)")
     args = parser.parse_args()
-    json_files = set()
-    for f in os.listdir(args.dir):
-        if f.split('/')[-1] in ['1.pkl', '2.pkl']:
-            data=pickle.load(open(os.path.join(args.dir, f), 'rb'))
-            for d in data:
-                for p in data[d]:
-                    if isinstance(p.product_map, ProductMap):
-                        json_files.add(p.product_map.fpath)
-                    elif isinstance(p.product_map, ProductMapLink):
-                        for fpath in p.product_map.fpaths:
-                            json_files.add(fpath)
-        # if '07d413ef4f8a12b8e2d2a09a012a804e' in f:
-        #     data=pickle.load(open(os.path.join(args.dir, f), 'rb'))
-        #     breakpoint()
-    count = 0
-    bad_count = 0
-    for f in os.listdir(args.dir):
-        if '.json' in f:
-            if os.path.join(args.dir, f) not in json_files:
+    fpaths = cache_references(args.dir)
+    print(f"{len(fpaths)} references in {args.dir}")
+    if not fpaths and not args.force:
+        sys.exit(f"no references found in {args.dir}, not sweeping (pass --force to remove every product map)")
+    store = ProductStore(args.dir)
+    store.recount(fpaths)
+    print(f"removed {store.sweep()} files, keep {len(set(fpaths))}")
+    if args.scan and fpaths:
+        keep = set(map(os.path.realpath, fpaths))
+        removed = 0
+        for f in os.listdir(args.dir):
+            if os.path.splitext(f)[1] not in ['.json', '.npz']: # .lock files may be held by a running build
+                continue
+            if os.path.realpath(os.path.join(args.dir, f)) not in keep:
                 os.remove(os.path.join(args.dir, f))
+                removed += 1
+        print(f"removed {removed} files (scan)")
@@ -0,0 +1,55 @@
+"""
+Converts the .json/.pkl product maps referenced by cataloged programs (programs.db) into the columnar .npz format
+"""
+import argparse
+import os
+from synnet.utils.data_utils import ProductMap, ProductMapLink
+from synnet.utils.program_catalog import ProgramCatalog
+from tqdm import tqdm
+
+
+def convert_program(p, converted):
+    """
+    converted maps old -> new fpath, since programs may share base files
+    Returns whether p changed
+    """
+    changed = False
+    if isinstance(p.product_map, ProductMap):
+        fpath = p.product_map.fpath
+        if not fpath.endswith(".npz"):
+            if fpath not in converted:
+                converted[fpath] = ProductMap.convert(fpath)
+            p.product_map.fpath = converted[fpath]
+            changed = True
+    elif isinstance(p.product_map, ProductMapLink):
+        for entry_key, fpath in p.product_map.fpaths.items():
+            offset = None
+            if isinstance(fpath, tuple):
+                offset, fpath = fpath
+            if fpath.endswith(".npz"):
+                continue
+            if fpath not in converted:
+                converted[fpath] = ProductMap.convert(fpath, node=True)
+            new_fpath = converted[fpath]
+            p.product_map.fpaths[entry_key] = new_fpath if offset is None else (offset, new_fpath)
+            changed = True
+    return changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help="cache dir of build-hash-table.py, holding programs.db")
+    parser.add_argument('--remove', action='store_true', help="remove the converted .json/.pkl files")
+    args = parser.parse_args()
+    catalog = ProgramCatalog(os.path.join(args.dir, "programs.db"))
+    converted = {}
+    for stage, depth in catalog.stages():
+        progs = catalog.programs(stage, depth)
+        for idx, p in zip(progs.ids, tqdm(progs, desc=f"converting {stage} depth {depth}")):
+            if hasattr(p, 'product_map') and convert_program(p, converted):
+                catalog.update(stage, depth, idx, p)
+    print(f"converted {len(converted)} files")
+    if args.remove:
+        for old_fpath in converted:
+            if os.path.exists(old_fpath):
+                os.remove(old_fpath)
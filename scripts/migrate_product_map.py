@@ -26,7 +26,7 @@ if __name__ == "__main__":
                     for i, p in tqdm(enumerate(data[d])):
                         data[d][i] = Program.migrate(p)
                 for p in data[d]:
-                    for fpath in p.product_map.fpaths.values():
+                    for fpath in p.product_map.files():
                         assert os.path.exists(fpath)
             breakpoint()
             pickle.dump(data, open(os.path.join(args.dir, f), 'wb+'))
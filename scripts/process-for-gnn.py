@@ -1,5 +1,8 @@
 from synnet.utils.data_utils import SyntheticTree, SyntheticTreeSet, Skeleton, SkeletonSet, \
-load_skeletons, compute_md, get_bool_mask, get_wl_kernel, process_syntree_mask, test_is_leaves_up, inds_to_i
+load_skeletons, compute_md, get_bool_mask, get_wl_kernel, process_syntree_mask, test_is_leaves_up, valid_mask_inds
+from synnet.utils.gnn_shards import GNNShards
+from synnet.utils.mask_tables import MaskTable
+from synnet.config import MASK_TABLE_SAVE_EVERY
 import pickle
 import os
 import networkx as nx
@@ -100,12 +103,18 @@ def get_args():
         default=10
     )   
 
+    parser.add_argument("--sparse-feats", action='store_true', help="Write the old sparse .npz batch files instead of bit-packed shards")
+    parser.add_argument("--fp-ids", action='store_true', help="Store each batch's fingerprints once and X as fingerprint ids (see GNNShards)")
+    parser.add_argument("--sample-masks", action='store_true', help="Only store the syntrees of each class, masks and (X, y) are sampled while training (gnn.py)")
     # Processing
     parser.add_argument("--ncpu", type=int, help="Number of cpus", default=1)
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.sample_masks and args.predict_anchor:
+        parser.error("--sample-masks can't be used with --predict_anchor")
+    return args
 
 
-def get_parg(syntree, min_r_set, index, args):
+def get_parg(syntree, min_r_set, index, args, valid_inds=None):
     determine_criteria=args.determine_criteria
     predict_anchor=args.predict_anchor
     sk = Skeleton(syntree, index)
@@ -122,20 +131,10 @@ def get_parg(syntree, min_r_set, index, args):
             sk.mask = fill_in
             pargs.append([i, sk, args, min_r_set, [sk.tree_root] + fill_in])    
     else:
-        # for some, we can compute the valid i easily
-        if determine_criteria == 'leaf_up_2':
-            inds = [inds_to_i(sk.bottom_2_rxns + [sk.tree_root], len(sk.tree), min_r_set)]
-        elif determine_criteria == 'bfs':           
-            inds = [inds_to_i(sk.correct_bfs_mask[:l], len(sk.tree), min_r_set) for l in range(1, len(sk.correct_bfs_mask))]
-        else:
-            inds = range(2**(len(sk.tree)-len(min_r_set))-1)
-        for i in inds:
-            sk.reset(min_r_set)
-            zero_mask_inds = np.where(sk.mask == 0)[0]
-            bool_mask = get_bool_mask(i)
-            sk.mask = zero_mask_inds[-len(bool_mask):][bool_mask]   
-            if getattr(sk, determine_criteria):
-                pargs.append([i, sk, args, min_r_set])
+        if valid_inds is None:
+            valid_inds = valid_mask_inds(sk, min_r_set, determine_criteria)
+        for i in valid_inds.tolist():
+            pargs.append([i, sk, args, min_r_set])
     return pargs
 
 
@@ -146,6 +145,7 @@ def main():
     len_inds = np.argsort([len(skeletons[st]) for st in skeletons])
     kth_largest = np.zeros(len(skeletons))
     kth_largest[len_inds] = np.arange(len(skeletons))[::-1]
+    mask_table = MaskTable.open(args.skeleton_file)
     for index, st in tqdm(enumerate(skeletons)):
         if len(list(skeletons[st])) == 0:
             continue
@@ -188,12 +188,28 @@ def main():
             min_r_set = [sk.tree_root] + np.array(sk.tree.nodes)[sk.leaves].tolist()
         else:
             min_r_set = [sk.tree_root]
+
+        valid_inds = None
+        if not args.predict_anchor:
+            # same for every syntree of the class
+            valid_inds = mask_table.inds(sk, min_r_set, args.determine_criteria)
+            if mask_table.unsaved >= MASK_TABLE_SAVE_EVERY:
+                mask_table.save()
+        if args.sample_masks:
+            if not len(valid_inds):
+                print(f"class {index} has no masks satisfying {args.determine_criteria}, skipping")
+                continue
+            # the masks are drawn from valid_inds in the DataLoader workers
+            with open(os.path.join(args.output_dir, f"{index}_syntrees.pkl"), 'wb') as f:
+                pickle.dump({'syntrees': list(skeletons[st]), 'min_r_set': min_r_set, 'determine_criteria': args.determine_criteria, 'valid_inds': valid_inds}, f)
+            np.save(os.path.join(args.output_dir, f"{index}_edge_index.npy"), edge_index)
+            continue
         
         if args.ncpu > 1:
             with Pool(args.ncpu) as p:
-                pargs = p.starmap(get_parg, tqdm([[syntree, min_r_set, index, args] for syntree in tqdm(skeletons[st], desc="gathering pargs")]))
+                pargs = p.starmap(get_parg, tqdm([[syntree, min_r_set, index, args, valid_inds] for syntree in tqdm(skeletons[st], desc="gathering pargs")]))
         else:
-            pargs = [get_parg(*[syntree, min_r_set, index, args]) for syntree in tqdm(skeletons[st])]
+            pargs = [get_parg(*[syntree, min_r_set, index, args, valid_inds]) for syntree in tqdm(skeletons[st])]
         pargs = [parg for parg_sublist in pargs for parg in parg_sublist]
         print(f"mapping {len(pargs)}")
         if args.num_trees_per_batch == -1:
@@ -203,7 +219,7 @@ def main():
         num_batches = min((len(pargs)+batch_size-1)//batch_size, 1)
         print(f"{num_batches} batches")
         for k in tqdm(range(num_batches), desc="batches"): 
-            if os.path.exists(os.path.join(args.output_dir, f"{index}_{k}_node_masks.npy")):
+            if os.path.exists(os.path.join(args.output_dir, f"{index}_{k}_node_masks.npz")) or GNNShards.exists(os.path.join(args.output_dir, f"{index}_{k}")):
                 continue
             # print(k)  
             res = []     
@@ -221,13 +237,16 @@ def main():
             ys = np.concatenate([r[2] for r in res], axis=0)              
             smiles = np.array([r[3] for r in res])
             
-            Xs = sparse.csr_array(Xs)
-            ys = sparse.csr_array(ys)
-            node_masks = sparse.csr_array(node_masks)
-            sparse.save_npz(os.path.join(args.output_dir, f"{index}_{k}_Xs.npz"), Xs)
-            sparse.save_npz(os.path.join(args.output_dir, f"{index}_{k}_ys.npz"), ys)
-            np.save(os.path.join(args.output_dir, f"{index}_{k}_smiles.npy"), smiles)
-            sparse.save_npz(os.path.join(args.output_dir, f"{index}_{k}_node_masks.npz"), node_masks)
+            if args.sparse_feats:
+                Xs = sparse.csr_array(Xs)
+                ys = sparse.csr_array(ys)
+                node_masks = sparse.csr_array(node_masks)
+                sparse.save_npz(os.path.join(args.output_dir, f"{index}_{k}_Xs.npz"), Xs)
+                sparse.save_npz(os.path.join(args.output_dir, f"{index}_{k}_ys.npz"), ys)
+                np.save(os.path.join(args.output_dir, f"{index}_{k}_smiles.npy"), smiles)
+                sparse.save_npz(os.path.join(args.output_dir, f"{index}_{k}_node_masks.npz"), node_masks)
+            else:
+                GNNShards.write(os.path.join(args.output_dir, f"{index}_{k}"), node_masks, Xs, ys, smiles, fp_ids=args.fp_ids)
             np.save(os.path.join(args.output_dir, f"{index}_edge_index.npy"), edge_index)
 
         # with Pool(min(100, len(skeletons[st]))) as p:
@@ -245,6 +264,7 @@ def main():
         # np.save(os.path.join(args.output_dir, f"{index}_ys.npy"), ys)
         # np.save(os.path.join(args.output_dir, f"{index}_node_masks.npy"), node_masks)
         # np.save(os.path.join(args.output_dir, f"{index}_edge_index.npy"), edge_index)
+    mask_table.save()
 
 
 
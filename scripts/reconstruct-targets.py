@@ -77,9 +77,11 @@ def get_args():
         help="Path to list of SMILES"
     )
     parser.add_argument("--top-bbs-file", help='if given, consider only these bbs')
+    parser.add_argument("--bb-quantize", choices=['int8', 'binary'], help='quantize the building-block embeddings searched by the decoder')
     parser.add_argument("--top-k", default=1, type=int, help="Beam width for first bb")
     parser.add_argument("--top-k-rxn", default=1, type=int, help="Beam width for first rxn")
     parser.add_argument("--batch-size", default=10, type=int, help='how often to report metrics')
+    parser.add_argument("--decode-batch-size", default=16, type=int, help='number of targets whose beams are decoded together (1 to decode one by one)')
     parser.add_argument("--filter-only", type=str, nargs='+', choices=['rxn', 'bb'], default=[])
     parser.add_argument("--strategy", default='conf', choices=['conf', 'topological'], help="""
         Strategy to decode:
@@ -254,7 +256,16 @@ def main(args):
             df.to_csv(path)
             print(os.path.abspath(path))
         else:            
-            if args.ncpu == 1:
+            if args.decode_batch_size > 1 and not args.mermaid:
+                decode_size = args.decode_batch_size
+                chunks = [target_batch[i:i+decode_size] for i in range(0, len(target_batch), decode_size)]
+                if args.ncpu == 1:
+                    sks_chunks = [decode_batch(chunk) for chunk in tqdm(chunks)]
+                else:
+                    with ThreadPool(args.ncpu) as p:
+                        sks_chunks = p.map(decode_batch, tqdm(chunks))
+                sks_batch = [sks for sks_chunk in sks_chunks for sks in sks_chunk]
+            elif args.ncpu == 1:
                 sks_batch = []
                 for arg in tqdm(target_batch):                        
                     sks = decode(*arg)
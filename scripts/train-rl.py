@@ -11,7 +11,7 @@ import multiprocessing as mp
 from synnet.data_generation.preprocessing import BuildingBlockFileHandler, ReactionTemplateFileHandler
 from synnet.policy import RxnPolicy, Trainer, ReplayMemory, execute_episode
 from synnet.envs.synnet_env import make_skeleton_class
-from synnet.utils.data_utils import Skeleton, SkeletonSet, ReactionSet, Reaction
+from synnet.utils.data_utils import Skeleton, SkeletonSet, ReactionSet, Reaction, BuildingBlockRegistry
 from synnet.utils.analysis_utils import reorder_syntrees
 from synnet.models.common import load_gnn_from_ckpt
 from synnet.config import DELIM
@@ -209,7 +209,7 @@ def main(args):
     trainers = {}
     networks = {}
     mems = {}
-    bbs = BuildingBlockFileHandler().load(args.building_blocks_file)
+    bbs = BuildingBlockRegistry(BuildingBlockFileHandler().load(args.building_blocks_file))
     bb_emb = np.load(args.embeddings_knn_file)
     bb_emb = torch.as_tensor(bb_emb, dtype=torch.float32)    
     rxns = [Reaction(smirks) for smirks in ReactionTemplateFileHandler().load(args.rxn_templates_file)]
@@ -7,6 +7,17 @@ MAX_PROCESSES = min(100, multiprocessing.cpu_count()) - 1
 MP_MIN_COMBINATIONS = 10000000000000000000000000000000000
 
 NUM_THREADS = 1
+# Number of reactant combinations decoded & run per task in Program.run_rxn_tree
+RXN_CHUNK_SIZE = 10000
+# Number of chunks between resumable checkpoints of Program.run_rxn_tree
+RXN_CHECKPOINT_CHUNKS = 100
+
+# Max. number of SMILES held by the per-process molecule cache (synnet.utils.mol_cache)
+MOL_CACHE_SIZE = 200000
+# Max. number of bit-packed fingerprints held by the per-process fingerprint cache (synnet.encoding.fingerprints)
+FP_CACHE_SIZE = 200000
+# Number of SMILES fingerprinted per task when FingerprintEngine uses a process pool
+FP_CHUNK_SIZE = 1000
 
 # TODO: Remove these paths bit by bit
 
@@ -14,13 +25,32 @@ NUM_THREADS = 1
 # PRODUCT_DIR = "/ssd/msun415/program_cache-bb=10000-prods=1_new_product_map"
 PRODUCT_DIR = "/dccstor/graph-design/program_cache_keep-prods=2/"
 PRODUCT_JSON = True
+# New product maps are written in the columnar .npz format (ProductTable), .json/.pkl files are still read
+PRODUCT_NPZ = True
+# Max number of mmapped node files a ProductMapLink keeps open
+PRODUCT_LRU_SIZE = 8
+# Max number of loaded programs a ProgramCatalog keeps for cached reads (synnet.utils.program_catalog)
+CATALOG_LRU_SIZE = 4096
 DELIM = '_____'
+# Index of the hash directory written by build-hash-table (synnet.utils.hash_index), inside the directory
+HASH_INDEX_FILE = "index.npz"
+# Max. number of samples per bit-packed GNN feature shard written by process-for-gnn (synnet.utils.gnn_shards)
+GNN_SHARD_SIZE = 10000
+# Valid-mask tables of the skeleton classes (synnet.utils.mask_tables), next to the skeleton file: skeletons.pkl -> skeletons_masks.npz
+MASK_TABLE_SUFFIX = "_masks.npz"
+# process-for-gnn merges newly computed tables into the file every this many tables (and at the end)
+MASK_TABLE_SAVE_EVERY = 64
+# Rows of quantized building-block embeddings dequantized at once by EmbeddingIndex.search (synnet.utils.embedding_index)
+EMB_SEARCH_CHUNK = 65536
 MAX_DEPTH = 2
 NUM_POSS = 91
 
 # Pre-processed data
 DATA_PREPROCESS_DIR = "data/pre-process"
 
+# Building block x reaction template compatibility matrices, keyed by content hash
+COMPAT_DIR = "data/pre-process/reactant-compat"
+
 # Prepared data
 DATA_FEATURIZED_DIR = "data/featurized"
 
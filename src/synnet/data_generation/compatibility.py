@@ -0,0 +1,129 @@
+"""Persisted (building block x reaction template x reactant slot) compatibility matrix."""
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from synnet.config import COMPAT_DIR, MAX_PROCESSES
+from synnet.utils.data_utils import Reaction
+
+logger = logging.getLogger(__name__)
+
+
+class ReactantCompatibility:
+    """Packed bit matrix of logical shape `[n_bbs, n_rxns, 2]`.
+
+    Bit `(i, r, s)` is set iff building block `i` matches reactant slot `s` of template `r`.
+    Bits are packed along the building-block axis (`np.packbits(axis=0)`), so the
+    stored array has shape `[ceil(n_bbs/8), n_rxns, 2]` and `dtype=uint8`.
+    """
+
+    def __init__(self, bits: np.ndarray, n_bbs: int):
+        self.bits = bits
+        self.n_bbs = n_bbs
+
+    @property
+    def n_rxns(self) -> int:
+        return self.bits.shape[1]
+
+    @staticmethod
+    def key(building_blocks: list[str], rxn_templates: list[str]) -> str:
+        """md5 over the contents of the building block and template files."""
+        m = hashlib.md5()
+        m.update("\n".join(building_blocks).encode())
+        m.update(b"\0")
+        m.update("\n".join(rxn_templates).encode())
+        return m.hexdigest()
+
+    @staticmethod
+    def fpath(key: str, cache_dir: str = COMPAT_DIR) -> Path:
+        return Path(cache_dir) / f"{key}.npy"
+
+    @staticmethod
+    def _match(rxn: Reaction, building_blocks: list[str]) -> np.ndarray:
+        mask = np.zeros((len(building_blocks), 2), dtype=bool)
+        mask[:, 0] = [rxn.is_reactant_first(smi) for smi in building_blocks]
+        if rxn.num_reactant == 2:
+            mask[:, 1] = [rxn.is_reactant_second(smi) for smi in building_blocks]
+        return mask
+
+    @classmethod
+    def build(
+        cls, building_blocks: list[str], rxns: list[Reaction], processes: int = MAX_PROCESSES
+    ) -> "ReactantCompatibility":
+        """Runs the substructure match for every (building block, template, slot) triple."""
+        if processes == 1:
+            masks = [cls._match(rxn, building_blocks) for rxn in rxns]
+        else:
+            from functools import partial
+
+            from pathos import multiprocessing as mp
+
+            func = partial(cls._match, building_blocks=building_blocks)
+            with mp.Pool(processes=processes) as pool:
+                masks = pool.map(func, rxns)
+        mask = np.stack(masks, axis=1) if len(masks) else np.zeros((len(building_blocks), 0, 2), dtype=bool)
+        return cls(np.packbits(mask, axis=0), len(building_blocks))
+
+    @classmethod
+    def load(
+        cls, building_blocks: list[str], rxn_templates: list[str], cache_dir: str = COMPAT_DIR
+    ) -> Optional["ReactantCompatibility"]:
+        """Memory-maps a previously built matrix, or returns `None` if there is none."""
+        fpath = cls.fpath(cls.key(building_blocks, rxn_templates), cache_dir)
+        if not fpath.exists():
+            return None
+        return cls(np.load(fpath, mmap_mode="r"), len(building_blocks))
+
+    @classmethod
+    def load_or_build(
+        cls,
+        building_blocks: list[str],
+        rxn_templates: list[str],
+        rxns: Optional[list[Reaction]] = None,
+        cache_dir: str = COMPAT_DIR,
+        processes: int = MAX_PROCESSES,
+    ) -> "ReactantCompatibility":
+        compat = cls.load(building_blocks, rxn_templates, cache_dir)
+        if compat is not None:
+            return compat
+        logger.info(f"Building reactant compatibility matrix ({len(building_blocks)} bbs, {len(rxn_templates)} templates)")
+        if rxns is None:
+            rxns = [Reaction(template=tmplt) for tmplt in rxn_templates]
+        compat = cls.build(building_blocks, rxns, processes=processes)
+        fpath = cls.fpath(cls.key(building_blocks, rxn_templates), cache_dir)
+        os.makedirs(fpath.parent, exist_ok=True)
+        tmp = fpath.with_suffix(f".{os.getpid()}.tmp.npy")
+        np.save(tmp, compat.bits)
+        os.replace(tmp, fpath)  # atomic, concurrent builders race harmlessly
+        return compat
+
+    def is_compatible(self, bb_index: int, rxn_index: int, slot: int) -> bool:
+        return bool((self.bits[bb_index >> 3, rxn_index, slot] >> (7 - (bb_index & 7))) & 1)
+
+    def mask(self, rxn_index: int, slot: int) -> np.ndarray:
+        """Boolean mask over building blocks for one reactant slot."""
+        return np.unpackbits(self.bits[:, rxn_index, slot], count=self.n_bbs).astype(bool)
+
+    def indices(self, rxn_index: int, slot: int) -> np.ndarray:
+        """Indices of building blocks matching one reactant slot."""
+        return np.flatnonzero(self.mask(rxn_index, slot))
+
+    def matched(self) -> np.ndarray:
+        """Mask of building blocks that match at least one slot of any template."""
+        return np.unpackbits(np.bitwise_or.reduce(self.bits.reshape(self.bits.shape[0], -1), axis=1), count=self.n_bbs).astype(bool)
+
+    def available_reactants(self, rxn_index: int, num_reactant: int, building_blocks: list[str]) -> tuple:
+        return tuple(
+            [building_blocks[i] for i in self.indices(rxn_index, slot)] for slot in range(num_reactant)
+        )
+
+    def set_available_reactants(self, rxns: list[Reaction], building_blocks: list[str]) -> list[Reaction]:
+        """Sets `rxn.available_reactants` for every reaction, without any substructure matching."""
+        assert len(rxns) == self.n_rxns
+        for r, rxn in enumerate(rxns):
+            rxn.available_reactants = self.available_reactants(r, rxn.num_reactant, building_blocks)
+        return rxns
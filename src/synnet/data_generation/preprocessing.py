@@ -3,6 +3,7 @@ from pathlib import Path
 from tqdm import tqdm
 
 from synnet.config import MAX_PROCESSES
+from synnet.data_generation.compatibility import ReactantCompatibility
 from synnet.utils.data_utils import Reaction
 
 
@@ -33,28 +34,14 @@ class BuildingBlockFilter:
         self.verbose = verbose
         self.rxns_initialised = False
 
-    def _match_mp(self):
-        from functools import partial
-
-        from pathos import multiprocessing as mp
-
-        def __match(bblocks: list[str], _rxn: Reaction):
-            return _rxn.set_available_reactants(bblocks)
-
-        func = partial(__match, self.building_blocks)
-        with mp.Pool(processes=self.processes) as pool:
-            self.rxns = pool.map(func, tqdm(self.rxns))
-        return self
-
     def _init_rxns_with_reactants(self):
         """Initializes a `Reaction` with a list of possible reactants.
 
-        Info: This can take a while for lots of possible reactants."""
-        self.rxns = tqdm(self.rxns) if self.verbose else self.rxns
-        if self.processes == 1:
-            self.rxns = [rxn.set_available_reactants(self.building_blocks) for rxn in tqdm(self.rxns)]
-        else:
-            self._match_mp()
+        Info: The matching is cached on disk, see `ReactantCompatibility`."""
+        self.compat = ReactantCompatibility.load_or_build(
+            self.building_blocks, self.rxn_templates, rxns=self.rxns, processes=self.processes
+        )
+        self.compat.set_available_reactants(self.rxns, self.building_blocks)
 
         self.rxns_initialised = True
         return self
@@ -13,10 +13,12 @@ np.random.seed(0)
 random.seed(0)
 
 from synnet.config import MAX_PROCESSES
+from synnet.encoding.fingerprints import FP_ENGINE
 
 logger = logging.getLogger(__name__)
 
 from synnet.utils.data_utils import Reaction, SyntheticTree, SkeletonSet
+from synnet.data_generation.compatibility import ReactantCompatibility
 
 
 class NoReactantAvailableError(Exception):
@@ -85,34 +87,14 @@ class SynTreeGenerator:
         # Time intensive tasks
         self._init_rxns_with_reactants()
 
-    def __match_mp(self):
-        # TODO: refactor / merge with `BuildingBlockFilter`
-        # TODO: Rename `ReactionSet` -> `ReactionCollection` (same for `SyntheticTreeSet`)
-        #       `Reaction` as "datacls", `*Collection` as cls that encompasses operations on "data"?
-        #       Third class simpyl for file I/O or include somewhere?
-        from functools import partial
-
-        from pathos import multiprocessing as mp
-
-        def __match(bblocks: list[str], _rxn: Reaction):
-            return _rxn.set_available_reactants(bblocks)
-
-        func = partial(__match, self.building_blocks)
-        with mp.Pool(processes=self.processes) as pool:
-            rxns = pool.map(func, self.rxns)
-
-        self.rxns = rxns
-        return self
-
     def _init_rxns_with_reactants(self):
         """Initializes a `Reaction` with a list of possible reactants.
 
-        Info: This can take a while for lots of possible reactants."""
-        self.rxns = tqdm(self.rxns) if self.verbose else self.rxns
-        if self.processes == 1:
-            self.rxns = [rxn.set_available_reactants(self.building_blocks) for rxn in self.rxns]
-        else:
-            self.__match_mp()
+        Info: The matching is cached on disk, see `ReactantCompatibility`."""
+        self.compat = ReactantCompatibility.load_or_build(
+            self.building_blocks, self.rxn_templates, rxns=self.rxns, processes=self.processes
+        )
+        self.compat.set_available_reactants(self.rxns, self.building_blocks)
 
         self.rxns_initialised = True
         return self
@@ -375,15 +357,10 @@ class MorganFingerprintEncoder(Encoder):
         self.nbits = nbits
 
     def encode(self, smi: str) -> np.ndarray:
-        if smi is None:
-            fp = np.zeros((1, self.nbits))  # (1,d)
-        else:
-            mol = Chem.MolFromSmiles(smi)  # TODO: sanity check mol here or use datmol?
-            bv = Chem.AllChem.GetMorganFingerprintAsBitVect(mol, self.radius, self.nbits)
-            fp = np.empty(self.nbits)
-            Chem.DataStructs.ConvertToNumpyArray(bv, fp)
-            fp = fp[None, :]
-        return fp  # (1,d)
+        return FP_ENGINE.dense([smi], self.radius, self.nbits, dtype=np.float64)  # (1,d)
+
+    def encode_batch(self, smis: list[str], ncpu: int = 1) -> np.ndarray:
+        return FP_ENGINE.dense(smis, self.radius, self.nbits, dtype=np.float64, ncpu=ncpu)  # (n,d)
 
 
 class IdentityIntEncoder(Encoder):
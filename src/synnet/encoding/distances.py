@@ -1,6 +1,6 @@
 import numpy as np
 
-from synnet.encoding.fingerprints import mol_fp
+from synnet.encoding.fingerprints import FP_ENGINE, FingerprintEngine, mol_fp
 
 
 def cosine_distance(v1, v2):
@@ -55,5 +55,9 @@ def tanimoto_similarity(target_fp: np.ndarray, smis: list[str]):
     Returns:
         list of np.ndarray: Contains Tanimoto similarities.
     """
-    fps = [mol_fp(smi, 2, len(target_fp)) for smi in smis]
-    return [_tanimoto_similarity(target_fp, fp) for fp in fps]
+    target_fp = np.asarray(target_fp)
+    if not np.isin(target_fp, (0, 1)).all():
+        fps = [mol_fp(smi, 2, len(target_fp)) for smi in smis]
+        return [_tanimoto_similarity(target_fp, fp) for fp in fps]
+    fps = FP_ENGINE.packed(smis, 2, len(target_fp))
+    return list(FingerprintEngine.tanimoto(np.packbits(target_fp.astype(bool)), fps))
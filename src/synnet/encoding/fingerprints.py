@@ -1,6 +1,119 @@
+import functools
+import multiprocessing as mp
+import os
+import threading
+from collections import OrderedDict
+
 import numpy as np
-from rdkit import Chem
-from rdkit.Chem import AllChem, DataStructs
+from rdkit.Chem import rdFingerprintGenerator
+
+from synnet.config import FP_CACHE_SIZE, FP_CHUNK_SIZE
+from synnet.utils.mol_cache import get_mol
+
+# number of set bits of each byte value
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+class FingerprintEngine:
+    """Morgan fingerprints of batches of SMILES, stored bit-packed.
+
+    A fingerprint is kept as its `np.packbits` row (nbits // 8 uint8) in an LRU cache keyed on
+    (smiles, radius, nbits), and only unpacked by `dense` / `tensor` where it is consumed.
+    Large batches of uncached SMILES are fingerprinted across a process pool.
+    Under fork-based multiprocessing each worker inherits a copy of the parent's cache.
+    """
+
+    def __init__(self, capacity: int = FP_CACHE_SIZE):
+        self.capacity = capacity
+        self._fps = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def generator(radius: int, nbits: int):
+        return rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=nbits)
+
+    @staticmethod
+    def compute(smis: list[str], radius: int, nbits: int) -> np.ndarray:
+        """Packed fingerprints of `smis` without the cache, `None` gives a zero fingerprint."""
+        gen = FingerprintEngine.generator(radius, nbits)
+        fps = np.zeros((len(smis), (nbits + 7) // 8), dtype=np.uint8)
+        for i, smi in enumerate(smis):
+            if smi is None:
+                continue
+            mol = get_mol(smi)
+            if mol is None:
+                raise ValueError(f"Invalid SMILES {smi}")
+            fps[i] = np.packbits(gen.GetFingerprintAsNumPy(mol))
+        return fps
+
+    def packed(self, smis: list[str], radius: int = 2, nbits: int = 2048, ncpu: int = 1) -> np.ndarray:
+        """(len(smis), nbits // 8) uint8 matrix of packed fingerprints."""
+        fps = np.empty((len(smis), (nbits + 7) // 8), dtype=np.uint8)
+        missing = {}  # smiles -> rows
+        with self._lock:
+            for i, smi in enumerate(smis):
+                key = (smi, radius, nbits)
+                if key in self._fps:
+                    self._fps.move_to_end(key)
+                    fps[i] = self._fps[key]
+                else:
+                    missing.setdefault(smi, []).append(i)
+        if not missing:
+            return fps
+        todo = list(missing)
+        if ncpu > 1 and len(todo) > FP_CHUNK_SIZE:
+            chunks = [(todo[i : i + FP_CHUNK_SIZE], radius, nbits) for i in range(0, len(todo), FP_CHUNK_SIZE)]
+            with mp.Pool(ncpu) as pool:
+                computed = np.concatenate(pool.starmap(FingerprintEngine.compute, chunks))
+        else:
+            computed = FingerprintEngine.compute(todo, radius, nbits)
+        with self._lock:
+            for smi, fp in zip(todo, computed):
+                fps[missing[smi]] = fp
+                self._fps[(smi, radius, nbits)] = fp.copy()  # not a view, evicting frees it
+            while len(self._fps) > self.capacity:
+                self._fps.popitem(last=False)
+        return fps
+
+    @staticmethod
+    def unpack(fps: np.ndarray, nbits: int, dtype=np.float32) -> np.ndarray:
+        return np.unpackbits(fps, axis=-1, count=nbits).astype(dtype, copy=False)
+
+    def dense(self, smis: list[str], radius: int = 2, nbits: int = 2048, dtype=np.float32, ncpu: int = 1) -> np.ndarray:
+        return FingerprintEngine.unpack(self.packed(smis, radius, nbits, ncpu=ncpu), nbits, dtype)
+
+    @staticmethod
+    def unpack_tensor(fps: np.ndarray, nbits: int, device=None):
+        """Float32 torch tensor of packed fingerprints, unpacked on `device`."""
+        import torch
+
+        fps = torch.as_tensor(fps, device=device)
+        shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=fps.device)
+        bits = (fps.unsqueeze(-1) >> shifts) & 1
+        return bits.reshape(*fps.shape[:-1], -1)[..., :nbits].float()
+
+    def tensor(self, smis: list[str], radius: int = 2, nbits: int = 2048, device=None, ncpu: int = 1):
+        return FingerprintEngine.unpack_tensor(self.packed(smis, radius, nbits, ncpu=ncpu), nbits, device=device)
+
+    @staticmethod
+    def tanimoto(fp: np.ndarray, fps: np.ndarray) -> np.ndarray:
+        """Tanimoto similarities of one packed fingerprint to each row of `fps`."""
+        both = _POPCOUNT[fps & fp].sum(axis=-1)
+        return both / (_POPCOUNT[fp].sum() + _POPCOUNT[fps].sum(axis=-1) - both)
+
+    def clear(self):
+        with self._lock:
+            self._fps.clear()
+
+    def _after_fork(self):
+        # the parent's lock may have been held by another thread at fork time
+        self._lock = threading.Lock()
+
+
+FP_ENGINE = FingerprintEngine()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=FP_ENGINE._after_fork)
 
 
 ## Morgan fingerprints
@@ -20,11 +133,7 @@ def mol_fp(smi, _radius=2, _nBits=4096) -> np.ndarray:  # dtype=int64
     if smi is None:
         return np.zeros(_nBits)
     else:
-        mol = Chem.MolFromSmiles(smi)
-        features_vec = Chem.AllChem.GetMorganFingerprintAsBitVect(mol, _radius, _nBits)
-        return np.array(
-            features_vec
-        )  # TODO: much slower compared to `DataStructs.ConvertToNumpyArray` (20x?) so deprecates
+        return FP_ENGINE.dense([smi], _radius, _nBits, dtype=np.int64)[0]
 
 
 def fp_embedding(smi, _radius=2, _nBits=4096) -> list[float]:
@@ -39,38 +148,27 @@ def fp_embedding(smi, _radius=2, _nBits=4096) -> list[float]:
     Returns:
         np.ndarray: A Morgan fingerprint generated using the specified parameters.
     """
-    if smi is None:
-        return np.zeros(_nBits).reshape((-1,)).tolist()
-    else:
-        mol = Chem.MolFromSmiles(smi)
-        try:
-            features_vec = AllChem.GetMorganFingerprintAsBitVect(mol, _radius, _nBits)
-        except:
-            print(smi, "smi")
-            print(mol, "mol")
-        features = np.zeros((1,))
-        DataStructs.ConvertToNumpyArray(features_vec, features)
-        return features.reshape((-1,)).tolist()
+    return FP_ENGINE.dense([smi], _radius, _nBits, dtype=np.float64)[0].tolist()
 
 
 def fp_4096(smi):
-    return fp_embedding(smi, _radius=2, _nBits=4096)
+    return FP_ENGINE.dense([smi], 2, 4096)[0]
 
 
 def fp_2048(smi): # handle case of given fingerprint
     if isinstance(smi, np.ndarray):
         assert smi.shape == (2048,)
         return smi
-    return fp_embedding(smi, _radius=2, _nBits=2048)
+    return FP_ENGINE.dense([smi], 2, 2048)[0]
 
 
 def fp_1024(smi):
-    return fp_embedding(smi, _radius=2, _nBits=1024)
+    return FP_ENGINE.dense([smi], 2, 1024)[0]
 
 
 def fp_512(smi):
-    return fp_embedding(smi, _radius=2, _nBits=512)
+    return FP_ENGINE.dense([smi], 2, 512)[0]
 
 
 def fp_256(smi):
-    return fp_embedding(smi, _radius=2, _nBits=256)
+    return FP_ENGINE.dense([smi], 2, 256)[0]
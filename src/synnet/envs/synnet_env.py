@@ -5,8 +5,9 @@ from utils import cprint
 from static_env import StaticEnv
 from synnet.utils.predict_utils import mol_fp, tanimoto_similarity
 from synnet.utils.data_utils import Reaction, ReactionSet, SyntheticTreeSet, Skeleton, SkeletonSet, Program
+from synnet.utils.hash_index import HashIndex
 from synnet.config import DELIM
-from synnet.models.mlp import nn_search_list
+from synnet.utils.embedding_index import EmbeddingIndex
 from synnet.models.gnn import PtrDataset
 import os
 from copy import deepcopy
@@ -72,7 +73,7 @@ def prepare_input(sk, model_bb):
 
 def get_return(sk, state, model, hash_dir, rxns, bbs, bb_emb):
     """
-    bbs: all bbs
+    bbs: all bbs, as a BuildingBlockRegistry
     emb_bb: embedding of all bbs
     """    
     if sum(state[-sk.rxns.sum()*91:]) < 2:
@@ -94,9 +95,8 @@ def get_return(sk, state, model, hash_dir, rxns, bbs, bb_emb):
     parent_path = os.path.join(hash_dir, parent_path)
     child_path = os.path.join(hash_dir, Path(parent_path).stem, child_path)
 
-    parent_dic = json.load(open(parent_path))
-    child_dic = json.load(open(child_path))
-    lookup = {src: parent_dic, dest: child_dic}
+    hash_index = HashIndex.open(hash_dir)
+    lookup = {src: parent_path, dest: child_path}
 
     # reconstruct target
     for i in np.argwhere(sk.leaves).flatten():
@@ -104,23 +104,13 @@ def get_return(sk, state, model, hash_dir, rxns, bbs, bb_emb):
         parent = list(sk.tree.predecessors(i))[0]
         child = sk.tree.nodes[i]['child'] == 'right'
         term = node_map[parent]
-        if 'bbs' not in lookup[term]:
-            breakpoint()
-        bb_lookup = lookup[term]['bbs']
-        if str(term) in bb_lookup:
-            key = str(term)       
-            indices = [bbs.index(smi) for smi in bb_lookup[key][child]]             
-        else:
-            key = f"{str(term)}{DELIM}{int(child)}"
-            assert key in bb_lookup
-            assert len(bb_lookup[key]) == 1
-            indices = [bbs.index(smi) for smi in bb_lookup[key][0]]
+        indices = hash_index.bbs(lookup[term], term, int(child), bbs).astype(np.int64)
 
         # if 'save_smiles' in sk.tree.nodes[i]:
         #     assert bbs.index(sk.tree.nodes[i]['save_smiles']) in indices
         
-        bb_ind = nn_search_list(emb_bb, bb_emb[indices], top_k=1).item()
-        smiles = bbs[indices[bb_ind]]
+        _, bb_inds = EmbeddingIndex.open(bb_emb).search(emb_bb, 1, subset=indices)
+        smiles = bbs[int(bb_inds[0, 0])]
         sk.modify_tree(i, smiles=smiles)
     sk.reconstruct(rxns)
     poss = []
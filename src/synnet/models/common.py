@@ -24,6 +24,8 @@ def get_args():
     parser.add_argument("--pe", choices=['sin', 'one_hot', 'child'], help='pos encoding')
     parser.add_argument("--feats-split", action='store_true', help="add _{train|valid|test} suffix to gnn-input-feats")
     parser.add_argument("--rewire-edges", action='store_true', help="whether to rewire skeleton edges")
+    parser.add_argument("--masks-per-tree", type=int, default=1, help="masks sampled per syntree and epoch, for process-for-gnn.py --sample-masks data")
+    parser.add_argument("--fp-ids", action='store_true', help="read features as fingerprint ids (process-for-gnn.py --fp-ids), gathered on device; needs --lazy_load or --feats-split")
         
     parser.add_argument("--gnn-datasets", type=int, nargs='+')
     parser.add_argument("--lazy_load", action='store_true')
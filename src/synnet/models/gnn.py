@@ -1,5 +1,6 @@
-from synnet.utils.data_utils import SyntheticTree, SyntheticTreeSet, Skeleton, SkeletonSet
+from synnet.utils.data_utils import SyntheticTree, SyntheticTreeSet, Skeleton, SkeletonSet, valid_mask_inds, mask_state
 from synnet.models.mlp import GNN
+from synnet.utils.gnn_shards import FingerprintTable, GNNShards
 # from synnet.models.rt1 import _fetch_molembedder
 
 import pytorch_lightning as pl
@@ -37,9 +38,14 @@ MODEL_ID = Path(__file__).stem
 all_skeletons = pickle.load(open('/home/msun415/SynTreeNet/results/viz/skeletons.pkl','rb'))
 # keys = sorted([index for index in range(len(all_skeletons))], key=lambda ind: len(all_skeletons[list(all_skeletons)[ind]]))[-4:]
 class PtrDataset(Dataset):
-    def __init__(self, ptrs, rewire=False, pe=None, **kwargs):
+    def __init__(self, ptrs, rewire=False, pe=None, fp_table=None, seed=None, **kwargs):
         super().__init__(**kwargs)
         self.ptrs = ptrs
+        self.fp_table = fp_table # FingerprintTable, samples are read as fingerprint ids
+        # for {i}_syntrees.pkl ptrs: a fresh mask on every read if None, else a function of (seed, idx)
+        self.seed = seed
+        self.syntrees = {}
+        self.valid_inds = {}
         self.edge_index = {}
         self.graphs = {}
         self.interms_map = {}
@@ -47,6 +53,7 @@ class PtrDataset(Dataset):
         self.num_nodes = {}
         self.pe = pe
         self.child = {}
+        self.shards = {} # base -> GNNShards, None for the sparse .npz format
         for ptr in ptrs:
             _, e, _ = ptr
             if e in self.edge_index:
@@ -149,13 +156,25 @@ class PtrDataset(Dataset):
 
     def __getitem__(self, idx):
         base, e, index = self.ptrs[idx]
-        node_mask = sparse.load_npz(base+'_node_masks.npz').toarray()[index]
-        # smi = sparse.load_npz(base+'_smiles.npz').toarray()[index]
-        # if smi == 'CCNCC1=NNC(Cc2ccccc2CS(=O)(=O)N2CCCC2COC(C)(C)C)=N1':
-        #     breakpoint()
+        if base not in self.shards:
+            self.shards[base] = GNNShards(base) if GNNShards.exists(base) else None
         num_nodes = self.num_nodes[e]
-        X = sparse.load_npz(base+'_Xs.npz').toarray()
-        X = X.reshape(-1, num_nodes, X.shape[-1])[index]
+        if base.endswith('_syntrees.pkl'):
+            node_mask, X, y = self.sample(base, e, index, idx)
+        elif self.fp_table is not None:
+            return self.get_ids(base, e, index)
+        elif self.shards[base] is not None:
+            # only reads this sample's rows
+            node_mask, X, y, _ = self.shards[base][index]
+        else:
+            node_mask = sparse.load_npz(base+'_node_masks.npz').toarray()[index]
+            # smi = sparse.load_npz(base+'_smiles.npz').toarray()[index]
+            # if smi == 'CCNCC1=NNC(Cc2ccccc2CS(=O)(=O)N2CCCC2COC(C)(C)C)=N1':
+            #     breakpoint()
+            X = sparse.load_npz(base+'_Xs.npz').toarray()
+            X = X.reshape(-1, num_nodes, X.shape[-1])[index]
+            y = sparse.load_npz(base+'_ys.npz').toarray()
+            y = y.reshape(-1, num_nodes, y.shape[-1])[index]
         # add 1D positional encoding (num_nodes, dim)                        
         # interm nodes :2048 feats are 0
         # TODO: Fix these hacky tricks
@@ -178,8 +197,6 @@ class PtrDataset(Dataset):
         elif self.pe == 'child':
             pe = self.child[e]
             X = np.concatenate((X, pe), axis=-1)
-        y = sparse.load_npz(base+'_ys.npz').toarray()
-        y = y.reshape(-1, num_nodes, y.shape[-1])[index]
         # mask out y all rxns except bottom-2        
         # y[self.sks[e].rxns] = 0.
         key_val = e.split('/')[-1].split('_')[0]+''.join(list(map(str, node_mask)  ))
@@ -191,6 +208,59 @@ class PtrDataset(Dataset):
             torch.tensor(self.sks[e].leaves)
         )
         return Data(edge_index=data[0], key=data[1], x=data[2], y=data[3], bb_mask=data[4])
+
+
+    def sample(self, base, e, index, idx):
+        """(node_mask, X, y) of syntree index of base, under one of its valid masks"""
+        if base not in self.syntrees:
+            self.syntrees[base] = pickle.load(open(base, 'rb'))
+        syntrees = self.syntrees[base]
+        min_r_set, determine_criteria = syntrees['min_r_set'], syntrees['determine_criteria']
+        sk = Skeleton(syntrees['syntrees'][index], self.sks[e].index)
+        if base not in self.valid_inds:
+            # same for every syntree of the class, process-for-gnn.py stores them from the MaskTable
+            valid_inds = syntrees.get('valid_inds')
+            self.valid_inds[base] = valid_inds if valid_inds is not None else valid_mask_inds(sk, min_r_set, determine_criteria)
+        rng = np.random.default_rng() if self.seed is None else np.random.default_rng([self.seed, idx])
+        i = rng.choice(self.valid_inds[base])
+        return mask_state(int(i), sk, min_r_set, determine_criteria)
+
+
+    def pos_encoding(self, e):
+        num_nodes = self.num_nodes[e]
+        if self.pe == 'sin':
+            return self.positionalencoding1d(32, num_nodes).numpy()
+        elif self.pe == 'one_hot':
+            return np.eye(num_nodes)
+        elif self.pe == 'child':
+            return self.child[e]
+        return np.zeros((num_nodes, 0))
+
+
+    def get_ids(self, base, e, index):
+        """
+        Sample as fingerprint ids into self.fp_table, x only holds the positional encoding.
+        GNNModel.node_features gathers the fingerprints on device.
+        """
+        shards = self.shards[base]
+        n, _, y_dim, shard_size = shards.dims
+        shard = shards.shard(index // shard_size)
+        row = index % shard_size
+        node_mask = np.unpackbits(shard["node_masks"][row], count=n)
+        y = np.unpackbits(shard["y"][row], axis=-1, count=y_dim)
+        fp_ids, target_id, rxn_ids = shards.ids(index)
+        offset = self.fp_table.offsets[base]
+        key_val = e.split('/')[-1].split('_')[0]+''.join(list(map(str, node_mask)))
+        return Data(
+            edge_index=torch.tensor(self.edge_index[e], dtype=torch.int64),
+            key=np.array([key_val for _ in node_mask]),
+            x=torch.tensor(self.pos_encoding(e), dtype=torch.float32),
+            y=torch.tensor(y, dtype=torch.float32),
+            bb_mask=torch.tensor(self.sks[e].leaves),
+            fp_ids=torch.tensor(fp_ids + offset),
+            target_ids=torch.full((n,), target_id + offset, dtype=torch.int64), # every node sees the target
+            rxn_ids=torch.tensor(rxn_ids),
+        )
     
     
     def __len__(self):
@@ -198,7 +268,7 @@ class PtrDataset(Dataset):
 
 
 
-def gather_ptrs(input_dir, include_is=[], ratio=[8,1,1]):
+def gather_ptrs(input_dir, include_is=[], ratio=[8,1,1], masks_per_tree=1):
     used_is = []
     train_dataset_ptrs = []
     val_dataset_ptrs = []
@@ -214,11 +284,31 @@ def gather_ptrs(input_dir, include_is=[], ratio=[8,1,1]):
             i += 1
             continue
 
+        syntrees_file = os.path.join(input_dir, f"{i}_syntrees.pkl")
+        if os.path.exists(syntrees_file):
+            # process-for-gnn.py --sample-masks, masks_per_tree ptrs per syntree, see PtrDataset.sample
+            syntrees = pickle.load(open(syntrees_file, 'rb'))
+            if syntrees.get('valid_inds') is not None and not len(syntrees['valid_inds']):
+                # no mask satisfies the criteria, the class has no samples
+                continue
+            n = len(syntrees['syntrees'])
+            train_ind, val_ind = int(train_frac*n), int(val_frac*n)
+            for ptrs, start, end in [(train_dataset_ptrs, 0, train_ind), (val_dataset_ptrs, train_ind, val_ind), (test_dataset_ptrs, val_ind, n)]:
+                for j in range(start, end):
+                    ptrs += [(syntrees_file, os.path.join(input_dir, f"{i}_edge_index.npy"), j)]*masks_per_tree
+            used_is.append(str(i))
+            continue
+
         index = 0        
-        while os.path.exists(os.path.join(input_dir, f"{i}_{index}_node_masks.npz")):
+        while os.path.exists(os.path.join(input_dir, f"{i}_{index}_node_masks.npz")) or GNNShards.exists(os.path.join(input_dir, f"{i}_{index}")):
             # y = np.load(os.path.join(input_dir, f"{i}_{index}_ys.npy"))
-            node_mask = sparse.load_npz(os.path.join(input_dir, f"{i}_{index}_node_masks.npz"))
-            smiles = np.load(os.path.join(input_dir, f"{i}_{index}_smiles.npy"))  
+            if GNNShards.exists(os.path.join(input_dir, f"{i}_{index}")):
+                shards = GNNShards(os.path.join(input_dir, f"{i}_{index}"))
+                node_mask = shards.node_masks()
+                smiles = range(len(shards))
+            else:
+                node_mask = sparse.load_npz(os.path.join(input_dir, f"{i}_{index}_node_masks.npz"))
+                smiles = np.load(os.path.join(input_dir, f"{i}_{index}_smiles.npy"))  
             start_inds = []
             prev_sum = node_mask[0].sum()
             for j, nm in enumerate(node_mask):
@@ -245,6 +335,15 @@ def gather_ptrs(input_dir, include_is=[], ratio=[8,1,1]):
 
 
 
+def load_fp_table(args, ptrs):
+    """FingerprintTable of the batches of ptrs if args.fp_ids, else None"""
+    if not args.fp_ids:
+        return None
+    if any(base.endswith('_syntrees.pkl') for base, _, _ in ptrs):
+        raise ValueError("--fp-ids can't read process-for-gnn.py --sample-masks data, its features are computed while sampling")
+    return FingerprintTable([base for base, _, _ in ptrs])
+
+
 def load_lazy_dataloaders(args):
     input_dir = args.gnn_input_feats
     if not args.gnn_datasets:
@@ -255,10 +354,11 @@ def load_lazy_dataloaders(args):
         print(f"gnn-datasets has been set to {indices}")
         setattr(args, 'gnn_datasets', indices)    
     
-    train_dataset_ptrs, val_dataset_ptrs, test_dataset_ptrs, used_is = gather_ptrs(input_dir, args.gnn_datasets)        
-    dataset_train = PtrDataset(train_dataset_ptrs, args.rewire_edges, args.pe)
-    dataset_valid = PtrDataset(val_dataset_ptrs, args.rewire_edges, args.pe)
-    dataset_test = PtrDataset(test_dataset_ptrs, args.rewire_edges, args.pe)
+    train_dataset_ptrs, val_dataset_ptrs, test_dataset_ptrs, used_is = gather_ptrs(input_dir, args.gnn_datasets, masks_per_tree=args.masks_per_tree)        
+    fp_table = load_fp_table(args, train_dataset_ptrs+val_dataset_ptrs+test_dataset_ptrs)
+    dataset_train = PtrDataset(train_dataset_ptrs, args.rewire_edges, args.pe, fp_table=fp_table)
+    dataset_valid = PtrDataset(val_dataset_ptrs, args.rewire_edges, args.pe, fp_table=fp_table, seed=0)
+    dataset_test = PtrDataset(test_dataset_ptrs, args.rewire_edges, args.pe, fp_table=fp_table, seed=0)
     prefetch_factor = args.prefetch_factor
     train_dataloader = DataLoader(dataset_train, batch_size=args.batch_size, num_workers=args.ncpu, shuffle=True, prefetch_factor=prefetch_factor, persistent_workers=True)
     valid_dataloader = DataLoader(dataset_valid, batch_size=args.batch_size, num_workers=args.ncpu, prefetch_factor=prefetch_factor, persistent_workers=True)
@@ -285,8 +385,8 @@ def load_split_dataloaders(args):
         print(f"gnn-datasets has been set to {indices}")
         setattr(args, 'gnn_datasets', indices)    
 
-    train_dataset_ptrs, _, _, used_is['train'] = gather_ptrs(input_dir['train'], args.gnn_datasets, [1,0,0])
-    _, val_dataset_ptrs, _, used_is['valid'] = gather_ptrs(input_dir['valid'], args.gnn_datasets, [0,1,0])
+    train_dataset_ptrs, _, _, used_is['train'] = gather_ptrs(input_dir['train'], args.gnn_datasets, [1,0,0], args.masks_per_tree)
+    _, val_dataset_ptrs, _, used_is['valid'] = gather_ptrs(input_dir['valid'], args.gnn_datasets, [0,1,0], args.masks_per_tree)
     if len(val_dataset_ptrs) == 0:
         val_dataset_ptrs = train_dataset_ptrs
 
@@ -295,9 +395,10 @@ def load_split_dataloaders(args):
     test_dataset_ptrs = val_dataset_ptrs ; used_is['test'] = used_is['valid']
     # if not (used_is['train'] == used_is['valid'] == used_is['test']):
     #     breakpoint()
-    dataset_train = PtrDataset(train_dataset_ptrs, args.rewire_edges, args.pe)
-    dataset_valid = PtrDataset(val_dataset_ptrs, args.rewire_edges, args.pe)
-    dataset_test = PtrDataset(test_dataset_ptrs, args.rewire_edges, args.pe)
+    fp_table = load_fp_table(args, train_dataset_ptrs+val_dataset_ptrs+test_dataset_ptrs)
+    dataset_train = PtrDataset(train_dataset_ptrs, args.rewire_edges, args.pe, fp_table=fp_table)
+    dataset_valid = PtrDataset(val_dataset_ptrs, args.rewire_edges, args.pe, fp_table=fp_table, seed=0)
+    dataset_test = PtrDataset(test_dataset_ptrs, args.rewire_edges, args.pe, fp_table=fp_table, seed=0)
 
     prefetch_factor = args.prefetch_factor
     train_dataloader = DataLoader(dataset_train, batch_size=args.batch_size, num_workers=args.ncpu, shuffle=True, prefetch_factor=prefetch_factor, persistent_workers=bool(args.ncpu))
@@ -333,15 +434,20 @@ def load_dataloaders(args):
         node_masks, Xs, ys = [], [], []
         smiles = []
         index = 0        
-        while os.path.exists(os.path.join(input_dir, f"{i}_{index}_node_masks.npz")):
-            node_masks.append(sparse.load_npz(os.path.join(input_dir, f"{i}_{index}_node_masks.npz")))
-            num_nodes = edge_index.max()+1
-            X = sparse.load_npz(os.path.join(input_dir, f"{i}_{index}_Xs.npz"))
-            y = sparse.load_npz(os.path.join(input_dir, f"{i}_{index}_ys.npz"))
-            smile = np.load(os.path.join(input_dir, f"{i}_{index}_smiles.npy"))
-            smiles.append(smile)
-            X = X.reshape(-1, num_nodes, X.shape[-1])
-            y = y.reshape(-1, num_nodes, y.shape[-1])
+        while os.path.exists(os.path.join(input_dir, f"{i}_{index}_node_masks.npz")) or GNNShards.exists(os.path.join(input_dir, f"{i}_{index}")):
+            if GNNShards.exists(os.path.join(input_dir, f"{i}_{index}")):
+                node_mask, X, y, smile = GNNShards(os.path.join(input_dir, f"{i}_{index}")).load()
+                node_masks.append(node_mask)
+                smiles.append(smile)
+            else:
+                node_masks.append(sparse.load_npz(os.path.join(input_dir, f"{i}_{index}_node_masks.npz")))
+                num_nodes = edge_index.max()+1
+                X = sparse.load_npz(os.path.join(input_dir, f"{i}_{index}_Xs.npz"))
+                y = sparse.load_npz(os.path.join(input_dir, f"{i}_{index}_ys.npz"))
+                smile = np.load(os.path.join(input_dir, f"{i}_{index}_smiles.npy"))
+                smiles.append(smile)
+                X = X.reshape(-1, num_nodes, X.shape[-1])
+                y = y.reshape(-1, num_nodes, y.shape[-1])
             Xs.append(X)
             ys.append(y)
             print(f"loaded {i}_{index}")
@@ -393,6 +499,7 @@ def load_dataloaders(args):
 
 
 def main(args):
+    assert not args.fp_ids or args.feats_split or args.lazy_load, "--fp-ids needs --lazy_load or --feats-split"
     if args.feats_split:
         train_dataloader, valid_dataloader, _, used_is = load_split_dataloaders(args)
     elif args.lazy_load:
@@ -430,6 +537,8 @@ def main(args):
         datasets=used_is,
         **vars(args)
     )
+    if args.fp_ids:
+        gnn.model.set_fp_table(train_dataloader.dataset.fp_table.fps)
 
     # Set up Trainer
     save_dir = Path(args.results_log) / MODEL_ID
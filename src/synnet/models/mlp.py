@@ -13,6 +13,9 @@ import torch_geometric.nn as geom_nn
 from collections import defaultdict
 
 from synnet.MolEmbedder import MolEmbedder
+from synnet.config import NUM_POSS
+from synnet.encoding.fingerprints import FingerprintEngine
+from synnet.utils.embedding_index import EmbeddingIndex
 from sklearn.neighbors import NearestNeighbors
 
 logger = logging.getLogger(__name__)
@@ -142,8 +145,9 @@ class MLP(pl.LightningModule):
             # NOTE: Very slow!
             # Performing the knn-search can easily take a couple of minutes,
             # even for small datasets.
-            y = nn_search_list(y.detach().cpu(), self.X)
-            y_hat = nn_search_list(y_hat.detach().cpu(), self.X)
+            X_index = EmbeddingIndex.open(self.X, device="cpu")
+            y = X_index.search(y.detach().cpu())[1]
+            y_hat = X_index.search(y_hat.detach().cpu())[1]
             accuracy = (y_hat == y).sum() / len(y)
             loss = 1 - accuracy
         elif self.valid_loss == "faiss-knn":
@@ -233,6 +237,24 @@ class GNNModel(nn.Module):
             layer = gnn_layer(nn=nn.Sequential(lin_i_1, act, lin_i_2))            
         layers += [layer]
         self.layers = nn.ModuleList(layers)
+        # packed fingerprints of fingerprint-id data, not saved with the weights
+        self.register_buffer("fp_table", torch.zeros((0, 256), dtype=torch.uint8), persistent=False)
+        self.fp_bits = 2048
+
+    def set_fp_table(self, fps, nbits=2048):
+        """fps: (F, ceil(nbits/8)) packed fingerprints indexed by data.fp_ids / data.target_ids."""
+        self.fp_table = torch.as_tensor(np.asarray(fps), dtype=torch.uint8, device=self.fp_table.device)
+        self.fp_bits = nbits
+
+    def node_features(self, data):
+        """data.x, or for fingerprint-id data [node fp | target fp | rxn one-hot | data.x] gathered on device."""
+        if getattr(data, "fp_ids", None) is None:
+            return data.x
+        node_fps = FingerprintEngine.unpack_tensor(self.fp_table[data.fp_ids], self.fp_bits)
+        target_fps = FingerprintEngine.unpack_tensor(self.fp_table[data.target_ids], self.fp_bits)
+        rxn_ids = data.rxn_ids
+        rxns = F.one_hot(rxn_ids.clamp(min=0), NUM_POSS).float() * (rxn_ids >= 0).unsqueeze(-1)
+        return torch.cat((node_fps, target_fps, rxns, data.x.float()), dim=-1)
 
     def forward(self, data, return_attention=False):
         """Forward.
@@ -241,7 +263,7 @@ class GNNModel(nn.Module):
             x: Input features per node
             edge_index: List of vertex index pairs representing the edges in the graph (PyTorch geometric notation)
         """        
-        x = data.x
+        x = self.node_features(data)
         edge_index = data.edge_index
         if return_attention:
             attns = []
@@ -386,8 +408,10 @@ class GNN(pl.LightningModule):
                 
         if "nn_accuracy" in self.valid_loss:
             if y_bb.shape[0]:                
-                y = nn_search_list(y_bb, torch.as_tensor(self.X, dtype=torch.float32).to(y.device))
-                y_hat = nn_search_list(y_hat_bb, torch.as_tensor(self.X, dtype=torch.float32).to(y.device))            
+                # normalized once, moved to the validation device on first use
+                X_index = EmbeddingIndex.open(self.X, device=y_bb.device)
+                y = X_index.search(y_bb)[1]
+                y_hat = X_index.search(y_hat_bb)[1]
                 accuracy = (y_hat == y).sum() / len(y)
                 nn_acc_loss = (1 - accuracy)
                 self.log("val_nn_accuracy_loss", nn_acc_loss, on_step=False, on_epoch=True, prog_bar=True, logger=True)
@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from synnet.utils.data_utils import Reaction, ReactionSet, SyntheticTreeSet, Skeleton, SkeletonSet, Program
+from synnet.utils.hash_index import HashIndex
 from networkx.algorithms.traversal.depth_first_search import dfs_tree
 import os
 from pathlib import Path
@@ -30,6 +31,7 @@ class RxnPolicy(nn.Module):
         self.dense_v = nn.Linear(n_hidden, 1)
         self.tree = sk.tree
         self.hash_dir = hash_dir
+        self.hash_index = HashIndex.open(hash_dir)
         self.entries = self.compute_entries(sk)
         self.rxns = rxns
 
@@ -75,19 +77,11 @@ class RxnPolicy(nn.Module):
             parent = int(mask.sum(axis=-1).argwhere().flatten()[0])
             num_reactant = len(list(self.tree.successors(self.rxn_to_nodes[parent])))
             assert parent == self.node_map[self.rxn_to_nodes[parent]]
-            r_mask = []
-            paths = []
-            for r in range(91):
-                if self.rxns[r].num_reactant != num_reactant:
-                    paths.append('')
-                    r_mask.append(False)
-                else:
-                    rxn_graph_copy.nodes[parent]['rxn_id'] = r
-                    p = Program(rxn_graph_copy)
-                    path = os.path.join(self.hash_dir, p.get_path())
-                    paths.append(path)
-                    r_mask.append(os.path.exists(path))
-            mask[parent] = torch.from_numpy(np.array(r_mask))
+            r_mask = np.array([self.rxns[r].num_reactant == num_reactant for r in range(91)])
+            names = Program(rxn_graph_copy).get_paths(parent, range(91))
+            paths = [os.path.join(self.hash_dir, name) if ok else '' for name, ok in zip(names, r_mask)]
+            r_mask = r_mask & self.hash_index.exists(paths)
+            mask[parent] = torch.from_numpy(r_mask)
             mask = mask.flatten()
             if return_paths:
                 return mask, paths
@@ -114,19 +108,11 @@ class RxnPolicy(nn.Module):
             r_mask = [num_reactant == self.rxns[r].num_reactant for r in range(91)]
             if bool_mask[self.parents[unfilled]].item():
                 pred = self.parents[unfilled][0]
-                paths = []
-                for r in range(91):
-                    if not r_mask[r]:
-                        paths.append('')
-                        continue
-                    rxn_graph_copy.nodes[unfilled]['rxn_id'] = r
-                    p = Program(rxn_graph_copy)
-                    ppath = Path(entries[pred])
-                    path = os.path.join(ppath.parent, ppath.stem, p.get_path())
-                    paths.append(path)
-                    r_mask[r] = os.path.exists(path)
-                rxn_graph_copy.nodes[unfilled]['rxn_id'] = -1
-                mask[unfilled] = torch.from_numpy(np.array(r_mask))
+                ppath = Path(entries[pred])
+                names = Program(rxn_graph_copy).get_paths(unfilled, range(91))
+                paths = [os.path.join(ppath.parent, ppath.stem, name) if ok else '' for name, ok in zip(names, r_mask)]
+                r_mask = np.array(r_mask) & self.hash_index.exists(paths)
+                mask[unfilled] = torch.from_numpy(r_mask)
         mask = mask.reshape(self.n_actions)
         if return_paths:
             return mask, paths
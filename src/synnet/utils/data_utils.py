@@ -10,16 +10,21 @@ Here we define the following classes for working with synthetic tree data:
 import functools
 import gzip
 import itertools
+import mmap
+import sqlite3
+import struct
+import zipfile
 import shutil
 import uuid
 import json
+import re
 import numpy as np
 import random
 from typing import Any, Optional, Set, Tuple, Union
 import multiprocessing as mp
-from multiprocessing import Array, Manager
+from multiprocessing import Manager
 mp.set_start_method('fork')
-from synnet.config import MP_MIN_COMBINATIONS, MAX_PROCESSES, PRODUCT_DIR, PRODUCT_JSON, NUM_THREADS, DELIM
+from synnet.config import MP_MIN_COMBINATIONS, MAX_PROCESSES, PRODUCT_DIR, PRODUCT_JSON, PRODUCT_NPZ, NUM_THREADS, DELIM, RXN_CHUNK_SIZE, RXN_CHECKPOINT_CHUNKS, PRODUCT_LRU_SIZE
 import threading
 from rdkit import Chem
 from rdkit.Chem import AllChem, Draw, rdChemReactions
@@ -29,7 +34,7 @@ from tqdm import tqdm
 import pickle
 from time import time
 from itertools import permutations, product
-from collections import defaultdict, deque
+from collections import Counter, OrderedDict, defaultdict, deque
 from networkx.algorithms.isomorphism import rooted_tree_isomorphism
 from networkx.algorithms import weisfeiler_lehman_graph_hash
 from networkx.algorithms.traversal.depth_first_search import dfs_tree
@@ -39,14 +44,17 @@ from matplotlib.patches import FancyArrowPatch
 from matplotlib.lines import Line2D
 from sklearn.manifold import MDS
 from zss import Node as ZSSNode, simple_distance
-from copy import deepcopy
+from copy import copy, deepcopy
+from contextlib import closing, nullcontext
 from filelock import FileLock
 from synnet.encoding.fingerprints import fp_2048, fp_256
+from synnet.utils.mol_cache import get_mol
 import os
 import math
 import zss
 import logging
 import hashlib
+import inspect
 
 
 # the definition of reaction classes below
@@ -111,6 +119,37 @@ class Reaction:
         rdChemReactions.ChemicalReaction.Initialize(rxn)
         return rxn
 
+    @property
+    def rxn(self) -> Chem.rdChemReactions.ChemicalReaction:
+        """The `rdkit` reaction, parsed from `smirks` on first access."""
+        if self.__dict__.get("_rxn") is None:
+            self._rxn = self.__init_reaction(self.smirks)
+        return self._rxn
+
+    @rxn.setter
+    def rxn(self, rxn: Chem.rdChemReactions.ChemicalReaction):
+        self._rxn = rxn
+
+    @property
+    def reactant_patterns(self) -> list[Chem.Mol]:
+        """Query mols of `reactant_template`, parsed once per instance."""
+        if self.__dict__.get("_reactant_patterns") is None:
+            self._reactant_patterns = [Chem.MolFromSmarts(t) for t in self.reactant_template]
+        return self._reactant_patterns
+
+    def __getstate__(self):
+        # rdkit objects are not carried through pickle/deepcopy,
+        # they are rebuilt lazily from `smirks` on first use
+        state = self.__dict__.copy()
+        state.pop("_rxn", None)
+        state.pop("_reactant_patterns", None)
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        state.pop("rxn", None) # pickles from before `rxn` was cached lazily
+        self.__dict__.update(state)
+
     def load(
         self,
         smirks,
@@ -139,10 +178,9 @@ class Reaction:
         self.rxnname = rxnname
         self.smiles = smiles
         self.reference = reference
-        self.rxn = self.__init_reaction(self.smirks)
+        self.rxn = None # parsed lazily
         return self
 
-    @functools.lru_cache(maxsize=20)
     def get_mol(self, smi: Union[str, Chem.Mol]) -> Chem.Mol:
         """
         A internal function that returns an `RDKit.Chem.Mol` object.
@@ -155,7 +193,7 @@ class Reaction:
             RDKit.Chem.Mol
         """
         if isinstance(smi, str):
-            return Chem.MolFromSmiles(smi)
+            return get_mol(smi)
         elif isinstance(smi, Chem.Mol):
             return smi
         else:
@@ -201,16 +239,14 @@ class Reaction:
         mol = self.get_mol(smi)
         if mol is None:
             return False
-        pattern = Chem.MolFromSmarts(self.reactant_template[0])
-        return mol.HasSubstructMatch(pattern)
+        return mol.HasSubstructMatch(self.reactant_patterns[0])
 
     def is_reactant_second(self, smi: Union[str, Chem.Mol]) -> bool:
         """Check if `smi` the second reactant in this reaction"""
         mol = self.get_mol(smi)
         if mol is None:
             return False
-        pattern = Chem.MolFromSmarts(self.reactant_template[1])
-        return mol.HasSubstructMatch(pattern)
+        return mol.HasSubstructMatch(self.reactant_patterns[1])
 
     def run_reaction(
         self, reactants: Tuple[Union[str, Chem.Mol, None]], keep_main: bool = True
@@ -313,6 +349,10 @@ class Reaction:
         self.available_reactants = self._filter_reactants(building_blocks, verbose=verbose)
         return self
 
+    def available_reactant_ids(self, registry: "BuildingBlockRegistry") -> Tuple[np.ndarray, ...]:
+        """`available_reactants` as int32 building-block ids, one array per reactant slot."""
+        return tuple(registry.ids(reactants) for reactants in self.available_reactants)
+
     @property
     def get_available_reactants(self) -> Set[str]:
         return {x for reactants in self.available_reactants for x in reactants}
@@ -322,14 +362,380 @@ class Reaction:
         *Excludes* Not-easily-serializable `self.rxn: rdkit.Chem.ChemicalReaction`."""
         import copy
 
-        out = copy.deepcopy(self.__dict__)  # TODO:
-        _ = out.pop("rxn")
+        out = copy.deepcopy(self.__getstate__())  # TODO:
         return out
 
 
 
+class BuildingBlockRegistry:
+    """Maps building-block SMILES <-> int32 ids (position in the building block file).
+
+    Can be used in place of the list of building blocks: `len`, iteration, `in`,
+    indexing and `.index()` work as for the list, but lookups are O(1).
+    """
+
+    def __init__(self, building_blocks: list[str]):
+        self.smiles = np.array(building_blocks, dtype=object)
+        self._ids = {smi: i for i, smi in enumerate(building_blocks)}
+
+    def __len__(self):
+        return len(self.smiles)
+
+    def __iter__(self):
+        return iter(self.smiles)
+
+    def __contains__(self, smi):
+        return smi in self._ids
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.smiles[i].tolist()
+        if isinstance(i, (list, np.ndarray)):
+            return self.smiles[np.asarray(i, dtype=np.int64)].tolist()
+        return self.smiles[i]
+
+    def index(self, smi: str) -> int:
+        try:
+            return self._ids[smi]
+        except KeyError:
+            raise ValueError(f"{smi} is not a registered building block")
+
+    def ids(self, smis, missing: Optional[int] = None) -> np.ndarray:
+        """int32 ids of `smis`. Unknown SMILES raise, or map to `missing` if given."""
+        if missing is None:
+            return np.fromiter((self.index(smi) for smi in smis), dtype=np.int32)
+        return np.fromiter((self._ids.get(smi, missing) for smi in smis), dtype=np.int32)
+
+    def to_smiles(self, ids) -> list[str]:
+        return self[np.asarray(ids)]
+
+
+def product_ext():
+    """File extension of newly written product maps"""
+    if PRODUCT_NPZ:
+        return "npz"
+    return "json" if PRODUCT_JSON else "pkl"
+
+
+class ProductStore:
+    """
+    Content-addressed store of product map files in root (PRODUCT_DIR)
+    A file is named by the md5 of its contents, so identical maps are stored once and copies are free
+    root/refs.db counts the ProductMap/ProductMapLink references to each file:
+        put() adds a reference (storing the file if new), copy()/combine() incref, save() decrefs the replaced file
+        sweep() removes the files without references
+        recount() resets the counts to the references of everything live (e.g. after dropping programs),
+        which must cover all holders of references, see program_catalog.cache_references
+    put() and sweep() hold the database's write lock while they check and change files, so a sweep can't
+    remove a file between put() finding it and counting the new reference.
+    SQLite's locking is not reliable on network filesystems (PRODUCT_DIR on the shared /dccstor), there
+    only one process at a time may write to a root: don't run builds or clean_cache.py concurrently on it.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.db_path = os.path.join(root, "refs.db")
+
+
+    def _connect(self):
+        os.makedirs(self.root, exist_ok=True)
+        con = sqlite3.connect(self.db_path, timeout=600)
+        con.execute("CREATE TABLE IF NOT EXISTS refs (fpath TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        return con
+
+
+    @staticmethod
+    def digest(fpath):
+        m = hashlib.md5()
+        with open(fpath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                m.update(block)
+        return m.hexdigest()
+
+
+    def put(self, write, obj, ext):
+        """
+        Stores write(obj, fpath) under the hash of the written file, returns the stored fpath
+        """
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, f"{str(uuid.uuid4())}.tmp.{ext}")
+        write(obj, tmp)
+        fpath = os.path.join(self.root, f"{ProductStore.digest(tmp)}.{ext}")
+        with closing(self._connect()) as con, con:
+            con.execute("BEGIN IMMEDIATE") # excludes sweep until the reference is counted
+            con.execute(
+                "INSERT INTO refs VALUES (?, 1) ON CONFLICT(fpath) DO UPDATE SET count = count + 1", (fpath,)
+            )
+            if os.path.exists(fpath):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, fpath) # atomic, concurrent writers of the same map race harmlessly
+        return fpath
+
+
+    def incref(self, fpaths, n=1):
+        with closing(self._connect()) as con, con:
+            con.executemany(
+                "INSERT INTO refs VALUES (?, ?) ON CONFLICT(fpath) DO UPDATE SET count = count + excluded.count",
+                [(fpath, n) for fpath in fpaths]
+            )
+
+
+    def decref(self, fpaths):
+        with closing(self._connect()) as con, con:
+            con.executemany(
+                "INSERT INTO refs VALUES (?, 0) ON CONFLICT(fpath) DO UPDATE SET count = max(count - 1, 0)",
+                [(fpath,) for fpath in fpaths]
+            )
+
+
+    def count(self, fpath):
+        with closing(self._connect()) as con:
+            row = con.execute("SELECT count FROM refs WHERE fpath = ?", (fpath,)).fetchone()
+        return row[0] if row else 0
+
+
+    def recount(self, fpaths):
+        """
+        fpaths are all references held by the live programs and cached results, with repeats
+        """
+        counts = Counter(fpaths)
+        with closing(self._connect()) as con, con:
+            con.execute("UPDATE refs SET count = 0")
+            con.executemany(
+                "INSERT INTO refs VALUES (?, ?) ON CONFLICT(fpath) DO UPDATE SET count = excluded.count",
+                list(counts.items())
+            )
+
+
+    def sweep(self):
+        """
+        Removes the files no program references, returns how many
+        """
+        with closing(self._connect()) as con, con:
+            con.execute("BEGIN IMMEDIATE") # no put() can count a reference to these files meanwhile
+            fpaths = [row[0] for row in con.execute("SELECT fpath FROM refs WHERE count <= 0")]
+            con.executemany("DELETE FROM refs WHERE fpath = ? AND count <= 0", [(fpath,) for fpath in fpaths])
+            for fpath in fpaths:
+                if os.path.exists(fpath):
+                    os.remove(fpath)
+        return len(fpaths)
+
+
+
+def product_store():
+    return ProductStore(PRODUCT_DIR)
+
+
+
+def mmap_npz(fpath):
+    """
+    Arrays of an (uncompressed, as written by np.savez) .npz file as views of one read-only mmap of the file
+    Nothing is read until the arrays are used
+    """
+    arrays = {}
+    with open(fpath, 'rb') as f, zipfile.ZipFile(f) as zf:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for info in zf.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED, f"{fpath} is compressed"
+            # local file header: 30 bytes, then the name and extra field, then the .npy
+            name_len, extra_len = struct.unpack('<HH', buf[info.header_offset+26:info.header_offset+30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[info.filename[:-len(".npy")]] = np.ndarray(
+                shape, dtype=dtype, buffer=buf, offset=f.tell(), order='F' if fortran_order else 'C'
+            )
+    return arrays
+
+
+class ProductTable:
+    """
+    Columnar form of one node's product map {interm: {entry: [reactant index, ...]}}
+    All interms share the same entries, so the map is stored as
+        interms: interned intermediate smiles, row i of indices belongs to interms[i]
+        entries: entry keys, node or (node, reactant idx)
+        entry_offsets: columns of entries[j] are entry_offsets[j]:entry_offsets[j+1]
+        indices: int32 array (num interms, num columns) of indices into .available_reactants
+    Reading an interm returns a new dict, use reindex/drop/offset to modify the table
+    Arrays are never written in place, so tables from ProductTable.mmap stay read-only views of the file
+    (fpath is the file it was read from, reset to None once the table no longer matches it)
+    """
+    def __init__(self, interms, entries, entry_offsets, indices, encoded=None, fpath=None):
+        # interms=None with encoded=(interm_bytes, interm_offsets) decodes the smiles on first use
+        self._interms = None if interms is None else list(interms)
+        self._encoded = encoded if interms is None else None
+        self.entries = list(entries)
+        self.entry_offsets = np.asarray(entry_offsets, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32).reshape(len(self), self.entry_offsets[-1])
+        self.fpath = fpath
+        self._rows = None
+
+
+    @property
+    def interms(self):
+        if self._interms is None:
+            interm_bytes, offsets = self._encoded
+            interm_bytes, offsets = bytes(interm_bytes), offsets.tolist()
+            self._interms = [interm_bytes[a:b].decode() for a, b in zip(offsets[:-1], offsets[1:])]
+            self._encoded = None
+        return self._interms
+
+
+    @interms.setter
+    def interms(self, interms):
+        self._interms = list(interms)
+        self._encoded = None
+
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = {interm: i for i, interm in enumerate(self.interms)}
+        return self._rows
+
+
+    @staticmethod
+    def from_dict(node_map):
+        interms = list(node_map)
+        entries = list(node_map[interms[0]]) if interms else []
+        entry_offsets = [0]
+        for e in entries:
+            entry_offsets.append(entry_offsets[-1] + len(node_map[interms[0]][e]))
+        indices = np.empty((len(interms), entry_offsets[-1]), dtype=np.int32)
+        for i, interm in enumerate(interms):
+            assert list(node_map[interm]) == entries
+            indices[i] = [idx for e in entries for idx in node_map[interm][e]]
+        return ProductTable(interms, entries, entry_offsets, indices)
+
+
+    def to_dict(self):
+        return {interm: self[interm] for interm in self.interms}
+
+
+    def to_arrays(self, prefix=''):
+        if self._interms is None:
+            interm_bytes, interm_offsets = self._encoded
+        else:
+            encoded = [interm.encode() for interm in self.interms]
+            interm_bytes = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            interm_offsets = np.cumsum([0] + [len(b) for b in encoded], dtype=np.int64)
+        entries = [list(e) if isinstance(e, tuple) else [e, -1] for e in self.entries]
+        return {
+            f"{prefix}interm_bytes": interm_bytes,
+            f"{prefix}interm_offsets": interm_offsets,
+            f"{prefix}entries": np.array(entries, dtype=np.int32).reshape(-1, 2),
+            f"{prefix}entry_offsets": self.entry_offsets,
+            f"{prefix}indices": self.indices,
+        }
+
+
+    @staticmethod
+    def from_arrays(arrays, prefix='', fpath=None):
+        encoded = (arrays[f"{prefix}interm_bytes"], arrays[f"{prefix}interm_offsets"])
+        entries = [n if idx == -1 else (n, idx) for n, idx in arrays[f"{prefix}entries"].tolist()]
+        return ProductTable(None, entries, arrays[f"{prefix}entry_offsets"], arrays[f"{prefix}indices"], encoded=encoded, fpath=fpath)
+
+
+    @staticmethod
+    def mmap(fpath):
+        """
+        Table backed by a read-only mmap of an .npz node file, see mmap_npz
+        """
+        return ProductTable.from_arrays(mmap_npz(fpath), fpath=fpath)
+
+
+    def __len__(self):
+        if self._interms is None:
+            return len(self._encoded[1])-1
+        return len(self._interms)
+
+
+    def __iter__(self):
+        return iter(self.interms)
+
+
+    def __contains__(self, interm):
+        return interm in self.rows
+
+
+    def keys(self):
+        return self.interms
+
+
+    def __getitem__(self, interm):
+        row = self.indices[self.rows[interm]].tolist()
+        offsets = self.entry_offsets.tolist()
+        return {e: row[offsets[j]:offsets[j+1]] for j, e in enumerate(self.entries)}
+
+
+    def drop(self, interms):
+        """
+        Removes the rows of interms
+        """
+        drop_rows = [self.rows[interm] for interm in interms]
+        if not drop_rows:
+            return
+        keep = np.ones(len(self.interms), dtype=bool)
+        keep[drop_rows] = False
+        self.interms = [interm for interm, k in zip(self.interms, keep) if k]
+        self.indices = self.indices[keep]
+        self.fpath = None
+        self._rows = None
+
+
+    def pop(self, interm):
+        val = self[interm]
+        self.drop([interm])
+        return val
+
+
+    def offset(self, offset):
+        """
+        New table with entry nodes shifted by offset, see Program.combine
+        """
+        entries = [(e[0]+offset, e[1]) if isinstance(e, tuple) else e+offset for e in self.entries]
+        return ProductTable(self._interms, entries, self.entry_offsets, self.indices, encoded=self._encoded)
+
+
+    def reactant_counts(self, radices, rows=None):
+        """
+        How often each reactant is used, per entry and reactant as in all_reactant_indices
+        radices are Program.entry_radices(self.entries, rxn_map), rows optionally selects the interms to count
+        """
+        indices = self.indices if rows is None else self.indices[rows]
+        counts = [[] for _ in self.entries]
+        for col, (j, _, num_reactants) in enumerate(radices):
+            counts[j].append(np.bincount(indices[:, col], minlength=num_reactants))
+        return counts
+
+
+    def reindex(self, entries, all_reactant_indices):
+        """
+        Maps every reactant index column through all_reactant_indices[entry][reactant], see Program.reindex_product_map
+        """
+        if not len(self.interms):
+            return
+        assert self.entries == list(entries)
+        indices = np.array(self.indices)
+        for j in range(len(self.entries)):
+            for i, col in enumerate(range(self.entry_offsets[j], self.entry_offsets[j+1])):
+                new_idx = np.asarray(all_reactant_indices[j][i], dtype=np.int32)[indices[:, col]]
+                assert (new_idx != -1).all()
+                indices[:, col] = new_idx
+        self.indices = indices
+        self.fpath = None
+
+
+
 class ProductMap:
-    def __init__(self, fpath, loaded=True):         
+    """
+    Product map of a whole program in one file, stored in the ProductStore
+    fpath is None until the map is first saved
+    """
+    def __init__(self, fpath=None, loaded=True):         
         self.fpath = fpath
         if loaded:
             self._product_map = {}
@@ -344,10 +750,12 @@ class ProductMap:
         logger = logging.getLogger('global_logger')
         logger.info(f"begin saving product map")
         assert self._loaded, "need to call load() first"      
-        if PRODUCT_JSON:
-            ProductMap.json_dump(self._product_map, open(self.fpath, 'w+'))
-        else:
-            pickle.dump(self._product_map, open(self.fpath, 'wb+'))
+        store = product_store()
+        old_fpath = self.fpath
+        ext = product_ext() if old_fpath is None else os.path.splitext(old_fpath)[1][1:]
+        self.fpath = store.put(ProductMap.write, self._product_map, ext)
+        if old_fpath is not None:
+            store.decref([old_fpath])
         logger.info(f"done saving product map")
         self._product_map = None
         self._loaded = False
@@ -407,13 +815,92 @@ class ProductMap:
         
 
     
+    @staticmethod
+    def read(fpath):
+        """
+        Reads a whole product map {node: node map}, the format is given by the file extension
+        """
+        if fpath.endswith(".npz"):
+            with np.load(fpath) as arrays:
+                return {n: ProductTable.from_arrays(arrays, prefix=f"{n}/") for n in arrays["nodes"].tolist()}
+        elif fpath.endswith(".json"):
+            return ProductMap.json_load(open(fpath, 'r'))
+        else:
+            return ProductMap.str_key_to_int(pickle.load(open(fpath, 'rb')))
+
+
+    @staticmethod
+    def write(product_map, fpath):
+        if fpath.endswith(".npz"):
+            arrays = {"nodes": np.array(list(product_map), dtype=np.int64)}
+            for n, node_map in product_map.items():
+                if not isinstance(node_map, ProductTable):
+                    node_map = ProductTable.from_dict(node_map)
+                arrays.update(node_map.to_arrays(prefix=f"{n}/"))
+            ProductMap.savez(fpath, arrays)
+            return
+        product_map = {n: node_map.to_dict() if isinstance(node_map, ProductTable) else node_map for n, node_map in product_map.items()}
+        if fpath.endswith(".json"):
+            ProductMap.json_dump(product_map, open(fpath, 'w+'))
+        else:
+            pickle.dump(product_map, open(fpath, 'wb+'))
+
+
+    @staticmethod
+    def savez(fpath, arrays):
+        """
+        np.savez with fixed zip timestamps, so that equal maps are written to equal bytes (see ProductStore)
+        """
+        with zipfile.ZipFile(fpath, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for name, arr in arrays.items():
+                info = zipfile.ZipInfo(f"{name}.npy", date_time=(1980, 1, 1, 0, 0, 0))
+                with zf.open(info, 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(arr), allow_pickle=False)
+
+
+    @staticmethod
+    def read_node(fpath):
+        """
+        Reads one node's map, as stored by ProductMapLink
+        """
+        if fpath.endswith(".npz"):
+            with np.load(fpath) as arrays:
+                return ProductTable.from_arrays(arrays)
+        elif fpath.endswith(".json"):
+            return ProductMap.json_load(open(fpath, 'r'))
+        else:
+            return pickle.load(open(fpath, 'rb'))
+
+
+    @staticmethod
+    def write_node(node_map, fpath):
+        if fpath.endswith(".npz"):
+            if not isinstance(node_map, ProductTable):
+                node_map = ProductTable.from_dict(node_map)
+            ProductMap.savez(fpath, node_map.to_arrays())
+        elif fpath.endswith(".json"):
+            ProductMap.json_dump(node_map.to_dict() if isinstance(node_map, ProductTable) else node_map, open(fpath, 'w+'))
+        else:
+            pickle.dump(node_map.to_dict() if isinstance(node_map, ProductTable) else node_map, open(fpath, 'wb+'))
+
+
+    @staticmethod
+    def convert(fpath, node=False):
+        """
+        Converts a .json/.pkl product map (or ProductMapLink node file if node) into .npz
+        Returns the new fpath, the old file is left in place
+        """
+        new_fpath = f"{os.path.splitext(fpath)[0]}.npz"
+        if node:
+            ProductMap.write_node(ProductMap.read_node(fpath), new_fpath)
+        else:
+            ProductMap.write(ProductMap.read(fpath), new_fpath)
+        return new_fpath
+
+
     def load(self):
         if not self._loaded:      
-            if PRODUCT_JSON:
-                self._product_map = ProductMap.json_load(open(self.fpath, 'r'))       
-            else:
-                self._product_map = pickle.load(open(self.fpath, 'rb'))
-                self._product_map = self.str_key_to_int(self._product_map)
+            self._product_map = ProductMap.read(self.fpath)
             self._loaded = True
     
 
@@ -432,6 +919,8 @@ class ProductMap:
         n, interm, e = key
         if n not in self._product_map:
             self._product_map[n] = {}
+        if isinstance(self._product_map[n], ProductTable):
+            self._product_map[n] = self._product_map[n].to_dict()
         if interm not in self._product_map[n]:
             self._product_map[n][interm] = {}        
         self._product_map[n][interm][e] = val
@@ -452,21 +941,30 @@ class ProductMap:
     
 
     def copy(self):
-        ext = "json" if PRODUCT_JSON else "pkl"
-        new_fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-        while os.path.exists(new_fpath):
-            new_fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
+        """
+        unsaved work on _product_map is stored for the copy only
+        """
+        store = product_store()
         if not self._loaded:
-            self.load()
-        if PRODUCT_JSON:
-            ProductMap.json_dump(self._product_map, open(new_fpath, 'w+'))
-        else:
-            pickle.dump(self._product_map, open(new_fpath, 'wb+'))
-        new_pmap = ProductMap(new_fpath, loaded=False)        
+            store.incref([self.fpath])
+            return ProductMap(self.fpath, loaded=False)
+        ext = product_ext() if self.fpath is None else os.path.splitext(self.fpath)[1][1:]
+        new_pmap = ProductMap(store.put(ProductMap.write, self._product_map, ext), loaded=False)        
         self.unload()
         return new_pmap
 
 
+    def files(self):
+        return [] if self.fpath is None else [self.fpath]
+
+
+    def release(self):
+        """
+        Drops this map's references, see ProductStore.sweep
+        """
+        product_store().decref(self.files())
+
+
 
     def combine(self, other, offset):
         if not self._loaded:
@@ -474,6 +972,10 @@ class ProductMap:
         if not other._loaded:
             other.load()
         for n in other._product_map:
+            if isinstance(other._product_map[n], ProductTable):
+                assert n+offset not in self._product_map
+                self._product_map[n+offset] = other._product_map[n].offset(offset)
+                continue
             for r in other._product_map[n]:
                 for e, v in other._product_map[n][r].items():
                     self[(n+offset, r, e+offset)] = v
@@ -485,111 +987,140 @@ class ProductMap:
 class ProductMapLink:
     """
     Making a product map memory-efficient by storing a dict of files
+    Node files live in the ProductStore and are never modified, so programs share them (copy-on-write)
     The following functions are available:
-        load(): load all base files into a in-memory dict
-        save(): write _product_map back into the base files
-        copy(): create a new ProductMapLink with new (copied) list of files
+        load(): start lazy access, a node's file is only read (mmapped if .npz) when the node is accessed
+        save(): store the modified nodes, replacing their base files
+        copy(): create a new ProductMapLink sharing the base files
         combine(): combine two ProductMapLinks, by combining base files with disjoint keys
+        files(): the base files referenced
+        release(): drop the references to the base files
         __getitem__
         __setitem__        
+    Clean .npz nodes are kept in an LRU (_open) of at most PRODUCT_LRU_SIZE maps
+    Nodes in _product_map are the ones that were set or changed and are written back by save()
     """
     def __init__(self, fpaths):
         self.fpaths = fpaths
         assert isinstance(fpaths, dict)
         self._product_map = None
+        self._open = OrderedDict()
         self._loaded = False
-        for fpath in self.fpaths.values():
+        for fpath in self.files():
             assert os.path.exists(fpath)   
 
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_open'] = OrderedDict() # never pickle the mmapped arrays
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_open', OrderedDict())
+
+
+    def files(self):
+        return [fpath[1] if isinstance(fpath, tuple) else fpath for fpath in self.fpaths.values()]
+
+
+    def release(self):
+        product_store().decref(self.files())
+
+
     def load(self):
-        logger = logging.getLogger('global_logger')
-        logger.info(f"begin loading product map link")        
         if not self._loaded:    
             self._product_map = {}
+            self._open = OrderedDict()
             self._loaded = True
-            for entry_key, fpath in self.fpaths.items():
-                logger.info(f"begin loading {fpath} for entry key {entry_key}")
-                # with FileLock(f"{fpath}.lock"):
-                offset = 0
-                if isinstance(fpath, tuple):
-                    offset, fpath = fpath
-                    self.fpaths[entry_key] = fpath  
-                try:                       
-                    f = open(fpath, 'r' if PRODUCT_JSON else 'rb')
-                    self._product_map[entry_key] = (ProductMap.json_load if PRODUCT_JSON else pickle.load)(f)
-                except:
-                    print(fpath)
-                if offset:
-                    n = entry_key
-                    for r in self._product_map[n]:
-                        entries = list(self._product_map[n][r].keys())
-                        for e in entries:
-                            if isinstance(e, tuple):
-                                offset_key = (int(e[0])+offset, int(e[1])) 
-                            else:
-                                offset_key = int(e)+offset
-                            assert offset_key not in self[(n,r)]
-                            self[(n, r, offset_key)] = self._product_map[n][r][e]                                
-                        for e in entries:
-                            self._product_map[n][r].pop(e)
-        logger.info(f"done loading product map link")
+
+
+    def _read(self, entry_key):
+        """
+        Reads the base file of entry_key, applying the offset from combine()
+        """
+        fpath = self.fpaths[entry_key]
+        offset = 0
+        if isinstance(fpath, tuple):
+            offset, fpath = fpath
+        if fpath.endswith(".npz"):
+            node_map = ProductTable.mmap(fpath)
+        else:
+            node_map = ProductMap.read_node(fpath)
+        if not offset:
+            return node_map
+        if isinstance(node_map, ProductTable):
+            table = node_map.offset(offset)
+            table.fpath = (offset, fpath) # still matches self.fpaths[entry_key] until changed
+            return table
+        return {r: {(int(e[0])+offset, int(e[1])) if isinstance(e, tuple) else int(e)+offset: v for e, v in entry_map.items()} for r, entry_map in node_map.items()}
+
+
+    def _node(self, n):
+        assert self._loaded
+        if n in self._product_map:
+            return self._product_map[n]
+        if n in self._open:
+            self._open.move_to_end(n)
+            return self._open[n]
+        node_map = self._read(n)
+        if not isinstance(node_map, ProductTable):
+            # dicts may be changed in place, so they are kept until save()
+            self._product_map[n] = node_map
+            return node_map
+        self._open[n] = node_map
+        while len(self._open) > PRODUCT_LRU_SIZE:
+            k, table = self._open.popitem(last=False)
+            if table.fpath is None: # changed since it was read
+                self._product_map[k] = table
+        return node_map
 
     
     def save(self):
         logger = logging.getLogger('global_logger')
         logger.info(f"begin saving product map")
         assert self._loaded, "need to call load() first" 
-        for entry_key in self._product_map:
-            if entry_key in self.fpaths:
-                fpath = self.fpaths[entry_key]
-            else:
-                ext = "json" if PRODUCT_JSON else "pkl"
-                fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-                while os.path.exists(fpath):
-                    fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")                
-                self.fpaths[entry_key] = fpath
-            with FileLock(f"{fpath}.lock"):
-                with open(fpath, 'w+' if PRODUCT_JSON else 'wb+') as f:
-                    (ProductMap.json_dump if PRODUCT_JSON else pickle.dump)(self._product_map[entry_key], f)
+        store = product_store()
+        changed = dict(self._product_map)
+        changed.update({k: table for k, table in self._open.items() if table.fpath is None})
+        replaced = []
+        for entry_key, node_map in changed.items():
+            fpath = self.fpaths.get(entry_key)
+            if isinstance(node_map, ProductTable) and node_map.fpath is not None and node_map.fpath == fpath:
+                continue
+            if isinstance(fpath, tuple):
+                fpath = fpath[1]
+            ext = product_ext() if fpath is None else os.path.splitext(fpath)[1][1:]
+            self.fpaths[entry_key] = store.put(ProductMap.write_node, node_map, ext)
+            if fpath is not None:
+                replaced.append(fpath)
+        store.decref(replaced)
         logger.info(f"done saving product map")
-        self._product_map = None
-        self._loaded = False
+        self.unload()
 
 
     def unload(self):
         if self._loaded:
             self._product_map = None
+            self._open = OrderedDict()
             self._loaded = False        
 
 
     def copy(self):
         """
-        copy _product_map into new files
-        filenames are random uuid's to avoid collision
+        copy-on-write: the copy shares the base files, nodes changed by either link are saved into new files
+        unsaved work on _product_map is written for the copy only
         """
-        ext = "json" if PRODUCT_JSON else "pkl"
+        product_store().incref(self.files())
         if not self._loaded:
-            # since product map not loaded, we can copy without loading
-            new_fpaths = {}
-            for entry_key, fpath in self.fpaths.items():                
-                new_fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-                while os.path.exists(new_fpath):
-                    new_fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-                shutil.copyfile(fpath, new_fpath)
-                new_fpaths[entry_key] = new_fpath
-            new_pmap = ProductMapLink(new_fpaths)        
-        else:                        
-            new_fpaths = {}
-            for entry_key in self._product_map:
-                new_fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-                while os.path.exists(new_fpath):
-                    new_fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-                with open(new_fpath, 'w+' if PRODUCT_JSON else 'wb+') as f:
-                    (ProductMap.json_dump if PRODUCT_JSON else pickle.dump)(self._product_map[entry_key], f)
-                new_fpaths[entry_key] = new_fpath
-            new_pmap = ProductMapLink(new_fpaths)        
-            self.unload()
+            return ProductMapLink(dict(self.fpaths))
+        new_pmap = ProductMapLink(dict(self.fpaths))
+        new_pmap.load()
+        new_pmap._product_map = dict(self._product_map)
+        new_pmap._open = OrderedDict((k, table) for k, table in self._open.items() if table.fpath is None)
+        new_pmap.save()
+        self.unload()
         return new_pmap    
 
 
@@ -601,8 +1132,12 @@ class ProductMapLink:
         """
         assert not self._loaded
         assert not other._loaded
+        product_store().incref(other.files())
         for entry_key, fpath in other.fpaths.items():
-            self.fpaths[entry_key+offset] = (offset, fpath)
+            if isinstance(fpath, tuple):
+                self.fpaths[entry_key+offset] = (fpath[0]+offset, fpath[1])
+            else:
+                self.fpaths[entry_key+offset] = (offset, fpath)
 
 
 
@@ -612,7 +1147,9 @@ class ProductMapLink:
         assert len(key) == 3
         n, interm, e = key
         if n not in self._product_map:
-            self._product_map[n] = {}
+            self._product_map[n] = self._open.pop(n) if n in self._open else (self._read(n) if n in self.fpaths else {})
+        if isinstance(self._product_map[n], ProductTable):
+            self._product_map[n] = self._product_map[n].to_dict()
         if interm not in self._product_map[n]:
             self._product_map[n][interm] = {}        
         self._product_map[n][interm][e] = val
@@ -623,21 +1160,21 @@ class ProductMapLink:
         assert isinstance(key, tuple)   
         if len(key) == 3:
             n, interm, e = key
-            return self._product_map[n][interm][e]  
+            return self._node(n)[interm][e]  
         elif len(key) == 2:
             n, interm = key
-            return self._product_map[n][interm]
+            return self._node(n)[interm]
         elif len(key) == 1:
             n = key[0]
-            return self._product_map[n]  
+            return self._node(n)  
     
 
     def get_num_interms(self, key):
-        if key not in self._product_map:
+        if key not in self._product_map and key not in self.fpaths:
             print(self.fpaths, f"{key} has no interms!")
             print(self._product_map.keys())
             breakpoint()
-        return len(self._product_map[key])                 
+        return len(self._node(key))                 
 
 
 
@@ -654,11 +1191,7 @@ class Program:
             for each intermediate, store the entry nodes
             for each entry, store the indices in .available_reactants
             """        
-            ext = "json" if PRODUCT_JSON else "pkl"              
-            fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-            while os.path.exists(fpath):
-                fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-            self.product_map = ProductMap(fpath)
+            self.product_map = ProductMap()
             self.product_map.save()
             # assert 'depth' in self.rxn_tree.graph
 
@@ -712,7 +1245,35 @@ class Program:
             num_poss.append(Program.input_length(p))
         return np.mean(num_poss) if len(num_poss) else 0
 
-    
+
+    def product_signature(self, rxns):
+        """
+        Which reactant slots the root's products can fill, sig[r, j] iff some product matches rxns[r].reactant_patterns[j]
+        Expanding into a slot the products cannot fill is dropped by init_rxns' filter anyway
+        None if the root's products are not kept
+        """
+        root = len(self.rxn_tree)-1
+        if self.rxn_tree.nodes[root]['depth'] > self.keep_prods:
+            return None
+        sig = np.zeros((len(rxns), 2), dtype=bool)
+        slots = [(r, j) for r, rxn in enumerate(rxns) for j in range(rxn.num_reactant)]
+        loaded = self.product_map._loaded
+        self.product_map.load()
+        for interm in self.product_map[(root,)]:
+            mol = Chem.MolFromSmiles(interm) # each product is matched once, keep it out of the mol cache
+            if mol is None:
+                continue
+            for r, j in slots:
+                if mol.HasSubstructMatch(rxns[r].reactant_patterns[j]):
+                    sig[r, j] = True
+            slots = [(r, j) for r, j in slots if not sig[r, j]]
+            if not slots:
+                break
+        if not loaded:
+            self.product_map.unload()
+        return sig
+
+
     @staticmethod
     def hash_str(s):
         # s is bytes string
@@ -722,9 +1283,42 @@ class Program:
     @staticmethod
     def hash_json(json_data):
         return Program.hash_str(json.dumps(json_data, sort_keys=True).encode())    
+
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def code_version():
+        """
+        md5 of the source of the code producing a program's reactants and products, stamps cached results
+        """
+        return Program.hash_str("".join(inspect.getsource(cls) for cls in [Reaction, ProductTable, Program]).encode())
+
+
+    def input_fingerprint(self, rxns=None):
+        """
+        md5 of everything init_rxns(rxns)/run_rxn_tree depend on: the tree with the template and available reactants
+        of each reaction (rxns for nodes not yet in rxn_map), the product map files (content-addressed), keep_prods and code_version
+        Independent of the rxn_id numbering, so it is stable when templates are added or reordered
+        """
+        nodes = []
+        for n in sorted(self.rxn_tree.nodes()):
+            attrs = dict(self.rxn_tree.nodes[n])
+            rxn = self.rxn_map[n] if n in self.rxn_map else rxns[attrs['rxn_id']]
+            attrs['rxn_id'] = rxn.smirks
+            attrs['available_reactants'] = Program.hash_json(rxn.available_reactants)
+            nodes.append((n, attrs))
+        return Program.hash_json({
+            "nodes": nodes,
+            "edges": sorted(self.rxn_tree.edges()),
+            "in_rxn_map": sorted(self.rxn_map),
+            "entries": [list(e) if isinstance(e, tuple) else e for e in self.entries],
+            "product_map": self.product_map.files() if self.keep_prods else [],
+            "keep_prods": self.keep_prods,
+            "code": Program.code_version(),
+        })
     
 
-    def get_path(self):
+    def path_mask(self):
         mask = []
         for n in self.rxn_tree:
             if 'rxn_id_forcing' in self.rxn_tree.nodes[n]:
@@ -734,14 +1328,104 @@ class Program:
             else:
                 breakpoint()
             mask.append(b)
-        hash_val = self.hash(mask)
+        return mask
+
+
+    def get_path(self):
+        hash_val = self.hash(self.path_mask())
         return f"{hash_val}.json"
-    
+
+
+    def get_paths(self, node, rxn_ids):
+        """
+        get_path() with each of rxn_ids as the rxn_id of node, e.g. for all reactions of a frontier node
+        The md5 of the json before node's rxn_id is computed once, see tree_template
+        """
+        mask = self.path_mask()
+        if list(self.rxn_tree).index(node) != node:
+            # hash() reads path_mask() (in node order) by node id, only the same when nodes were added in id order
+            rxn_id = self.rxn_tree.nodes[node]['rxn_id']
+            paths = []
+            try:
+                for r in rxn_ids:
+                    self.rxn_tree.nodes[node]['rxn_id'] = r
+                    paths.append(self.get_path())
+            finally:
+                self.rxn_tree.nodes[node]['rxn_id'] = rxn_id
+            return paths
+        literals, nodes = Program.tree_template(Program.tree_shape(self.rxn_tree))
+        k = nodes.index(node)
+        fill = [self.rxn_tree.nodes[n]['rxn_id'] if mask[n] else None for n in nodes]
+        head = Program.fill_template(literals[:k+1], nodes[:k], fill[:k])
+        tail = Program.fill_template(literals[k+1:], nodes[k+1:], fill[k+1:])
+        forcing = self.rxn_tree.nodes[node].get('rxn_id_forcing')
+        head_md5 = hashlib.md5(head.encode())
+        paths = []
+        for rxn_id in rxn_ids:
+            on = forcing != -1 if forcing is not None else rxn_id != -1
+            md5 = head_md5.copy()
+            md5.update((Program.rxn_id_json(rxn_id if on else None) + tail).encode())
+            paths.append(f"{md5.hexdigest()}.json")
+        return paths
+
+
+    @staticmethod
+    def tree_shape(rxn_tree, attrs=('rxn_id', 'depth', 'child')):
+        """
+        Everything hash() depends on except the rxn_ids: per node its attrs, whether it has a rxn_id and its children
+        """
+        nodes = []
+        for n in rxn_tree:
+            data = rxn_tree.nodes[n]
+            items = tuple((k, data[k]) for k in attrs if k != 'rxn_id' and k in data)
+            nodes.append((n, items, 'rxn_id' in attrs and 'rxn_id' in data, tuple(rxn_tree.successors(n))))
+        return len(rxn_tree)-1, tuple(nodes)
+
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def tree_template(shape):
+        """
+        The json hashed by hash(), split at each node's rxn_id: (literals, nodes)
+        with the rxn_id of nodes[i] (or nothing, if masked) between literals[i] and literals[i+1]
+        """
+        root, nodes = shape
+        tree = nx.DiGraph()
+        for n, items, has_rxn_id, _ in nodes:
+            tree.add_node(n, **dict(items))
+            if has_rxn_id:
+                tree.nodes[n]['rxn_id'] = f"@@{n}@@"
+        for n, _, _, succs in nodes:
+            for succ in succs:
+                tree.add_edge(n, succ)
+        pieces = re.split(r', "rxn_id": "@@(\d+)@@"', json.dumps(nx.tree_data(tree, root), sort_keys=True))
+        return tuple(pieces[0::2]), tuple(int(n) for n in pieces[1::2])
+
+
+    @staticmethod
+    def rxn_id_json(rxn_id):
+        # "rxn_id" sorts after "id", which every node has, so it always follows a ", "
+        return '' if rxn_id is None else f', "rxn_id": {json.dumps(rxn_id)}'
+
+
+    @staticmethod
+    def fill_template(literals, nodes, rxn_ids):
+        parts = [literals[0]]
+        for rxn_id, literal in zip(rxn_ids, literals[1:]):
+            parts.append(Program.rxn_id_json(rxn_id))
+            parts.append(literal)
+        return ''.join(parts)
+
 
     def hash(self, mask, return_json=False, attrs=['rxn_id', 'depth', 'child']):
         # used to hash the partial state defined by mask
         # can also return the tree data defined by mask
         # if attrs, keep only the attrs
+        if not return_json:
+            # same md5 as of the json below, without copying the tree, see tree_template
+            literals, nodes = Program.tree_template(Program.tree_shape(self.rxn_tree, tuple(attrs)))
+            rxn_ids = [self.rxn_tree.nodes[n]['rxn_id'] if mask[n] else None for n in nodes]
+            return Program.hash_str(Program.fill_template(literals, nodes, rxn_ids).encode())
         rxn_tree_copy = deepcopy(self.rxn_tree)
         for n in self.rxn_tree:
             node_names = list(rxn_tree_copy.nodes[n])
@@ -754,12 +1438,7 @@ class Program:
                 data[n] = rxn_tree_copy.nodes[n]['rxn_id']
                 rxn_tree_copy.nodes[n].pop('rxn_id')
         json_data = nx.tree_data(rxn_tree_copy, len(rxn_tree_copy)-1)        
-        ans = self.hash_json(json_data)
-        for n, r in data.items():
-            rxn_tree_copy.nodes[n]['rxn_id'] = r
-        if return_json:
-            return json_data        
-        return str(ans)
+        return json_data        
 
     
     def hash_program(self):
@@ -828,32 +1507,49 @@ class Program:
     
 
     @staticmethod
-    def fill_reactant_indices(res, all_reactant_idxes):
-        for _, idxes in res:
-            assert len(all_reactant_idxes) == len(idxes)
-            for i in range(len(all_reactant_idxes)):
-                idx = idxes[i]
-                if len(idx) != len(all_reactant_idxes[i]):
-                    breakpoint()
-                assert len(idx) == len(all_reactant_idxes[i])
-                for j in range(len(idx)):
-                    all_reactant_idxes[i][j][idx[j]] += 1
+    def reindex_reactants(entries, all_reactant_indices, rxn_map, new_rxn_map):
+        """
+        A simple algorithm to re-index all_reactant_indices
+        all_reactant_indices[i] holds the counts of the reactants of entries[i] (only reactant idx for an entry (n, idx)),
+        each is replaced by the map old index -> new index of the used reactants, e.g. [0, 0, 3, 0, 1] -> [-1, -1, 0, -1, 1]
+        The used reactants of rxn_map[n] become the available reactants of new_rxn_map[n] (which can be rxn_map)
+        """
+        assert len(entries) == len(all_reactant_indices)
+        for i, e in enumerate(entries): # per entry
+            if isinstance(e, tuple):
+                assert len(all_reactant_indices[i]) == 1
+                e, idx = e
+                reactant_indices = [idx]
+            else:
+                reactant_indices = range(len(all_reactant_indices[i]))
+            available_reactants = list(new_rxn_map[e].available_reactants)
+            for idx, j in enumerate(reactant_indices): # per reactant
+                used = np.asarray(all_reactant_indices[i][idx]) > 0
+                all_reactant_indices[i][idx] = np.where(used, np.cumsum(used)-1, -1)
+                available_reactants[j] = list(itertools.compress(rxn_map[e].available_reactants[j], used))
+            new_rxn_map[e].available_reactants = tuple(available_reactants)
 
     @staticmethod
     def fill_product_reactant_indices(res, all_reactant_idxes, product_map=None):
-        for r, index in tqdm(res):
-            idxes = Program.infer_product_index(index, interm_counts, entries, rxn_map, return_idx=True)            
-            assert len(idxes) == len(all_reactant_idxes)
-            prod = {}
-            for i in range(len(all_reactant_idxes)):
-                idx = idxes[i]
-                assert len(idx) == len(all_reactant_idxes[i])
-                for j in range(len(idx)):
-                    all_reactant_idxes[i][j][idx[j]] += 1            
-                prod[entries[i]] = idxes[i]
-            if product_map is not None:           
+        if not len(res):
+            return
+        # decode all combination indices at once
+        entry_indices = Program.infer_product_indices([index for _, index in res], entries, rxn_map)
+        assert len(entry_indices) == len(all_reactant_idxes)
+        for i in range(len(all_reactant_idxes)):
+            assert len(entry_indices[i]) == len(all_reactant_idxes[i])
+            for j, idx in enumerate(entry_indices[i]):
+                counts = np.bincount(idx, minlength=len(all_reactant_idxes[i][j]))
+                if isinstance(all_reactant_idxes[i][j], np.ndarray):
+                    all_reactant_idxes[i][j] += counts
+                    continue
+                for k in np.flatnonzero(counts):
+                    all_reactant_idxes[i][j][k] += counts[k].item()
+        if product_map is not None:
+            entry_rows = [np.stack(idxes, axis=-1).tolist() for idxes in entry_indices]
+            for row, (r, _) in enumerate(res):
                 if r not in product_map:
-                    product_map[r] = prod
+                    product_map[r] = {e: entry_rows[i][row] for i, e in enumerate(entries)}
     
 
     def init_rxns(self, rxns):
@@ -903,134 +1599,38 @@ class Program:
                 filter_func = rxn.is_reactant_first 
             else:
                 filter_func = rxn.is_reactant_second
-            res = []    
             num_interms = self.product_map.get_num_interms(succ)        
-            bad_interms = []                
+            if not isinstance(self.product_map[(succ,)], ProductTable):
+                self.product_map._product_map[succ] = ProductTable.from_dict(self.product_map[(succ,)])
+            node_map = self.product_map[(succ,)]
+            if not num_interms:
+                breakpoint()
             """
             product_map stores the interms at n's successor
             """
             if count >= MP_MIN_COMBINATIONS:
                 with mp.Pool(100) as p:
-                    pass_filter = p.map(filter_func, tqdm(self.product_map[(succ,)], desc=f"filtering {num_interms} interms"))
+                    pass_filter = p.map(filter_func, tqdm(node_map, desc=f"filtering {num_interms} interms"))
             else:
-                pass_filter = [filter_func(interm) for interm in tqdm(self.product_map[(succ,)], desc=f"filtering {num_interms} interms")]               
-            last_interm = None
-            for interm_pass, interm in tqdm(zip(pass_filter, self.product_map[(succ,)]), desc=f"sorting good vs bad interms"):
-                if interm_pass:
-                    if list(self.product_map[(succ, interm)].keys()) != self.entries: # same order
-                        # make sure appear in same order
-                        appear_entries = [self.entries.index(p) for p in list(self.product_map[(succ, interm)].keys())]
-                        if sorted(appear_entries) != appear_entries:
-                            breakpoint()
-                            
-                    entry_reactants = []
-                    for e in self.product_map[(succ, interm)]:
-                        e_reactants = []
-                        for (i, ind) in enumerate(self.product_map[(succ, interm, e)]):
-                            # e_reactants.append(self.rxn_map[e].available_reactants[i][ind])
-                            e_reactants.append(ind)                            
-                        entry_reactants.append(e_reactants)
-                    res.append((interm, entry_reactants))
-                else:
-                    bad_interms.append(interm)            
-                last_interm = interm
-            if last_interm is None:
-                breakpoint()
-            entries = list(self.product_map[(succ, last_interm)].keys())                        
-            appear_entries = [self.entries.index(p) for p in list(self.product_map[(succ, interm)].keys())]
+                pass_filter = [filter_func(interm) for interm in tqdm(node_map, desc=f"filtering {num_interms} interms")]               
+            pass_filter = np.array(pass_filter, dtype=bool)
+            bad_interms = [interm for interm, interm_pass in zip(node_map, pass_filter) if not interm_pass]
+            entries = node_map.entries
+            # make sure appear in same order
+            appear_entries = [self.entries.index(p) for p in entries]
             if sorted(appear_entries) != appear_entries:
                 breakpoint()            
-                 
-            if count >= MP_MIN_COMBINATIONS and NUM_THREADS > 1:
-                threads = []
-                elems_per_thread = (len(res)+NUM_THREADS-1) // NUM_THREADS
-                all_reactant_indices = []
-                for e in entries:
-                    zero_count = []               
-                    if isinstance(e, tuple):
-                        zero_array = [0 for _ in range(len(self.rxn_map[e[0]].available_reactants[e[1]]))]
-                        arr = Array('i', zero_array)            
-                        zero_count.append(arr)
-                    else:
-                        for i in range(len(self.rxn_map[e].available_reactants)):
-                            zero_array = [0 for _ in range(len(self.rxn_map[e].available_reactants[i]))]            
-                            arr = Array('i', zero_array)            
-                            zero_count.append(arr)                        
-                    all_reactant_indices.append(zero_count)                
-                for i in range(NUM_THREADS):
-                    start = i*elems_per_thread
-                    end = (i+1)*elems_per_thread                
-                    thread = threading.Thread(target=self.fill_reactant_indices, args=(res[start:end], all_reactant_indices))
-                    threads.append(thread)
-                    thread.start()
-                for thread in threads:
-                    thread.join()
-            else:         
-                all_reactant_indices = []
-                for e in entries:
-                    zero_count = []
-                    if isinstance(e, tuple):
-                        zero_array = [0 for _ in range(len(self.rxn_map[e[0]].available_reactants[e[1]]))]
-                        if NUM_THREADS > 1:
-                            arr = Array('i', zero_array)
-                        else:
-                            arr = zero_array                
-                        zero_count.append(arr)
-                    else:
-                        for i in range(len(self.rxn_map[e].available_reactants)):
-                            zero_array = [0 for _ in range(len(self.rxn_map[e].available_reactants[i]))]
-                            if NUM_THREADS > 1:
-                                arr = Array('i', zero_array)
-                            else:
-                                arr = zero_array
-                            zero_count.append(arr)
-                    all_reactant_indices.append(zero_count)                                   
-                self.fill_reactant_indices(res, all_reactant_indices)
-            rxn_map_copy = deepcopy(self.rxn_map)
-            for n in entries:
-                idx = -1
-                if isinstance(n, tuple):
-                    n, idx = n                
-                cur = self.rxn_map[n].available_reactants
-                available_reactants = []
-                for i, reactants in enumerate(cur):
-                    if idx > -1 and i != idx:
-                        available_reactants.append(reactants)
-                    else:
-                        available_reactants.append([])                
-                self.rxn_map[n].available_reactants = tuple(available_reactants)                 
 
-            """
-            A simple algorithm to re-index all_reactant_indices            
-            """
-            assert len(entries) == len(all_reactant_indices)
-            for i, e in enumerate(entries): # per entry
-                if isinstance(e, tuple):
-                    assert len(all_reactant_indices[i]) == 1
-                    e, idx = e
-                    reactant_indices = [idx]
-                else:
-                    reactant_indices = range(len(all_reactant_indices[i]))                
-                for idx, j in enumerate(reactant_indices): # per reactant
-                    c = 0
-                    idxes = all_reactant_indices[i][idx]
-                    for k in range(len(idxes)): # per available reactant
-                        # [0, 0, 1, 0, 1, 0, 1] -> [-1, -1, 0, -1, 1, -1, 2]                            
-                        if idxes[k]:
-                            # add this reactant to self.rxn_map
-                            reactant = rxn_map_copy[e].available_reactants[j][k]
-                            self.rxn_map[e].available_reactants[j].append(reactant)
-                            idxes[k] = c                                
-                            c += 1
-                        else:
-                            idxes[k] = -1
+            # how often each reactant is used by the good interms
+            all_reactant_indices = node_map.reactant_counts(Program.entry_radices(entries, self.rxn_map), rows=pass_filter)
+            Program.reindex_reactants(entries, all_reactant_indices, self.rxn_map, self.rxn_map)
+
             """
             Fix product map
             """
             logging.info(f"begin re-indexing product map")
             # remove the bad interms
-            for interm in bad_interms:                            
-                self.product_map[tuple([succ])].pop(interm)                    
+            node_map.drop(bad_interms)
           
             self.reindex_product_map(succ, entries, all_reactant_indices)
             # re-index the entry_reactant indices of self.product_map
@@ -1095,6 +1695,38 @@ class Program:
         return entry_reactants
 
 
+    @staticmethod
+    def entry_radices(entries, rxn_map):
+        """
+        The mixed radix of a combination index as (entry position, reactant index, num. reactants),
+        most significant digit first: entries in order, and within an entry its reactants in order
+        """
+        radices = []
+        for j, e in enumerate(entries):
+            if isinstance(e, tuple):
+                r, idx = e
+                radices.append((j, idx, len(rxn_map[r].available_reactants[idx])))
+            else:
+                for k in range(len(rxn_map[e].available_reactants)):
+                    radices.append((j, k, len(rxn_map[e].available_reactants[k])))
+        return radices
+
+
+    @staticmethod
+    def infer_product_indices(indices, entries, rxn_map):
+        """
+        Vectorized infer_product_index(..., return_idx=True) over an array of combination indices,
+        i.e. np.unravel_index over the mixed radix of Program.entry_radices
+        Returns, for each entry, one index array per reactant of that entry
+        """
+        indices = np.array(indices, dtype=np.int64) # copy, divided in place below
+        entry_indices = [[None, None] for _ in entries]
+        for j, k, radix in reversed(Program.entry_radices(entries, rxn_map)):
+            indices, entry_indices[j][k] = np.divmod(indices, radix)
+        assert not indices.any()
+        return [[idx for idx in idxes if idx is not None] for idxes in entry_indices]
+
+
     @staticmethod
     def run_rxns(i):
         """
@@ -1102,6 +1734,40 @@ class Program:
         index refers to position in product(product(reactants))
         """        
         entry_reactants = Program.infer_product_index(i, interm_counts, entries, rxn_map)       
+        return Program.run_entry_reactants(entry_reactants)
+
+
+    @staticmethod
+    def run_rxns_chunk(bounds):
+        """
+        Same as run_rxns, over the combination indices range(*bounds)
+        Indices are decoded in one vectorized call, returns (product, index) for the successful ones
+        """
+        start, end = bounds
+        indices = np.arange(start, end, dtype=np.int64)
+        entry_indices = Program.infer_product_indices(indices, entries, rxn_map)
+        entry_slots = []
+        for e, idxes in zip(entries, entry_indices):
+            if isinstance(e, tuple):
+                r, idx = e
+                entry_slots.append([(rxn_map[r].available_reactants[idx], idxes[0].tolist())])
+            else:
+                entry_slots.append([(reactants, idx.tolist()) for reactants, idx in zip(rxn_map[e].available_reactants, idxes)])
+        res = []
+        for row, i in enumerate(indices.tolist()):
+            entry_reactants = [[reactants[idx[row]] for reactants, idx in slots] for slots in entry_slots]
+            r = Program.run_entry_reactants(entry_reactants)
+            if r is not None:
+                res.append((r, i))
+        return res
+
+
+    @staticmethod
+    def run_entry_reactants(entry_reactants):
+        """
+        Runs rxn_tree bottom-up given the reactants of each entry
+        Returns the product at the root, or None if some reaction is not applicable
+        """
         good = True
         product_map = {}
         for node in nx.dfs_postorder_nodes(rxn_tree, len(rxn_tree)-1):
@@ -1169,25 +1835,84 @@ class Program:
         We want to re-index self.product_map using all intermediates of node n
         We are given all_reactant_indices, which re-indexes the reactant indices in product_map
         """
-        for interm in tqdm(self.product_map[tuple([n])], "re-indexing product map interms"):
-            assert list(self.product_map[tuple([n])][interm]) == entries
-            for entry in self.product_map[tuple([n])][interm]:
-                e = entries.index(entry)
-                for i in range(len(self.product_map[tuple([n])][interm][entry])):                    
-                    idx = self.product_map[tuple([n])][interm][entry][i]                        
-                    new_idx = all_reactant_indices[e][i][idx]               
-                    assert new_idx != -1
-                    self.product_map[tuple([n])][interm][entry][i] = new_idx       
+        if not isinstance(self.product_map[tuple([n])], ProductTable):
+            self.product_map._product_map[n] = ProductTable.from_dict(self.product_map[tuple([n])])
+        self.product_map[tuple([n])].reindex(entries, all_reactant_indices)
     
 
-    def run_rxn_tree(self): 
-        # Assume entry inputs satisfy everything except the "root"        
-        # reactant_map = {}
-        # if self.rxn_tree.graph['super']:
-        #     breakpoint()
-        # for n in self.entries:
-        #     reactant_map[n] = product(*[reactants for reactants in self.rxn_map[n].available_reactants])
-        # all_entry_reactants = list(product(*[reactant_map[n] for n in self.entries]))
+    @staticmethod
+    def init_worker(tree, rmap, ents, counts):
+        """
+        Pool initializer, each worker receives the program once
+        """
+        globals()["rxn_tree"] = tree
+        globals()["rxn_map"] = rmap
+        globals()["entries"] = ents
+        globals()["interm_counts"] = counts
+
+
+    @staticmethod
+    def iter_chunks(count, chunk_size=None, start=0):
+        chunk_size = chunk_size or RXN_CHUNK_SIZE
+        for s in range(start, count, chunk_size):
+            yield (s, min(s+chunk_size, count))
+
+
+    def checkpoint_path(self, checkpoint_dir):
+        # a checkpoint is only valid for the same tree, available reactants, keep_prods and code
+        key = Program.hash_json({
+            'tree': nx.tree_data(self.rxn_tree, len(self.rxn_tree)-1),
+            'reactants': {str(n): self.rxn_map[n].available_reactants for n in self.rxn_map},
+            'keep_prods': self.keep_prods,
+            'code': Program.code_version()
+        })
+        return os.path.join(checkpoint_dir, key)
+
+
+    @staticmethod
+    def save_checkpoint(ckpt_path, state, new_products):
+        """
+        A checkpoint is a directory: state.pkl holds (next index, num. passed, reactant counts, num. parts),
+        part_{k}.pkl the root products found in wave k, so each wave only writes its own products
+        The part is written before the state that counts it, a crash in between leaves an unused part
+        """
+        os.makedirs(ckpt_path, exist_ok=True)
+        end, num_pass, all_reactant_indices, num_parts = state
+        if new_products is not None:
+            part_path = os.path.join(ckpt_path, f"part_{num_parts}.pkl")
+            with open(f"{part_path}.tmp", 'wb+') as f:
+                pickle.dump(new_products, f)
+            os.replace(f"{part_path}.tmp", part_path)
+            num_parts += 1
+        state_path = os.path.join(ckpt_path, "state.pkl")
+        with open(f"{state_path}.tmp", 'wb+') as f:
+            pickle.dump((end, num_pass, all_reactant_indices, num_parts), f)
+        os.replace(f"{state_path}.tmp", state_path)
+        return num_parts
+
+
+    @staticmethod
+    def load_checkpoint(ckpt_path, keep_prods):
+        """
+        Returns (next index, num. passed, reactant counts, num. parts, root product map merged from the parts)
+        """
+        start, num_pass, all_reactant_indices, num_parts = pickle.load(open(os.path.join(ckpt_path, "state.pkl"), 'rb'))
+        root_product_map = {} if keep_prods else None
+        for k in range(num_parts if keep_prods else 0):
+            for r, prod in pickle.load(open(os.path.join(ckpt_path, f"part_{k}.pkl"), 'rb')).items():
+                root_product_map.setdefault(r, prod) # parts hold new products only, first one wins as in fill_product_reactant_indices
+        return start, num_pass, all_reactant_indices, num_parts, root_product_map
+
+
+    def run_rxn_tree(self, checkpoint_dir=None): 
+        """
+        Runs all reactant combinations, streaming chunks of RXN_CHUNK_SIZE combination indices
+        through a pool initialized once with the program
+        Reactant counters and the root's product map are updated as chunks complete, so memory is
+        bounded by the products rather than the number of combinations
+        If checkpoint_dir is given, progress is saved every RXN_CHECKPOINT_CHUNKS chunks and resumed from there
+        Returns the number of combinations and how many of them passed
+        """
         logger = logging.getLogger('global_logger')  
         prods = []
         for n in self.entries:            
@@ -1198,46 +1923,21 @@ class Program:
                 poss_reactants = np.prod([len(reactants) for reactants in self.rxn_map[n].available_reactants])
             prods.append(poss_reactants)            
         
-        res = []
         if len(prods):
             interm_counts = prods
-            count = np.prod(prods)        
+            count = int(np.prod(prods))
         else:
             count = 0          
-            return 0, None
+            return 0, 0
         
         rxn_tree = self.rxn_tree
         rxn_map = self.rxn_map
         entries = self.entries
+        worker_args = (rxn_tree, rxn_map, entries, interm_counts)
+        Program.init_worker(*worker_args) # also used in this process
 
-        globals()["rxn_tree"] = rxn_tree
-        globals()["rxn_map"] = rxn_map
-        globals()["interm_counts"] = interm_counts
-        globals()["entries"] = entries
-        # globals()["all_entry_reactants"] = all_entry_reactants # debug
-        if count >= MP_MIN_COMBINATIONS:            
-            logger.info(f"running {count} entry_reactants")
-            with mp.Pool(MAX_PROCESSES) as p:
-                res = p.map(self.run_rxns, tqdm(range(count), desc="executing reactions"))           
-                assert len(res) == count
-        else:
-            res = [self.run_rxns(i) for i in range(count)]
-        
-        res = [(r, i) for (r, i) in zip(res, range(count)) if r is not None]
-        # Update the reactants to only valid inputs
-        rxn_map_copy = deepcopy(self.rxn_map)
-        for n in self.entries:                    
-            idx = -1
-            if isinstance(n, tuple):
-                n, idx = n        
-            cur = rxn_map_copy[n].available_reactants
-            available_reactants = []
-            for i, reactants in enumerate(cur):
-                if idx > -1 and i != idx:
-                    available_reactants.append(reactants)
-                else:
-                    available_reactants.append([])
-            rxn_map_copy[n].available_reactants = tuple(available_reactants)
+        # Update the reactants to only valid inputs, the workers keep using self.rxn_map
+        rxn_map_copy = {n: copy(rxn) for n, rxn in self.rxn_map.items()}
 
         """
         The following re-labels the available reactants of each entry
@@ -1251,135 +1951,66 @@ class Program:
                 for interm in self.product_map._product_map[e]:
                     if list(self.product_map._product_map[e][interm]) == [(1, 1), 0]:
                         breakpoint()              
-        logger.info(f"begin post-processing {len(res)} products")
-
-        
-        # rxn_map_debug = deepcopy(rxn_map_copy)
-        # product_map_debug = self.product_map.copy()
-        # product_map_debug.load()
-        # for r, index in tqdm(res, desc="post-processing products"):               
-        #     entry_reactants = Program.infer_product_index(index, interm_counts, entries, rxn_map)            
-        #     for entry_reactant, n in zip(entry_reactants, self.entries):
-        #         entry_point = []
-        #         for i, reactant in enumerate(entry_reactant):
-        #             if reactant not in avail_index[n][i]:                        
-        #                 avail_index[n][i][reactant] = len(rxn_map_debug[n].available_reactants[i])
-        #                 rxn_map_debug[n].available_reactants[i].append(reactant)
-        #             if keep_prods:
-        #                 entry_point.append(avail_index[n][i][reactant])
-        #         if keep_prods:
-        #             product_map_debug[(len(self.rxn_tree)-1, r, n)] = entry_point
-
-        """
-        Smarter way using multi-threading
-        """
-        threads = []
-        elems_per_thread = (len(res)+NUM_THREADS-1) // NUM_THREADS
 
         all_reactant_indices = []
         for e in self.entries:
-            zero_count = []
             if isinstance(e, tuple):
-                zero_array = [0 for _ in range(len(self.rxn_map[e[0]].available_reactants[e[1]]))]
-                if NUM_THREADS > 1:
-                    arr = Array('i', zero_array)
-                else:
-                    arr = zero_array                
-                zero_count.append(arr)
-            else:
-                for i in range(len(self.rxn_map[e].available_reactants)):
-                    zero_array = [0 for _ in range(len(self.rxn_map[e].available_reactants[i]))]
-                    if NUM_THREADS > 1:
-                        arr = Array('i', zero_array)
-                    else:
-                        arr = zero_array
-                    zero_count.append(arr)
-            all_reactant_indices.append(zero_count)   
-
-        if keep_prods:
-            product_map = self.product_map._product_map
-            if count >= MP_MIN_COMBINATIONS and NUM_THREADS > 1:
-                product_map[len(rxn_tree)-1] = Manager().dict()
+                all_reactant_indices.append([np.zeros(len(self.rxn_map[e[0]].available_reactants[e[1]]), dtype=np.int64)])
             else:
-                product_map[len(rxn_tree)-1] = {}
+                all_reactant_indices.append([np.zeros(len(reactants), dtype=np.int64) for reactants in self.rxn_map[e].available_reactants])
+        root_product_map = {} if keep_prods else None
+        start, num_pass, num_parts = 0, 0, 0
+        ckpt_path = self.checkpoint_path(checkpoint_dir) if checkpoint_dir else None
+        if ckpt_path and os.path.exists(os.path.join(ckpt_path, "state.pkl")):
+            start, num_pass, all_reactant_indices, num_parts, root_product_map = Program.load_checkpoint(ckpt_path, keep_prods)
+            logger.info(f"resuming {count} entry_reactants from {start} ({ckpt_path})")
+
+        logger.info(f"running {count} entry_reactants")
+        if count >= MP_MIN_COMBINATIONS:
+            pool = mp.Pool(MAX_PROCESSES, initializer=Program.init_worker, initargs=worker_args)
         else:
-            product_map = None
-
-        if count >= MP_MIN_COMBINATIONS and NUM_THREADS > 1:
-            for i in range(NUM_THREADS):
-                start = i*elems_per_thread
-                end = (i+1)*elems_per_thread                
-                thread = threading.Thread(target=self.fill_product_reactant_indices, 
-                                          args=(res[start:end], 
-                                          all_reactant_indices, 
-                                          product_map[len(rxn_tree)-1] if product_map is not None else None))
-                threads.append(thread)
-                thread.start()
-            for thread in threads:
-                thread.join()    
-        else:  
-            self.fill_product_reactant_indices(res, all_reactant_indices, product_map[len(rxn_tree)-1] if product_map is not None else None)
-
-        if keep_prods: # sanity check
-            for e in product_map:
-                for interm in product_map[e]:
-                    if list(product_map[e][interm]) == [(1, 1), 0]:
-                        breakpoint()
-
-        """
-        A simple algorithm to re-index all_reactant_indices            
-        """
-        for i in range(len(all_reactant_indices)): # per entry
-            entry = self.entries[i]
-            if isinstance(entry, tuple):
-                assert len(all_reactant_indices[i]) == 1
-                entry, idx = entry
-                reactant_indices = [idx]
-            else:
-                reactant_indices = range(len(all_reactant_indices[i]))
-            for idx, j in enumerate(reactant_indices): # per reactant
-                c = 0
-                idxes = all_reactant_indices[i][idx]
-                for k in range(len(idxes)): # per available reactant
-                    # [0, 0, 1, 0, 1, 0, 1] -> [-1, -1, 0, -1, 1, -1, 2]                                                
-                    if idxes[k]:
-                        # add this reactant to self.rxn_map
-                        reactant = self.rxn_map[entry].available_reactants[j][k]
-                        rxn_map_copy[entry].available_reactants[j].append(reactant)
-                        idxes[k] = c                                
-                        c += 1
-                    else:
-                        idxes[k] = -1 
-
+            pool = nullcontext()
+        chunks = Program.iter_chunks(count, start=start)
+        with pool, tqdm(total=count, initial=start, desc="executing reactions") as pbar:
+            while True:
+                wave = list(itertools.islice(chunks, RXN_CHECKPOINT_CHUNKS))
+                if not wave:
+                    break
+                num_prods = len(root_product_map) if keep_prods else 0
+                if isinstance(pool, nullcontext):
+                    chunk_results = map(Program.run_rxns_chunk, wave)
+                else:
+                    chunk_results = pool.imap(Program.run_rxns_chunk, wave)
+                for (s, e), chunk_res in zip(wave, chunk_results):
+                    Program.fill_product_reactant_indices(chunk_res, all_reactant_indices, root_product_map)
+                    num_pass += len(chunk_res)
+                    pbar.update(e-s)
+                if ckpt_path and wave[-1][1] < count:
+                    # products are only added to root_product_map, so the wave's are the last ones
+                    new_products = dict(itertools.islice(root_product_map.items(), num_prods, None)) if keep_prods else None
+                    num_parts = Program.save_checkpoint(ckpt_path, (wave[-1][1], num_pass, all_reactant_indices, num_parts), new_products)
+        logger.info(f"begin post-processing {num_pass} products")
+        Program.reindex_reactants(self.entries, all_reactant_indices, self.rxn_map, rxn_map_copy)
 
-        # for e1, e2 in zip(rxn_map_copy, rxn_map_debug):
-        #     assert e1 == e2
-        #     if rxn_map_copy[e1].available_reactants != rxn_map_debug[e2].available_reactants:
-        #         breakpoint()        
-   
         if keep_prods:
-            product_map[len(rxn_tree)-1] = dict(product_map[len(rxn_tree)-1])
-            self.product_map._product_map = product_map
+            self.product_map._product_map[len(rxn_tree)-1] = root_product_map
             logging.info(f"begin re-indexing product map")               
             self.reindex_product_map(len(rxn_tree)-1, self.entries, all_reactant_indices)
-            # if self.product_map._product_map != product_map_debug._product_map:
-            #     breakpoint()            
-            
-        # re-index the entry_reactant indices of self.product_map
-        logging.info(f"done re-indexing product map")         
-                                           
-
+            # re-index the entry_reactant indices of self.product_map
+            logging.info(f"done re-indexing product map")         
         
-        logger.info(f"done post-processing {len(res)} products")
+        logger.info(f"done post-processing {num_pass} products")
         if keep_prods:
             for e in self.product_map._product_map:
                 for interm in self.product_map._product_map[e]:
                     if list(self.product_map._product_map[e][interm]) == [(1, 1), 0]:
                         breakpoint()            
             self.product_map.save()
+        if ckpt_path and os.path.exists(ckpt_path):
+            shutil.rmtree(ckpt_path)
             
         self.rxn_map = rxn_map_copy
-        return count, res
+        return count, num_pass
                         
 
     def logging_info(self):
@@ -1388,20 +2019,19 @@ class Program:
 
     @staticmethod
     def migrate(p):
-        ext = "json" if PRODUCT_JSON else "pkl"
+        ext = product_ext()
         try:
             p.product_map.load()
         except:
             print(p.product_map.fpath)
             print(nx.tree_data(p.rxn_tree, len(p.rxn_tree)-1))
             return p
+        store = product_store()
         new_fpaths = {}
         for entry_key in p.product_map._product_map:
-            new_fpath = os.path.join(PRODUCT_DIR, f"{str(uuid.uuid4())}.{ext}")
-            new_fpaths[entry_key] = new_fpath                        
-            with open(new_fpath, 'w+' if PRODUCT_JSON else 'wb+') as f:
-                (ProductMap.json_dump if PRODUCT_JSON else pickle.dump)(p.product_map[(entry_key,)], f)
+            new_fpaths[entry_key] = store.put(ProductMap.write_node, p.product_map[(entry_key,)], ext)
         pmap_link = ProductMapLink(new_fpaths)
+        p.product_map.release()
         p.product_map = pmap_link
         return p
 
@@ -2010,8 +2640,83 @@ class Skeleton:
         bfs = []
         self.do_bfs(bfs)
         self.correct_bfs_mask = bfs
+        self.init_topology()
         self.reset()
 
+
+    def init_topology(self):
+        """
+        Parent, grandparent and (up to 2) children of each node as int arrays (-1 if none),
+        plus the per-criterion index arrays used by criteria()
+        """
+        n = len(self.tree)
+        self.parents = np.full(n, -1, dtype=np.int64)
+        self.children = np.full((n, 2), -1, dtype=np.int64)
+        for u, v in self.tree.edges:
+            self.parents[v] = u
+            self.children[u, (self.children[u] != -1).sum()] = v
+        self.grandparents = np.where(self.parents >= 0, self.parents[self.parents], -1)
+        self.grandparents[self.parents < 0] = -1
+        # rxns whose product is not the target, need their parent rxn filled
+        self._rxns_below = np.flatnonzero(self.rxns & (self.parents != self.tree_root) & (self.parents >= 0))
+        # interms and leaves, need their parent filled
+        interm_or_bb = ~self.rxns
+        interm_or_bb[self.tree_root] = False
+        self._interm_or_bb = np.flatnonzero(interm_or_bb)
+        self._bottom_2 = np.isin(np.arange(n), self.correct_bottom_2_mask)
+        # bfs_prefixes[k]: the first k nodes in bfs order
+        self._bfs_prefixes = np.zeros((len(self.correct_bfs_mask)+1, n), dtype=bool)
+        for k, node in enumerate(self.correct_bfs_mask):
+            self._bfs_prefixes[k+1:, node] = True
+
+
+    def criteria(self, masks):
+        """
+        Evaluates the criteria the mask setter computes for a whole batch of masks at once.
+        masks: (B, len(self.tree)) 0/1 array
+        Returns {criterion: (B,) bool array}
+        """
+        masks = np.atleast_2d(np.asarray(masks)).astype(bool)
+        res = {}
+        src = masks[:, self.non_root_tree_edges[0]]
+        dest = masks[:, self.non_root_tree_edges[1]]
+        res['leaves_up'] = ~(src & ~dest).any(axis=1)
+        res['all_leaves'] = masks[:, self.leaves].all(axis=1)
+        src, dest = self.bidir_edges
+        res['rxn_frontier'] = (masks[:, src] & ~masks[:, dest] & self.rxns[dest]).any(axis=1)
+        res['bb_frontier'] = masks.sum(axis=1) < len(self.tree) # bad only when no frontier
+        src = masks[:, self.tree_edges[0]]
+        dest = masks[:, self.tree_edges[1]]
+        res['target_down'] = (src >= dest).all(axis=1)
+
+        # check that if true, all parent of parent is true
+        non_target_interms = masks & ~self.rxns
+        non_target_interms[:, self.tree_root] = False
+        rxn_target_down = ~non_target_interms.any(axis=1) # all non-rxn nodes masked out, and rxns target_down
+        non_target_interms[:, self.leaves] = False
+        rxn_target_down_bb = ~non_target_interms.any(axis=1) # all interm nodes masked out, and rxns target_down
+        rxn_target_down_interm = rxn_target_down_bb.copy() # all interms masked out
+        parent_rxns = self.grandparents[self._rxns_below]
+        bad_rxns = (masks[:, self._rxns_below] & ~(masks[:, parent_rxns] & self.rxns[parent_rxns])).any(axis=1)
+        rxn_target_down &= ~bad_rxns
+        rxn_target_down_bb &= ~bad_rxns
+        rxn_target_down_interm &= ~bad_rxns
+        # for all interm/leaves, parent must be filled
+        orphans = masks[:, self._interm_or_bb] & ~masks[:, self.parents[self._interm_or_bb]]
+        rxn_target_down_bb &= ~orphans[:, self.leaves[self._interm_or_bb]].any(axis=1)
+        rxn_target_down_interm &= ~orphans.any(axis=1)
+        res['rxn_target_down'] = rxn_target_down
+        res['rxn_target_down_bb'] = rxn_target_down_bb
+        res['rxn_target_down_interm'] = rxn_target_down_interm
+
+        # test if mask satisfies precomputed criteria
+        res['leaf_up_2'] = (masks == self._bottom_2).all(axis=1)
+        num_masked = masks.sum(axis=1)
+        in_bfs = num_masked < len(self._bfs_prefixes)
+        prefixes = self._bfs_prefixes[np.minimum(num_masked, len(self._bfs_prefixes)-1)]
+        res['bfs'] = in_bfs & (masks == prefixes).all(axis=1)
+        return res
+
     
     def subtree(self, n):     
         def dfs(tree, cur):
@@ -2256,7 +2961,65 @@ class Skeleton:
         if mask is not None:
             self.mask = mask
 
-    
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['_X', '_X_keys', '_fps']: # features() cache, recomputed on demand (also by deepcopy)
+            state.pop(k, None)
+        return state
+
+
+    def features(self, fps=None):
+        """
+        Read-only (len(self.tree), 2*2048+91) float32 view of get_state's X: node fp | target fp | rxn one-hot
+        at masked nodes, zeros elsewhere.
+        The matrix is cached and a row only recomputed when its node's mask or attributes changed,
+        fingerprints are cached by smiles in fps (by default, per skeleton).
+        """
+        if getattr(self, '_X', None) is None or len(self._X) != len(self.tree):
+            self._X = np.zeros((len(self.tree), 2*2048+91), dtype=np.float32)
+            self._X_keys = [None for _ in self.tree]
+            self._fps = {}
+        if fps is None:
+            fps = self._fps
+        def fp(smi):
+            if isinstance(smi, np.ndarray): # given fingerprint
+                return smi
+            if smi not in fps:
+                fps[smi] = np.array(fp_2048(smi), dtype=np.float32)
+            return fps[smi]
+        target = self.tree.nodes[self.tree_root].get('smiles')
+        target_key = target if isinstance(target, str) else id(target)
+        for n in self.tree.nodes():
+            node = self.tree.nodes[n]
+            if not self.mask[n]:
+                key = None
+            elif 'smiles' in node:
+                smi = node['smiles']
+                key = ('smiles', smi if isinstance(smi, str) else id(smi), target_key)
+            elif 'rxn_id' in node:
+                key = ('rxn_id', node['rxn_id'], target_key)
+            else:
+                key = 'bad node'
+            if key == self._X_keys[n]:
+                continue
+            self._X[n] = 0
+            if key is None:
+                pass
+            elif key[0] == 'smiles':
+                self._X[n, :2048] = fp(node['smiles'])
+                self._X[n, 2048:2*2048] = fp(target)
+            elif key[0] == 'rxn_id':
+                assert len(list(self.tree.predecessors(n))) == 1
+                self._X[n, 2048:2*2048] = fp(target)
+                self._X[n, 2*2048:] = self.one_hot(91, node['rxn_id'])
+            else:
+                print("bad node")
+            self._X_keys[n] = key
+        X = self._X.view()
+        X.flags.writeable = False
+        return X
+
         
     def modify_tree(self, i, smiles=None, rxn_id=-1, suffix=''):
         """
@@ -2311,11 +3074,11 @@ class Skeleton:
                     succ = succ[::-1]
                 poss_reactants = [self.tree.nodes[j]['smiles'].split(DELIM) for j in succ]
                 poss_res = []
+                rxn = rxns[self.tree.nodes[i]['rxn_id']] # reuses its cached rdkit objects
                 for reactants in product(*poss_reactants):
                     # reactants = tuple(self.tree.nodes[j]['smiles'] for j in succ)
-                    if len(reactants) != rxns[self.tree.nodes[i]['rxn_id']].num_reactant:
+                    if len(reactants) != rxn.num_reactant:
                         return False
-                    rxn = Reaction(rxns[self.tree.nodes[i]['rxn_id']].smirks)
                     interms = rxn.run_reaction(reactants, keep_main=keep_main)
                     if interms is not None:
                         if not isinstance(interms, list):
@@ -2361,45 +3124,10 @@ class Skeleton:
     @mask.setter
     def mask(self, mask):
         self._mask[mask] = 1        
-        src = self.mask[self.non_root_tree_edges[0]]
-        dest = self.mask[self.non_root_tree_edges[1]]
-        self.leaves_up = not (src > dest).any()
-        self.all_leaves = self.mask[self.leaves].all()
-        non_mask_rxns = ~(self.mask == 1) & self.rxns
         src_in_mask = self.mask[self.bidir_edges.T[:, 0]]
         self.frontier_nodes = self.bidir_edges.T[src_in_mask == 1][:, 1]        
-        self.rxn_frontier = non_mask_rxns[self.frontier_nodes].any()
-        self.bb_frontier = self.mask.sum() < len(self.mask) # bad only when no frontier
-        src = self.mask[self.tree_edges[0]]
-        dest = self.mask[self.tree_edges[1]]
-        self.target_down = (src >= dest).all()     
-
-        # check that if true, all parent of parent is true
-        non_target_interms = (self.mask & ~self.rxns)
-        non_target_interms[self.tree_root] = 0
-        self.rxn_target_down = not non_target_interms.any() # all non-rxn nodes masked out, and rxns target_down
-        non_target_interms[self.leaves] = 0
-        self.rxn_target_down_bb = not non_target_interms.any() # all interm nodes masked out, and rxns target_down
-        self.rxn_target_down_interm = not non_target_interms.any() # all interms masked out
-        for n in np.argwhere((self.mask & self.rxns)).flatten().tolist(): # check rxns
-            if self.pred(n) == self.tree_root: continue
-            parent_rxn = self.pred(self.pred(n))
-            if not (self.mask & self.rxns)[parent_rxn]:
-                self.rxn_target_down = False
-                self.rxn_target_down_bb = False
-                self.rxn_target_down_interm = False
-        interm_or_bb = ~self.rxns
-        interm_or_bb[self.tree_root] = 0
-        for n in np.argwhere((self.mask & interm_or_bb)).flatten().tolist(): # for all interm/leaves, parent must be filled
-            if not self.mask[self.pred(n)]:
-                if self.leaves[n]:
-                    self.rxn_target_down_bb = False
-                self.rxn_target_down_interm = False
-        
-        # test if mask satisfies precomputed criteria
-        mask_inds = np.argwhere(self.mask).flatten().tolist()
-        self.leaf_up_2 = mask_inds == self.correct_bottom_2_mask
-        self.bfs = sorted(mask_inds) == sorted(self.correct_bfs_mask[:len(mask_inds)])
+        for criterion, value in self.criteria(self.mask[None]).items():
+            setattr(self, criterion, bool(value[0]))
         
     
     @staticmethod
@@ -2434,7 +3162,8 @@ class Skeleton:
                         rxn_target_down=False, 
                         rxn_target_down_bb=False, 
                         rxn_target_down_interm=False,
-                        bfs=False):
+                        bfs=False,
+                        copy=True):
         """
         Return the partial graph with self.mask determining which nodes are available
         If leaves_up is true, further zero out y at nodes where there is an un-filled child
@@ -2450,8 +3179,11 @@ class Skeleton:
         rxn_target_down_bb: same as leaves_up but from target down, and for reactions and leaves only
         rxn_target_down_interm: same as leaves_up but from target down, and for reactions and interms/leaves
         bfs: predict the next node in binary tree bfs order
+        copy: if False, X is the read-only cached matrix of self.features(), valid until the next call
         """        
-        X = np.zeros((len(self.tree), 2*2048+91))
+        X = self.features()
+        if copy:
+            X = X.copy()
         y = np.zeros((len(self.tree), 256+91))
         for n in self.tree.nodes():             
             # is target, or parent is target, or parent rxn is fulfilled
@@ -2468,24 +3200,7 @@ class Skeleton:
                 assert self.mask[self.bidir_edges.T[self.bidir_edges[1] == n][:, 0]].any()
                 assert 'rxn_id' in self.tree.nodes[n]                                
             if self.mask[n]:
-                # if leaves_filled and list(self.tree.neighbors(n)):
-                #     if 'smiles' in self.tree.nodes[n]: # impossible
-                #         if n != self.tree_root:
-                #             breakpoint()
-                #     else:
-                #         if not self.leaves[list(self.tree.neighbors(n))].all(): # rxn on intermediate
-                #             breakpoint()
-                if 'smiles' in self.tree.nodes[n]:
-                    X[n][:2048] = fp_2048(self.tree.nodes[n]['smiles'])
-                    X[n][2048:2*2048] = fp_2048(self.tree.nodes[self.tree_root]['smiles'])
-                    # print(self.tree.nodes[n])
-                elif 'rxn_id' in self.tree.nodes[n]:
-                    assert len(list(self.tree.predecessors(n))) == 1
-                    # X[n][:2048] = fp_2048(self.tree.nodes[self.pred(n)]['smiles'])
-                    X[n][2048:2*2048] = fp_2048(self.tree.nodes[self.tree_root]['smiles'])
-                    X[n][2*2048:] = self.one_hot(91,self.tree.nodes[n]['rxn_id'])
-                else:
-                    print("bad node")
+                pass # X is filled in by self.features()
             else:
                 if rxn_frontier:
                     if is_frontier_rxn:
@@ -2847,6 +3562,20 @@ def inds_to_i(inds, length, min_r_set):
     return int(''.join(map(str, filter(lambda x: x !=- 1, zeros))), 2)
 
 
+def inds_to_masks(inds, length, min_r_set):
+    """
+    inverse of inds_to_i for a batch: (len(inds), length) 0/1 masks, min_r_set filled and
+    the bits of each i (least significant last) over the indices outside min_r_set
+    """
+    inds = np.asarray(inds, dtype=np.int64)
+    masks = np.zeros((len(inds), length), dtype=np.int8)
+    masks[:, min_r_set] = 1
+    zero_mask_inds = np.setdiff1d(np.arange(length), min_r_set)
+    shifts = np.arange(len(zero_mask_inds))[::-1]
+    masks[:, zero_mask_inds] = (inds[:, None] >> shifts) & 1
+    return masks
+
+
 def get_wl_kernel(tree: nx.digraph, fill_in=[]):
     for n in tree.nodes():
         tree.nodes[n]['id'] = 0
@@ -2856,27 +3585,64 @@ def get_wl_kernel(tree: nx.digraph, fill_in=[]):
 
 
 
-def process_syntree_mask(i, sk, args, min_r_set, anchors=None):
+def criteria_kwargs(determine_criteria):
+    """get_state kwargs giving the targets of determine_criteria"""
     kwargs = {}
-    if args.determine_criteria in ['leaves_up', 'all_leaves']:
+    if determine_criteria in ['leaves_up', 'all_leaves']:
         kwargs['leaves_up'] = True
-    elif args.determine_criteria == 'rxn_frontier':        
+    elif determine_criteria == 'rxn_frontier':        
         kwargs['rxn_frontier'] = True        
-    elif args.determine_criteria == 'bb_frontier':        
+    elif determine_criteria == 'bb_frontier':        
         kwargs['rxn_frontier'] = True
         kwargs['bb_frontier'] = True        
-    elif args.determine_criteria == 'target_down':
+    elif determine_criteria == 'target_down':
         kwargs['target_down'] = True
-    elif args.determine_criteria == 'rxn_target_down':
+    elif determine_criteria == 'rxn_target_down':
         kwargs['rxn_target_down'] = True
-    elif args.determine_criteria == 'rxn_target_down_bb':
+    elif determine_criteria == 'rxn_target_down_bb':
         kwargs['rxn_target_down'] = True
         kwargs['rxn_target_down_bb'] = True
-    elif args.determine_criteria == 'rxn_target_down_interm':
+    elif determine_criteria == 'rxn_target_down_interm':
         kwargs['rxn_target_down'] = True
         kwargs['rxn_target_down_interm'] = True
-    elif args.determine_criteria == 'bfs':
+    elif determine_criteria == 'bfs':
         kwargs['bfs'] = True    
+    return kwargs
+
+
+def valid_mask_inds(sk, min_r_set, determine_criteria, chunk_size=2**16):
+    """
+    The i's (see inds_to_i) of the masks of sk satisfying determine_criteria, sorted.
+    Only depends on the topology, so it is the same for every syntree of a skeleton class.
+    """
+    # for some, we can compute the valid i easily
+    if determine_criteria == 'leaf_up_2':
+        inds = [inds_to_i(sk.bottom_2_rxns + [sk.tree_root], len(sk.tree), min_r_set)]
+    elif determine_criteria == 'bfs':           
+        inds = [inds_to_i(sk.correct_bfs_mask[:l], len(sk.tree), min_r_set) for l in range(1, len(sk.correct_bfs_mask))]
+    else:
+        inds = range(2**(len(sk.tree)-len(min_r_set))-1)
+    # evaluate the criteria on chunks of masks at once instead of setting them one by one
+    valid = [np.zeros(0, dtype=np.int64)]
+    for start in range(0, len(inds), chunk_size):
+        chunk = np.array(inds[start:start+chunk_size], dtype=np.int64)
+        valid.append(chunk[sk.criteria(inds_to_masks(chunk, len(sk.tree), min_r_set))[determine_criteria]])
+    return np.concatenate(valid)
+
+
+def mask_state(i, sk, min_r_set, determine_criteria):
+    """(node_mask, X, y) of sk under mask i (see inds_to_i), with the targets of determine_criteria"""
+    sk.reset(min_r_set)
+    zero_mask_inds = np.where(sk.mask == 0)[0]    
+    bool_mask = get_bool_mask(i)
+    sk.mask = zero_mask_inds[-len(bool_mask):][bool_mask]   
+    node_mask, X, y = sk.get_state(**criteria_kwargs(determine_criteria))        
+    if determine_criteria == 'all_leaves':
+        assert sk.all_leaves
+    return node_mask, X, y
+
+
+def process_syntree_mask(i, sk, args, min_r_set, anchors=None):
     if anchors is not None:
         poss_vals = []
         val = get_wl_kernel(sk.tree, min_r_set[:2+len(anchors)])
@@ -2890,13 +3656,7 @@ def process_syntree_mask(i, sk, args, min_r_set, anchors=None):
         # featurize prediction problem of next anchor, which can be any of poss_vals
         node_mask, X, y = sk.get_partial_state(poss_vals, min_r_set[len(anchors)+1])        
     else:
-        sk.reset(min_r_set)
-        zero_mask_inds = np.where(sk.mask == 0)[0]    
-        bool_mask = get_bool_mask(i)
-        sk.mask = zero_mask_inds[-len(bool_mask):][bool_mask]   
-        node_mask, X, y = sk.get_state(**kwargs)        
-        if args.determine_criteria == 'all_leaves':
-            assert sk.all_leaves
+        node_mask, X, y = mask_state(i, sk, min_r_set, args.determine_criteria)
 
     # visualize to help debug
     
@@ -0,0 +1,121 @@
+"""Cosine nearest-neighbour search over building-block embeddings (see `fill_in` in `synnet.utils.reconstruct_utils`)."""
+import weakref
+
+import torch
+import torch.nn.functional as F
+
+from synnet.config import EMB_SEARCH_CHUNK
+
+
+class EmbeddingIndex:
+    """Row-normalized float32 embeddings, searched by cosine similarity with one matmul and `torch.topk`.
+
+    quantize:
+        None: float32 rows
+        'int8': rows as int8 codes with a per-dimension scale
+        'binary': rows as their signs (+-1 int8), queries are ranked by sign agreement
+    Quantized rows are dequantized EMB_SEARCH_CHUNK at a time, by scaling the queries instead of the rows.
+    Named subsets (e.g. the building blocks of a reaction slot, see add_rxn_subsets) are gathered once and kept.
+    Queries are moved to the device of the index, which is only moved by `to` / `open(..., device=)`
+    (setup code, not concurrently with searches).
+    """
+
+    _open = {}  # id(emb) -> index, dropped when emb is garbage collected
+
+    def __init__(self, emb, quantize=None):
+        if quantize not in (None, "int8", "binary"):
+            raise ValueError(f"unknown quantization {quantize}")
+        self.quantize = quantize
+        emb = F.normalize(torch.as_tensor(emb, dtype=torch.float32), dim=-1)
+        self.scale = None
+        if quantize == "int8":
+            self.scale = emb.abs().amax(dim=0).clamp(min=1e-12) / 127
+            self.emb = torch.round(emb / self.scale).to(torch.int8)
+        elif quantize == "binary":
+            self.emb = (emb >= 0).to(torch.int8) * 2 - 1
+        else:
+            self.emb = emb
+        self.subsets = {}  # key -> indices
+        self._subset_emb = {}
+
+    @staticmethod
+    def open(emb, quantize=None, device=None) -> "EmbeddingIndex":
+        """
+        One index per embedding tensor/array while it is alive, the decoders are handed the raw tensor.
+        quantize only applies on creation, device moves the index there if it isn't already.
+        """
+        if isinstance(emb, EmbeddingIndex):
+            index = emb
+        elif id(emb) in EmbeddingIndex._open:
+            index = EmbeddingIndex._open[id(emb)]
+        else:
+            index = EmbeddingIndex(emb, quantize=quantize)
+            EmbeddingIndex._open[id(emb)] = index
+            weakref.finalize(emb, EmbeddingIndex._open.pop, id(emb), None)
+        if device is not None and index.device != torch.device(device):
+            index.to(device)
+        return index
+
+    def __len__(self):
+        return len(self.emb)
+
+    @property
+    def device(self):
+        return self.emb.device
+
+    def to(self, device) -> "EmbeddingIndex":
+        """Moves the index (and its gathered subsets) in place."""
+        self.emb = self.emb.to(device)
+        if self.scale is not None:
+            self.scale = self.scale.to(device)
+        self.subsets = {key: inds.to(device) for key, inds in self.subsets.items()}
+        self._subset_emb = {key: emb.to(device) for key, emb in self._subset_emb.items()}
+        return self
+
+    def add_subset(self, key, inds):
+        self.subsets[key] = torch.as_tensor(inds, dtype=torch.int64, device=self.device)
+        self._subset_emb.pop(key, None)
+
+    def add_rxn_subsets(self, rxns):
+        """Subset (rxn_id, slot) for the building blocks of each reactant slot, from the reactions' bblock_mask."""
+        for i, r in enumerate(rxns):
+            for slot, inds in enumerate(getattr(r, "bblock_mask", [])):
+                self.add_subset((i, slot), inds)
+
+    def _rows(self, subset):
+        """(indices or None, rows) searched for subset: None, a key of self.subsets, or indices"""
+        if subset is None:
+            return None, self.emb
+        if not torch.is_tensor(subset) and isinstance(subset, (tuple, str)) and subset in self.subsets:
+            if subset not in self._subset_emb:
+                self._subset_emb[subset] = self.emb[self.subsets[subset]]
+            return self.subsets[subset], self._subset_emb[subset]
+        inds = torch.as_tensor(subset, dtype=torch.int64, device=self.device)
+        return inds, self.emb[inds]
+
+    def scores(self, queries, rows) -> torch.Tensor:
+        """(B, len(rows)) similarities of the normalized queries to rows"""
+        if self.quantize is None:
+            return queries @ rows.T
+        if self.quantize == "int8":
+            queries = queries * self.scale
+        else:
+            queries = (queries >= 0).float() * 2 - 1
+        return torch.cat(
+            [queries @ rows[i : i + EMB_SEARCH_CHUNK].float().T for i in range(0, len(rows), EMB_SEARCH_CHUNK)]
+            or [queries.new_zeros((len(queries), 0))],
+            dim=-1,
+        )
+
+    @torch.no_grad()
+    def search(self, queries, k=1, subset=None):
+        """
+        Top-k neighbours of each query, best first, as (scores, indices), both (B, min(k, len(subset))).
+        Indices are rows of the full embedding matrix, also when searching a subset, on the index's device.
+        A single (d,) query gives (1, k) results.
+        """
+        queries = torch.as_tensor(queries, dtype=torch.float32).to(self.device)
+        queries = F.normalize(queries.reshape(-1, queries.shape[-1]), dim=-1)
+        inds, rows = self._rows(subset)
+        scores, top = torch.topk(self.scores(queries, rows), min(k, len(rows)), dim=-1)
+        return scores, (inds[top] if inds is not None else top)
@@ -0,0 +1,204 @@
+"""Sharded, mmapped GNN training features (see `scripts/process-for-gnn.py` and `synnet.models.gnn.PtrDataset`)."""
+import glob
+import os
+import re
+
+import numpy as np
+
+from synnet.config import GNN_SHARD_SIZE, NUM_POSS
+from synnet.utils.data_utils import ProductMap, mmap_npz
+
+
+class GNNShards:
+    """The samples of one featurized batch `{base}` as fixed-size shards `{base}_shard{j}.npz`.
+
+    Each shard is an uncompressed .npz of up to `shard_size` samples, opened as an mmap:
+        node_masks: (S, ceil(n/8)) bit-packed node masks
+        X: (S, n, ceil(x_dim/8)) bit-packed node features, y: (S, n, ceil(y_dim/8)) bit-packed targets
+        smiles_bytes, smiles_offsets: utf-8 target smiles of the samples, sample i is bytes[offsets[i]:offsets[i+1]]
+        dims: [n, x_dim, y_dim, shard_size]
+    Every feature written by Skeleton.get_state is 0/1 (fingerprint bits and one-hots), so packing is lossless,
+    and reading a sample only touches its own rows instead of decompressing the whole batch.
+
+    Written with `fp_ids=True`, X is instead stored by reference: the batch's distinct packed fingerprints
+    go once into `{base}_fps.npz` (key "fps"), and each shard has
+        fp_ids: (S, n) row of each node's fingerprint, target_ids: (S,) row of the target's fingerprint
+        rxn_ids: (S, n) reaction of each node, -1 for none
+    so the mask variants of a syntree no longer repeat its fingerprints.
+    """
+
+    def __init__(self, base: str):
+        self.base = base
+        self.fpaths = GNNShards.shard_files(base)
+        self._shards = {}
+
+    def __getstate__(self):
+        # mmaps are reopened in each DataLoader worker
+        return {"base": self.base, "fpaths": self.fpaths, "_shards": {}}
+
+    @staticmethod
+    def shard_files(base: str) -> list[str]:
+        fpaths = glob.glob(glob.escape(base) + "_shard*.npz")
+        shard_id = lambda fpath: int(re.search(r"_shard(\d+)\.npz$", fpath).group(1))
+        return sorted(fpaths, key=shard_id)
+
+    @staticmethod
+    def exists(base: str) -> bool:
+        return os.path.exists(f"{base}_shard0.npz")
+
+    @property
+    def has_fp_ids(self) -> bool:
+        return "fp_ids" in self.shard(0)
+
+    def fp_table(self) -> np.ndarray:
+        """(F, ceil(nbits/8)) packed fingerprints referenced by `ids`."""
+        return np.asarray(mmap_npz(f"{self.base}_fps.npz")["fps"])
+
+    def shard(self, j: int) -> dict:
+        if j not in self._shards:
+            self._shards[j] = mmap_npz(self.fpaths[j])
+        return self._shards[j]
+
+    @property
+    def dims(self):
+        return tuple(int(d) for d in self.shard(0)["dims"])
+
+    def __len__(self):
+        return sum(len(self.shard(j)["node_masks"]) for j in range(len(self.fpaths)))
+
+    def node_masks(self) -> np.ndarray:
+        """All (len(self), n) node masks, e.g. to split the samples by tree."""
+        n = self.dims[0]
+        return np.concatenate(
+            [np.unpackbits(self.shard(j)["node_masks"], axis=-1, count=n) for j in range(len(self.fpaths))]
+        )
+
+    def ids(self, i: int):
+        """(fp_ids, target_id, rxn_ids) of sample i, for shards written with `fp_ids=True`."""
+        shard_size = self.dims[3]
+        shard = self.shard(i // shard_size)
+        row = i % shard_size
+        return shard["fp_ids"][row].astype(np.int64), int(shard["target_ids"][row]), shard["rxn_ids"][row].astype(np.int64)
+
+    @staticmethod
+    def ids_to_X(fps, fp_ids, target_ids, rxn_ids, node_masks, nbits: int) -> np.ndarray:
+        """Dense (..., n, x_dim) features of fingerprint-id samples, laid out like Skeleton.get_state."""
+        node_fps = np.unpackbits(fps[fp_ids], axis=-1, count=nbits)
+        target_fps = np.unpackbits(fps[target_ids], axis=-1, count=nbits)[..., None, :] * node_masks[..., None]
+        rxns = (rxn_ids[..., None] == np.arange(NUM_POSS)).astype(np.uint8)
+        return np.concatenate((node_fps, target_fps, rxns), axis=-1)
+
+    def __getitem__(self, i: int):
+        """(node_mask, X, y, smiles) of sample i, as float32 arrays."""
+        n, x_dim, y_dim, shard_size = self.dims
+        shard = self.shard(i // shard_size)
+        row = i % shard_size
+        node_mask = np.unpackbits(shard["node_masks"][row], count=n)
+        if "fp_ids" in shard:
+            if not hasattr(self, "_fps"):
+                self._fps = self.fp_table()
+            fp_ids, target_id, rxn_ids = self.ids(i)
+            nbits = (x_dim - NUM_POSS) // 2
+            X = GNNShards.ids_to_X(self._fps, fp_ids, target_id, rxn_ids, node_mask, nbits).astype(np.float32)
+        else:
+            X = np.unpackbits(shard["X"][row], axis=-1, count=x_dim).astype(np.float32)
+        y = np.unpackbits(shard["y"][row], axis=-1, count=y_dim).astype(np.float32)
+        offsets = shard["smiles_offsets"]
+        smiles = bytes(shard["smiles_bytes"][offsets[row] : offsets[row + 1]]).decode()
+        return node_mask, X, y, smiles
+
+    def load(self):
+        """(node_masks, X, y, smiles) of every sample, like the sparse files of a batch."""
+        samples = [self[i] for i in range(len(self))]
+        return tuple(np.stack([sample[k] for sample in samples]) for k in range(3)) + (
+            np.array([sample[3] for sample in samples]),
+        )
+
+    @staticmethod
+    def packbits(arr: np.ndarray, name: str) -> np.ndarray:
+        if not np.isin(arr, (0, 1)).all():
+            raise ValueError(f"{name} is not binary, it can't be stored bit-packed")
+        return np.packbits(arr.astype(bool), axis=-1)
+
+    @staticmethod
+    def to_ids(node_masks: np.ndarray, Xs: np.ndarray):
+        """
+        Splits (S, n, x_dim) Skeleton.get_state features into (fps, fp_ids, target_ids, rxn_ids).
+        Raises ValueError if Xs can't be rebuilt from them, e.g. it isn't laid out as [node fp | target fp | rxn one-hot].
+        """
+        num_samples, n, x_dim = Xs.shape
+        nbits = (x_dim - NUM_POSS) // 2
+        if 2 * nbits + NUM_POSS != x_dim:
+            raise ValueError(f"X has {x_dim} features, expected 2*nbits+{NUM_POSS}")
+        node_fps = GNNShards.packbits(Xs[..., :nbits], "X").reshape(num_samples * n, -1)
+        target_fps = GNNShards.packbits(Xs[..., nbits : 2 * nbits].max(axis=1), "X")
+        fps, inverse = np.unique(np.concatenate((node_fps, target_fps)), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1).astype(np.int32)
+        fp_ids = inverse[: num_samples * n].reshape(num_samples, n)
+        target_ids = inverse[num_samples * n :]
+        rxns = Xs[..., 2 * nbits :]
+        rxn_ids = np.where(rxns.any(axis=-1), rxns.argmax(axis=-1), -1).astype(np.int16)
+        if not np.array_equal(GNNShards.ids_to_X(fps, fp_ids, target_ids, rxn_ids, node_masks, nbits), Xs):
+            raise ValueError("X can't be stored as fingerprint ids")
+        return fps, fp_ids, target_ids, rxn_ids
+
+    @staticmethod
+    def write(base: str, node_masks, Xs, ys, smiles, shard_size: int = GNN_SHARD_SIZE, fp_ids: bool = False) -> int:
+        """
+        Writes a batch as returned by process_syntree_mask and concatenated:
+        node_masks (S, n), Xs (S*n, x_dim), ys (S*n, y_dim), smiles (S,).
+        Replaces previous shards of base, returns the number of shards.
+        """
+        node_masks = np.asarray(node_masks)
+        num_samples, n = node_masks.shape
+        Xs = np.asarray(Xs).reshape(num_samples, n, -1)
+        ys = np.asarray(ys).reshape(num_samples, n, -1)
+        if fp_ids: # raises before the previous shards are removed
+            fps, ids, target_ids, rxn_ids = GNNShards.to_ids(node_masks, Xs)
+        for fpath in GNNShards.shard_files(base):
+            os.remove(fpath)
+        if os.path.exists(f"{base}_fps.npz"):
+            os.remove(f"{base}_fps.npz")
+        if fp_ids:
+            ProductMap.savez(f"{base}_fps.npz", {"fps": fps})
+        dims = np.array([n, Xs.shape[-1], ys.shape[-1], shard_size], dtype=np.int64)
+        num_shards = 0
+        for start in range(0, num_samples, shard_size):
+            end = min(start + shard_size, num_samples)
+            encoded = [str(smi).encode() for smi in smiles[start:end]]
+            arrays = {
+                "node_masks": GNNShards.packbits(node_masks[start:end], "node_masks"),
+                "y": GNNShards.packbits(ys[start:end], "y"),
+                "smiles_bytes": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                "smiles_offsets": np.cumsum([0] + [len(b) for b in encoded], dtype=np.int64),
+                "dims": dims,
+            }
+            if fp_ids:
+                arrays.update(fp_ids=ids[start:end], target_ids=target_ids[start:end], rxn_ids=rxn_ids[start:end])
+            else:
+                arrays["X"] = GNNShards.packbits(Xs[start:end], "X")
+            ProductMap.savez(f"{base}_shard{num_shards}.npz", arrays)
+            num_shards += 1
+        return num_shards
+
+
+class FingerprintTable:
+    """The fingerprint tables of several fingerprint-id batches, concatenated.
+
+    `offsets[base]` is added to the ids read from `base`, so the samples of all batches (train, valid, test)
+    index one table, which the model keeps on device (see GNNModel.set_fp_table).
+    """
+
+    def __init__(self, bases):
+        self.offsets = {}
+        tables = []
+        size = 0
+        for base in sorted(set(bases)):
+            shards = GNNShards(base)
+            if not GNNShards.exists(base) or not shards.has_fp_ids:
+                raise ValueError(f"{base} wasn't written with process-for-gnn.py --fp-ids")
+            fps = shards.fp_table()
+            self.offsets[base] = size
+            size += len(fps)
+            tables.append(fps)
+        self.fps = np.concatenate(tables) if tables else np.zeros((0, 0), dtype=np.uint8)
@@ -0,0 +1,171 @@
+"""Compact index of a hash directory (see `hash_programs` in `scripts/build-hash-table.py`)."""
+import functools
+import hashlib
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+from synnet.config import DELIM, HASH_INDEX_FILE
+from synnet.utils.data_utils import BuildingBlockRegistry, ProductMap, mmap_npz
+
+
+class HashIndex:
+    """Existence and building-block lists of the `{hash}.json` files of a hash directory.
+
+    The index is a single uncompressed .npz in the directory, mmapped on first use:
+    the md5 keys of the files' relative paths (sorted, so a batch of paths is one `np.searchsorted`),
+    and per file the building blocks of each (node, reactant) slot of its `bbs` as int ids.
+    Without an index file, the same queries fall back to `os.path.exists` and `json.load`.
+    """
+
+    def __init__(self, hash_dir: str):
+        self.hash_dir = hash_dir
+        self.fpath = os.path.join(hash_dir, HASH_INDEX_FILE)
+        self._arrays = None
+        self._vocab = None
+        self._registry = None  # (registry, vocab id -> registry id)
+
+    @staticmethod
+    def open(hash_dir: str) -> "HashIndex":
+        """One instance per directory and version of its index file, the policies and decoders are created per step.
+        A rebuilt (or newly built) index file gets a new instance instead of the stale mmap."""
+        try:
+            st = os.stat(os.path.join(hash_dir, HASH_INDEX_FILE))
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            stamp = None
+        return HashIndex._open(hash_dir, stamp)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _open(hash_dir: str, stamp) -> "HashIndex":
+        return HashIndex(hash_dir)
+
+    def __getstate__(self):
+        return {"hash_dir": self.hash_dir, "fpath": self.fpath, "_arrays": None, "_vocab": None, "_registry": None}
+
+    @property
+    def indexed(self) -> bool:
+        return self.arrays is not None
+
+    @property
+    def arrays(self) -> Optional[dict]:
+        if self._arrays is None and os.path.exists(self.fpath):
+            self._arrays = mmap_npz(self.fpath)
+        return self._arrays
+
+    def keys(self, paths: list[str]) -> np.ndarray:
+        prefix = os.path.join(self.hash_dir, "")
+        rel_paths = [path[len(prefix):] if path.startswith(prefix) else os.path.relpath(path, self.hash_dir) for path in paths]
+        rel_paths = [os.path.splitext(rel_path)[0] for rel_path in rel_paths]
+        return np.fromiter((HashIndex.key(rel_path) for rel_path in rel_paths), dtype=np.uint64, count=len(rel_paths))
+
+    @staticmethod
+    def key(rel_path: str) -> int:
+        return int.from_bytes(hashlib.md5(rel_path.encode()).digest()[:8], "little")
+
+    def _records(self, paths: list[str]) -> np.ndarray:
+        """Row of each path in the index, -1 if absent."""
+        keys = self.arrays["keys"]
+        query = self.keys(paths)
+        rows = np.searchsorted(keys, query)
+        found = rows < len(keys)
+        found[found] = keys[rows[found]] == query[found]
+        return np.where(found, rows, -1)
+
+    def exists(self, paths: list[str]) -> np.ndarray:
+        """Bool array, '' (no path) is never found."""
+        exists = np.array([bool(path) for path in paths], dtype=bool)
+        if not self.indexed:
+            return exists & np.array([bool(path) and os.path.exists(path) for path in paths], dtype=bool)
+        exists[exists] = self._records([path for path in paths if path]) >= 0
+        return exists
+
+    def bbs(self, path: str, node: int, reactant: int, registry: Optional[BuildingBlockRegistry] = None) -> np.ndarray:
+        """Building blocks of reactant `reactant` of `node` in `path`'s `bbs`, as ids of `registry` if given."""
+        if not self.indexed:
+            smis = HashIndex.slots(json.load(open(path))["bbs"])[(node, reactant)]
+            return registry.ids(smis) if registry is not None else np.array(smis, dtype=object)
+        a = self.arrays
+        (row,) = self._records([path])
+        if row < 0:
+            raise FileNotFoundError(path)
+        start, end = a["record_offsets"][row], a["record_offsets"][row + 1]
+        slot = np.flatnonzero((a["slot_nodes"][start:end] == node) & (a["slot_reactants"][start:end] == reactant))
+        if not len(slot):
+            raise KeyError(f"{path} has no building blocks for {(node, reactant)}")
+        s = start + slot[0]
+        ids = np.asarray(a["bb_ids"][a["slot_offsets"][s] : a["slot_offsets"][s + 1]])
+        if registry is None:
+            return self.vocab[ids]
+        registry_ids = self._registry_ids(registry)[ids]
+        if (registry_ids < 0).any():
+            missing = self.vocab[ids[registry_ids < 0][0]]
+            raise ValueError(f"{missing} is not a registered building block")
+        return registry_ids
+
+    @property
+    def vocab(self) -> np.ndarray:
+        if self._vocab is None:
+            vocab_bytes, offsets = bytes(self.arrays["vocab_bytes"]), self.arrays["vocab_offsets"].tolist()
+            self._vocab = np.array([vocab_bytes[a:b].decode() for a, b in zip(offsets[:-1], offsets[1:])], dtype=object)
+        return self._vocab
+
+    def _registry_ids(self, registry: BuildingBlockRegistry) -> np.ndarray:
+        if self._registry is None or self._registry[0] is not registry:
+            self._registry = (registry, registry.ids(self.vocab, missing=-1))
+        return self._registry[1]
+
+    @staticmethod
+    def slots(bbs: dict) -> dict:
+        """{(node, reactant): smiles} of a `bbs` json dict, see hash_program.
+
+        Entry `n` stores the lists of both reactants under "n", entry `(n, idx)` a single list under "n{DELIM}idx".
+        """
+        slots = {}
+        for key, lists in bbs.items():
+            if DELIM in key:
+                node, idx = map(int, key.split(DELIM))
+                slots[(node, idx)] = lists[0]
+            else:
+                for idx, smis in enumerate(lists):
+                    slots[(int(key), idx)] = smis
+        return slots
+
+    @staticmethod
+    def build(hash_dir: str) -> int:
+        """Indexes every `.json` under `hash_dir`, returns the number of files."""
+        records = []
+        vocab = {}
+        for root, _, files in os.walk(hash_dir):
+            for f in files:
+                if not f.endswith(".json"):
+                    continue
+                path = os.path.join(root, f)
+                data = json.load(open(path))
+                slots = HashIndex.slots(data.get("bbs", {}))
+                slots = {slot: [vocab.setdefault(smi, len(vocab)) for smi in smis] for slot, smis in slots.items()}
+                rel_path = os.path.splitext(os.path.relpath(path, hash_dir))[0]
+                records.append((HashIndex.key(rel_path), slots))
+        records.sort(key=lambda record: record[0])
+        keys = np.array([key for key, _ in records], dtype=np.uint64)
+        assert len(np.unique(keys)) == len(keys), "hash key collision"
+        slot_list = [(slot, ids) for _, slots in records for slot, ids in slots.items()]
+        encoded = [smi.encode() for smi in vocab]
+        ProductMap.savez(
+            os.path.join(hash_dir, HASH_INDEX_FILE),
+            {
+                "keys": keys,
+                "record_offsets": np.cumsum([0] + [len(slots) for _, slots in records], dtype=np.int64),
+                "slot_nodes": np.array([node for (node, _), _ in slot_list], dtype=np.int32),
+                "slot_reactants": np.array([idx for (_, idx), _ in slot_list], dtype=np.int32),
+                "slot_offsets": np.cumsum([0] + [len(ids) for _, ids in slot_list], dtype=np.int64),
+                "bb_ids": np.array([i for _, ids in slot_list for i in ids], dtype=np.int32),
+                "vocab_bytes": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                "vocab_offsets": np.cumsum([0] + [len(b) for b in encoded], dtype=np.int64),
+            },
+        )
+        HashIndex._open.cache_clear()
+        return len(records)
@@ -0,0 +1,128 @@
+"""Valid masks of the skeleton classes under the criteria of `scripts/process-for-gnn.py`."""
+import fcntl
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from synnet.config import DELIM, MASK_TABLE_SUFFIX
+from synnet.utils.data_utils import ProductMap, inds_to_masks, mmap_npz, valid_mask_inds
+
+
+class MaskTable:
+    """Per (skeleton class, criterion, anchors) the masks satisfying the criterion, as sorted uint64 bitmasks.
+
+    Bit n of a bitmask is set iff node n is in the mask. Which masks are valid only depends on the topology
+    of the class, so a table is computed once from any Skeleton of the class (see `valid_mask_inds`),
+    instead of once per syntree. Keys also hold a stamp of the topology, so a regenerated skeleton file
+    whose class indices moved doesn't hit the old tables. The tables of a skeleton file are cached in one
+    uncompressed .npz next to it, mmapped on first use; new tables are kept in memory until `save`,
+    which merges them into the file as it is on disk then.
+    """
+
+    def __init__(self, fpath: str):
+        self.fpath = fpath
+        self._arrays = None
+        self._new = {}
+
+    @staticmethod
+    def path(skeleton_file: str) -> str:
+        return os.path.splitext(skeleton_file)[0] + MASK_TABLE_SUFFIX
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def open(skeleton_file: str) -> "MaskTable":
+        return MaskTable(MaskTable.path(skeleton_file))
+
+    def __getstate__(self):
+        return {"fpath": self.fpath, "_arrays": None, "_new": self._new}
+
+    @property
+    def arrays(self) -> dict:
+        if self._arrays is None:
+            self._arrays = mmap_npz(self.fpath) if os.path.exists(self.fpath) else {}
+        return self._arrays
+
+    @property
+    def unsaved(self) -> int:
+        return len(self._new)
+
+    @staticmethod
+    def topology(sk) -> str:
+        """Stamp of sk's tree: edges, reaction and leaf nodes, and which child each node is"""
+        tree = {
+            "edges": sorted(map(list, sk.tree.edges)),
+            "rxns": np.flatnonzero(sk.rxns).tolist(),
+            "leaves": np.flatnonzero(sk.leaves).tolist(),
+            "child": [[n, sk.tree.nodes[n].get("child")] for n in sorted(sk.tree.nodes)],
+        }
+        return hashlib.md5(json.dumps(tree, sort_keys=True).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def key(index: int, criterion: str, min_r_set, topology: str) -> str:
+        return DELIM.join([str(index), criterion, "-".join(map(str, sorted(min_r_set))), topology])
+
+    def bitmasks(self, sk, min_r_set, criterion: str) -> np.ndarray:
+        """Sorted uint64 bitmasks of the valid masks of sk's class (sk.index), computed if not in the table."""
+        key = MaskTable.key(sk.index, criterion, min_r_set, MaskTable.topology(sk))
+        if key in self._new:
+            return self._new[key]
+        if key in self.arrays:
+            return self.arrays[key]
+        if len(sk.tree) > 64:
+            raise ValueError(f"skeleton {sk.index} has {len(sk.tree)} nodes, bitmasks hold 64")
+        inds = valid_mask_inds(sk, min_r_set, criterion)
+        self._new[key] = np.sort(MaskTable.to_bitmasks(inds_to_masks(inds, len(sk.tree), min_r_set)))
+        return self._new[key]
+
+    def masks(self, sk, min_r_set, criterion: str) -> np.ndarray:
+        """(M, len(sk.tree)) 0/1 valid masks"""
+        return MaskTable.to_masks(self.bitmasks(sk, min_r_set, criterion), len(sk.tree))
+
+    def inds(self, sk, min_r_set, criterion: str) -> np.ndarray:
+        """Valid masks as the i's of inds_to_i, like valid_mask_inds"""
+        return np.sort(MaskTable.to_inds(self.masks(sk, min_r_set, criterion), min_r_set))
+
+    def contains(self, sk, min_r_set, criterion: str, masks) -> np.ndarray:
+        """Whether each of the (B, len(sk.tree)) masks is valid, e.g. sk.mask[None]"""
+        table = self.bitmasks(sk, min_r_set, criterion)
+        query = MaskTable.to_bitmasks(np.atleast_2d(masks))
+        rows = np.minimum(np.searchsorted(table, query), max(len(table) - 1, 0))
+        return (table[rows] == query) if len(table) else np.zeros(len(query), dtype=bool)
+
+    @staticmethod
+    def to_bitmasks(masks) -> np.ndarray:
+        masks = np.asarray(masks).astype(bool)
+        weights = np.left_shift(np.uint64(1), np.arange(masks.shape[-1], dtype=np.uint64))
+        return (masks * weights).sum(axis=-1, dtype=np.uint64)
+
+    @staticmethod
+    def to_masks(bitmasks, length: int) -> np.ndarray:
+        bitmasks = np.asarray(bitmasks, dtype=np.uint64)
+        return ((bitmasks[:, None] >> np.arange(length, dtype=np.uint64)) & np.uint64(1)).astype(np.int8)
+
+    @staticmethod
+    def to_inds(masks, min_r_set) -> np.ndarray:
+        """Inverse of inds_to_masks: the bits over the nodes outside min_r_set, least significant last"""
+        masks = np.asarray(masks)
+        zero_mask_inds = np.setdiff1d(np.arange(masks.shape[-1]), min_r_set)
+        shifts = np.arange(len(zero_mask_inds), dtype=np.int64)[::-1]
+        return (masks[:, zero_mask_inds].astype(np.int64) << shifts).sum(axis=-1)
+
+    def save(self):
+        """Merges the tables computed since the last save into the file, concurrent savers (e.g. runs on
+        other --gnn-datasets) are serialized by a lock file and keep each other's tables."""
+        if not self._new:
+            return
+        with open(self.fpath + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            on_disk = mmap_npz(self.fpath) if os.path.exists(self.fpath) else {}
+            arrays = {key: np.asarray(arr) for key, arr in on_disk.items()}
+            arrays.update(self._new)
+            tmp = f"{self.fpath}.{os.getpid()}.tmp"
+            ProductMap.savez(tmp, arrays)
+            os.replace(tmp, self.fpath)
+        self._arrays = None  # reopened with the merged tables
+        self._new = {}
@@ -0,0 +1,89 @@
+"""Process-wide, size-bounded cache of parsed molecules and canonical SMILES."""
+import os
+import threading
+from collections import OrderedDict
+
+from rdkit import Chem
+
+from synnet.config import MOL_CACHE_SIZE
+
+
+class MolCache:
+    """LRU cache keyed on SMILES for `Chem.MolFromSmiles` and `Chem.CanonSmiles`.
+
+    Cached `Chem.Mol` objects are shared between callers and must be treated as read-only.
+    Invalid SMILES are cached as `None` for molecules, while `canon_smiles` raises
+    like `Chem.CanonSmiles` does.
+    Under fork-based multiprocessing each worker inherits a copy of the parent's cache
+    and from then on keeps its own entries and counters.
+    """
+
+    def __init__(self, capacity: int = MOL_CACHE_SIZE):
+        self.capacity = capacity
+        self._mols = OrderedDict()
+        self._canon = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, table: OrderedDict, key: str, fn):
+        with self._lock:
+            if key in table:
+                table.move_to_end(key)
+                self.hits += 1
+                return table[key]
+            self.misses += 1
+        val = fn(key)  # parse outside the lock, may raise
+        with self._lock:
+            table[key] = val
+            table.move_to_end(key)
+            while len(table) > self.capacity:
+                table.popitem(last=False)
+        return val
+
+    def get_mol(self, smi: str) -> Chem.Mol:
+        return self._lookup(self._mols, smi, Chem.MolFromSmiles)
+
+    def canon_smiles(self, smi: str) -> str:
+        return self._lookup(self._canon, smi, Chem.CanonSmiles)
+
+    def resize(self, capacity: int):
+        with self._lock:
+            self.capacity = capacity
+            for table in (self._mols, self._canon):
+                while len(table) > capacity:
+                    table.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._mols.clear()
+            self._canon.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._mols) + len(self._canon),
+            "capacity": self.capacity,
+        }
+
+    def _after_fork(self):
+        # the parent's lock may have been held by another thread at fork time
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+MOL_CACHE = MolCache()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=MOL_CACHE._after_fork)
+
+
+def get_mol(smi: str) -> Chem.Mol:
+    return MOL_CACHE.get_mol(smi)
+
+
+def canon_smiles(smi: str) -> str:
+    return MOL_CACHE.canon_smiles(smi)
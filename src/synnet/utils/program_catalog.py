@@ -0,0 +1,258 @@
+"""SQLite catalog of enumerated programs, used by `scripts/build-hash-table.py` instead of whole-depth pickles."""
+import os
+import pickle
+import sqlite3
+from collections import OrderedDict
+from collections.abc import Sequence
+from contextlib import closing
+from copy import copy
+from typing import Optional
+
+import numpy as np
+
+from synnet.config import CATALOG_LRU_SIZE
+from synnet.utils.data_utils import Program, Reaction
+from synnet.utils.scheduler import TaskLedger
+
+
+class ProgramCatalog:
+    """Programs of each (stage, depth), e.g. `("init", 2)`, with their metadata as columns.
+
+    Reactions are stored once in a shared table and referenced by id: programs of a depth mostly
+    carry the same filtered `Reaction`s, so a program row only holds its tree, entries and product map.
+    Metadata queries (`input_lengths`, `good`, `files`) never deserialize programs,
+    `load` rebuilds a single program on demand, over one connection per process.
+    Cached loads keep the last `lru_size` programs, the caller must copy them before changing them.
+    """
+
+    def __init__(self, db_path: str, lru_size: int = CATALOG_LRU_SIZE):
+        self.db_path = db_path
+        self.lru_size = lru_size
+        self._reactions = {}  # reaction id -> Reaction, shared by loaded programs through copies
+        self._programs = OrderedDict()  # (stage, depth, idx) -> Program
+        self._con = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {"db_path": self.db_path, "lru_size": self.lru_size, "_reactions": {}, "_programs": OrderedDict(), "_con": None, "_pid": None}
+
+    def _connection(self):
+        """This process's connection for reads, reopened after a fork."""
+        if self._con is None or self._pid != os.getpid():
+            self._con = self._connect()
+            self._pid = os.getpid()
+        return self._con
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        con = sqlite3.connect(self.db_path, timeout=600)
+        con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS reactions (id INTEGER PRIMARY KEY, key TEXT UNIQUE, data BLOB);
+            CREATE TABLE IF NOT EXISTS programs (
+                stage TEXT, depth INTEGER, idx INTEGER, input_length REAL, good INTEGER,
+                files TEXT, data BLOB, PRIMARY KEY (stage, depth, idx)
+            );
+            CREATE TABLE IF NOT EXISTS program_reactions (
+                stage TEXT, depth INTEGER, idx INTEGER, node INTEGER, reaction_id INTEGER,
+                PRIMARY KEY (stage, depth, idx, node)
+            );
+            CREATE TABLE IF NOT EXISTS stages (stage TEXT, depth INTEGER, fingerprint TEXT, PRIMARY KEY (stage, depth));
+            """
+        )
+        return con
+
+    @staticmethod
+    def is_good(p: Program) -> Optional[bool]:
+        """Every entry has reactants left (see build-hash-table's filter_programs), None if not initialized yet."""
+        for e in p.entries:
+            r, idx = e if isinstance(e, tuple) else (e, None)
+            if r not in p.rxn_map:
+                return None
+            if idx is None:
+                poss_reactants = np.prod([len(reactants) for reactants in p.rxn_map[r].available_reactants])
+            else:
+                poss_reactants = len(p.rxn_map[r].available_reactants[idx])
+            if not poss_reactants:
+                return False
+        return True
+
+    def _reaction_id(self, con, rxn: Reaction) -> int:
+        key = Program.hash_json([rxn.smirks, rxn.available_reactants])
+        row = con.execute("SELECT id FROM reactions WHERE key = ?", (key,)).fetchone()
+        if row:
+            return row[0]
+        return con.execute("INSERT INTO reactions (key, data) VALUES (?, ?)", (key, pickle.dumps(rxn))).lastrowid
+
+    def add(self, stage: str, depth: int, progs: list, rxns: Optional[list[Reaction]] = None, fingerprint: str = ""):
+        """Replaces the programs of (stage, depth), `None`s are skipped.
+
+        `rxns` are needed for the input length of programs whose new reaction is not initialized yet.
+        """
+        with closing(self._connect()) as con, con:
+            for table in ["programs", "program_reactions"]:
+                con.execute(f"DELETE FROM {table} WHERE stage = ? AND depth = ?", (stage, depth))
+            for idx, p in enumerate(p for p in progs if p is not None):
+                state = p.__dict__.copy()
+                rxn_map = state.pop("rxn_map")
+                good = ProgramCatalog.is_good(p)
+                files = p.product_map.files() if hasattr(p, "product_map") else []
+                con.execute(
+                    "INSERT INTO programs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (stage, depth, idx, float(Program.input_length(p, rxns)), good, "\n".join(files), pickle.dumps(state)),
+                )
+                con.executemany(
+                    "INSERT INTO program_reactions VALUES (?, ?, ?, ?, ?)",
+                    [(stage, depth, idx, n, self._reaction_id(con, rxn)) for n, rxn in rxn_map.items()],
+                )
+            con.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?)", (stage, depth, fingerprint))
+        for key in [key for key in self._programs if key[:2] == (stage, depth)]:
+            del self._programs[key]
+
+    def update(self, stage: str, depth: int, idx: int, p: Program):
+        """Rewrites a stored program whose reactions are unchanged, e.g. after converting its product map files."""
+        state = p.__dict__.copy()
+        state.pop("rxn_map")
+        files = p.product_map.files() if hasattr(p, "product_map") else []
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "UPDATE programs SET files = ?, data = ? WHERE stage = ? AND depth = ? AND idx = ?",
+                ("\n".join(files), pickle.dumps(state), stage, depth, idx),
+            )
+        self._programs.pop((stage, depth, idx), None)
+
+    def stages(self) -> list[tuple[str, int]]:
+        with closing(self._connect()) as con:
+            return [tuple(row) for row in con.execute("SELECT stage, depth FROM stages ORDER BY stage, depth")]
+
+    def files(self) -> list[str]:
+        """The product map files referenced by the programs of every stage, with repeats (see ProductStore.recount)."""
+        with closing(self._connect()) as con:
+            rows = con.execute("SELECT files FROM programs").fetchall()
+        return [f for (files,) in rows for f in files.split("\n") if f]
+
+    def has(self, stage: str, depth: int, fingerprint: str = "") -> bool:
+        with closing(self._connect()) as con:
+            row = con.execute("SELECT fingerprint FROM stages WHERE stage = ? AND depth = ?", (stage, depth)).fetchone()
+        return row is not None and row[0] == fingerprint
+
+    def _reaction(self, con, reaction_id: int) -> Reaction:
+        if reaction_id not in self._reactions:
+            (data,) = con.execute("SELECT data FROM reactions WHERE id = ?", (reaction_id,)).fetchone()
+            self._reactions[reaction_id] = pickle.loads(data)
+        return copy(self._reactions[reaction_id])  # programs replace, never mutate, available_reactants
+
+    def _load(self, con, stage: str, depth: int, idx: int) -> Program:
+        (data,) = con.execute(
+            "SELECT data FROM programs WHERE stage = ? AND depth = ? AND idx = ?", (stage, depth, idx)
+        ).fetchone()
+        p = Program.__new__(Program)
+        p.__dict__.update(pickle.loads(data))
+        rows = con.execute(
+            "SELECT node, reaction_id FROM program_reactions WHERE stage = ? AND depth = ? AND idx = ?",
+            (stage, depth, idx),
+        ).fetchall()
+        p.rxn_map = {n: self._reaction(con, reaction_id) for n, reaction_id in rows}
+        return p
+
+    def load(self, stage: str, depth: int, idx: int, cached: bool = False) -> Program:
+        if not cached:
+            return self._load(self._connection(), stage, depth, idx)
+        key = (stage, depth, idx)
+        if key in self._programs:
+            self._programs.move_to_end(key)
+        else:
+            self._programs[key] = self._load(self._connection(), stage, depth, idx)
+            while len(self._programs) > self.lru_size:
+                self._programs.popitem(last=False)
+        return self._programs[key]
+
+    def load_many(self, stage: str, depth: int, ids: list[int]):
+        """Yields the programs one at a time over a single connection."""
+        with closing(self._connect()) as con:
+            for idx in ids:
+                yield self._load(con, stage, depth, idx)
+
+    def _column(self, stage: str, depth: int, column: str) -> list:
+        with closing(self._connect()) as con:
+            rows = con.execute(
+                f"SELECT {column} FROM programs WHERE stage = ? AND depth = ? ORDER BY idx", (stage, depth)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def programs(self, stage: str, depth: int, good: bool = False) -> "CatalogPrograms":
+        """Lazy list of the programs of (stage, depth), only the good ones if good."""
+        flags = self._column(stage, depth, "good")
+        ids = [i for i, flag in enumerate(flags) if flag or not good]
+        return CatalogPrograms(self, stage, depth, ids)
+
+
+def referenced_files(obj) -> list[str]:
+    """The product map files of the programs in obj, a program or (nested) list/tuple/dict of them."""
+    if hasattr(obj, "product_map"):
+        return obj.product_map.files()
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        return [f for item in obj for f in referenced_files(item)]
+    return []
+
+
+def cache_references(cache_dir: str) -> list[str]:
+    """Every product map reference held in a build-hash-table.py cache_dir, with repeats.
+
+    Besides the cataloged programs, the task results in the ledger (tasks.db) and the memoized
+    init/run results (memo/) point into the product store, and are reused if their files still exist.
+    """
+    fpaths = ProgramCatalog(os.path.join(cache_dir, "programs.db")).files()
+    ledger = TaskLedger(os.path.join(cache_dir, "tasks.db"), os.path.join(cache_dir, "tasks"))
+    result_paths = ledger.result_paths()
+    memo_dir = os.path.join(cache_dir, "memo")
+    if os.path.isdir(memo_dir):
+        for step in os.listdir(memo_dir):
+            result_paths += [
+                os.path.join(memo_dir, step, f) for f in os.listdir(os.path.join(memo_dir, step)) if f.endswith(".pkl")
+            ]
+    for result_path in result_paths:
+        with open(result_path, "rb") as f:
+            fpaths += referenced_files(pickle.load(f))
+    return fpaths
+
+
+class CatalogPrograms(Sequence):
+    """A list of catalog programs that are loaded when accessed, through the catalog's LRU if cached."""
+
+    def __init__(self, catalog: ProgramCatalog, stage: str, depth: int, ids: list[int], cached: bool = False):
+        self.catalog = catalog
+        self.stage = stage
+        self.depth = depth
+        self.ids = list(ids)
+        self.cached = cached
+
+    def cached_view(self) -> "CatalogPrograms":
+        """The same programs, indexed through the LRU (read-only use, e.g. as expansion inputs)."""
+        return CatalogPrograms(self.catalog, self.stage, self.depth, self.ids, cached=True)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return CatalogPrograms(self.catalog, self.stage, self.depth, self.ids[i], self.cached)
+        return self.catalog.load(self.stage, self.depth, self.ids[i], cached=self.cached)
+
+    def __iter__(self):
+        return self.catalog.load_many(self.stage, self.depth, self.ids)
+
+    def _column(self, column: str) -> list:
+        values = self.catalog._column(self.stage, self.depth, column)
+        return [values[i] for i in self.ids]
+
+    def input_lengths(self) -> np.ndarray:
+        return np.array(self._column("input_length"), dtype=float)
+
+    def good(self) -> list[Optional[bool]]:
+        return [None if flag is None else bool(flag) for flag in self._column("good")]
+
+    def files(self) -> list[str]:
+        return [f for files in self._column("files") for f in files.split("\n") if f]
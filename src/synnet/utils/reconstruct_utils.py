@@ -5,7 +5,6 @@ from synnet.visualize.visualizer import SkeletonVisualizer
 from synnet.encoding.distances import cosine_distance
 from synnet.models.common import load_gnn_from_ckpt, find_best_model_ckpt, load_mlp_from_ckpt
 from synnet.models.gnn import PtrDataset
-from synnet.models.mlp import nn_search_list
 from synnet.data_generation.syntrees import (
     IdentityIntEncoder,
     MorganFingerprintEncoder,
@@ -13,17 +12,21 @@ from synnet.data_generation.syntrees import (
 )
 from synnet.MolEmbedder import MolEmbedder
 from synnet.utils.predict_utils import mol_fp, tanimoto_similarity
+from synnet.utils.mol_cache import canon_smiles
+from synnet.data_generation.compatibility import ReactantCompatibility
 from synnet.utils.analysis_utils import serialize_string
 from synnet.policy import RxnPolicy
 import rdkit.Chem as Chem
 from synnet.config import DATA_PREPROCESS_DIR, DATA_RESULT_DIR, MAX_PROCESSES, MAX_DEPTH, NUM_POSS, DELIM
-from synnet.utils.data_utils import ReactionSet, SyntheticTreeSet, Skeleton, SkeletonSet, Program
+from synnet.utils.data_utils import ReactionSet, SyntheticTreeSet, Skeleton, SkeletonSet, Program, BuildingBlockRegistry
+from synnet.utils.hash_index import HashIndex
+from synnet.utils.embedding_index import EmbeddingIndex
 from zss import simple_distance
 from pathlib import Path
 import numpy as np
 import networkx as nx
 from typing import Tuple
-from torch_geometric.data import Data
+from torch_geometric.data import Batch, Data
 import torch
 import os
 import yaml
@@ -131,6 +134,25 @@ def decode(sk, smi):
     return sks
 
 
+def decode_batch(target_batch):
+    """decode for a list of (sk, smi), decoded together by wrapper_decoder_batch."""
+    batch = []
+    for sk, smi in target_batch:
+        sk.clear_tree(forcing=args.forcing_eval)
+        sk.modify_tree(sk.tree_root, smiles=smi)
+        if 'rxn_models' in globals():
+            rxn_gnn = rxn_models[sk.index]
+        else:
+            rxn_gnn = globals()['rxn_gnn']
+        if 'bb_models' in globals():
+            bb_gnn = bb_models[sk.index]
+        else:
+            bb_gnn = globals()['bb_gnn']
+        batch.append((sk, rxn_gnn, bb_gnn))
+    bblock_inds = globals().get('bblock_inds', None)
+    return wrapper_decoder_batch(args, batch, bb_emb, rxn_templates, bblocks, bblock_inds=bblock_inds)
+
+
 def build_mc(max_num_rxns=-1): # build a markov chain    
     tree_lookup = globals()['skeleton_index_lookup']
     inds = get_skeleton_inds_within_depth(max_num_rxns)
@@ -545,18 +567,12 @@ def filter_imposs(args, rxn_graph, sk, cur, n):
             if depth > 2:
                 base_case = True
         if base_case:
-            paths = []
-            for i in range(91):
-                g = nx.DiGraph()
-                g.add_node(0, rxn_id=i, depth=1)   
-                path = Program(g).get_path()
-                path = os.path.join(args.hash_dir, path)
-                if os.path.exists(path):
-                    paths.append(path)
-                    rxn_imposs[i] = False
-                else:
-                    paths.append('')
-                    rxn_imposs[i] = True
+            g = nx.DiGraph()
+            g.add_node(0, rxn_id=-1, depth=1)   
+            paths = [os.path.join(args.hash_dir, path) for path in Program(g).get_paths(0, range(91))]
+            exists = HashIndex.open(args.hash_dir).exists(paths)
+            rxn_imposs = [not exist for exist in exists.tolist()]
+            paths = [path if exist else '' for path, exist in zip(paths, exists)]
             return rxn_imposs, paths
         policy = RxnPolicy(4096+2*91, 2, 2*91, sk.subtree(pred), args.hash_dir, rxns)
         obs = np.zeros((4096+2*91,))        
@@ -614,7 +630,7 @@ def fill_in(args, sk, n, logits_n, bb_emb, rxn_templates, bbs, top_bb=1, top_rxn
             else:
                 if 'path' in sk.tree.nodes[pred]:
                     path = sk.tree.nodes[pred]['path']     
-                    exist = os.path.exists(path)
+                    exist = HashIndex.open(args.hash_dir).exists([path])[0]
                 else:
                     exist = False
         else:
@@ -627,17 +643,11 @@ def fill_in(args, sk, n, logits_n, bb_emb, rxn_templates, bbs, top_bb=1, top_rxn
             else:
                 assert rxn_graph.nodes[int(e)]['depth'] == 1
                 e = '0'
-            data = json.load(open(path))
             succs = list(sk.tree.successors(pred))
             second = sk.tree.nodes[n]['child'] == 'right'
-            if e in data['bbs']:
-                bbs_child = data['bbs'][e][int(second)]
-            else:
-                bbs_child = data['bbs'][f"{e}{DELIM}{int(second)}"]
-                assert len(bbs_child) == 1
-                bbs_child = bbs_child[0]
+            indices = HashIndex.open(args.hash_dir).bbs(path, int(e), int(second), bbs).astype(np.int64)
             if args.forcing_eval:
-                if sk.tree.nodes[n]['smiles'] not in bbs_child:
+                if sk.tree.nodes[n]['smiles'] not in bbs.to_smiles(indices):
                     bad = False
                     for m in sk.tree:
                         if 'rxn_id' in sk.tree.nodes[m]:
@@ -645,23 +655,22 @@ def fill_in(args, sk, n, logits_n, bb_emb, rxn_templates, bbs, top_bb=1, top_rxn
                                 bad = True
                     # if not bad:
                     #     breakpoint()
-            indices = [bbs.index(smi) for smi in bbs_child]
             if len(indices) >= top_bb:
-                bb_ind = nn_search_list(emb_bb, bb_emb[indices], top_k=top_bb).item()
-                smiles = bbs[indices[bb_ind]]
+                _, bb_inds = EmbeddingIndex.open(bb_emb).search(emb_bb, top_bb, subset=indices)
+                smiles = bbs[int(bb_inds[0, -1])]
             else:
                 failed = True
         if not exist or failed:
-            if bblock_inds is not None:
-                indices = bblock_inds
-            else:
-                indices = list(range(bb_emb.shape[0]))
+            bb_index = EmbeddingIndex.open(bb_emb)
+            subset = bblock_inds # None: all bbs
             pred_rxn_id = sk.tree.nodes[pred]['rxn_id']            
             if hasattr(rxns[pred_rxn_id], 'bblock_mask'):
                 second = sk.tree.nodes[n]['child'] == 'right'
-                indices = rxns[pred_rxn_id].bblock_mask[second]
-            bb_ind = nn_search_list(emb_bb, bb_emb[indices], top_k=min(top_bb, len(indices))).item()
-            smiles = bbs[indices[bb_ind]]
+                subset = (pred_rxn_id, int(second))
+                if subset not in bb_index.subsets:
+                    bb_index.add_subset(subset, rxns[pred_rxn_id].bblock_mask[second])
+            _, bb_inds = bb_index.search(emb_bb, top_bb, subset=subset)
+            smiles = bbs[int(bb_inds[0, -1])]
         sk.modify_tree(n, smiles=smiles, suffix='_forcing' if args.forcing_eval else '')    
 
 
@@ -695,16 +704,8 @@ def pick_node(sk, logits, bb_emb):
         # return [n for n in logits if not sk.rxns[n]]
 
 
-@torch.no_grad()
-def wrapper_decoder(args, sk, model_rxn, model_bb, bb_emb, rxn_templates, bblocks, bblock_inds=None, skviz=None):
-    top_k_bb = args.top_k
-    top_k_rxn = args.top_k_rxn
-    """Generate a filled-in skeleton given the input which is only filled with the target."""
-    model_rxn.eval()
-    model_bb.eval()
-    # Following how SynNet reports reconstruction accuracy, we decode top-3 reactants, 
-    # corresponding to the first bb chosen
-    # To make the code more general, we implement this with a stack
+def init_beams(args, sk):
+    """The beams decoding starts from: sk, or one (sk, topological order) per order of its tree."""
     if args.strategy == 'topological':
         sks = []        
         tree_key = serialize_string(sk.tree, sk.tree_root)
@@ -714,6 +715,80 @@ def wrapper_decoder(args, sk, model_rxn, model_bb, bb_emb, rxn_templates, bblock
         sks = [sk]
     else:
         raise NotImplementedError    
+    return sks
+
+
+def decoder_features(sk, fps=None):
+    """
+    X of sk.get_state(rxn_target_down_bb=True, rxn_target_down=True) with the intermediates
+    (except the root) zero'ed out, which is what the decoder feeds the models.
+    fps caches smiles -> fp_2048 across skeletons, e.g. the beams and targets decoded together
+    """
+    keep = sk.rxns | sk.leaves
+    keep[sk.tree_root] = True
+    return np.where(keep[:, None], sk.features(fps), np.float32(0))
+
+
+def decoder_data(sk, X, model):
+    edges = sk.tree_edges
+    edge_input = torch.tensor(np.concatenate((edges, edges[::-1]), axis=-1), dtype=torch.int64)
+    x = torch.from_numpy(X)
+    if model.layers[0].in_channels != X.shape[1]:
+        x = torch.cat((x, PtrDataset.positionalencoding1d(32, len(X))), dim=-1)
+    return Data(edge_index=edge_input, x=x)
+
+
+def expand_beam(args, sk, next_node, logits_rxn, logits_bb, bb_emb, rxn_templates, bblocks, bblock_inds=None):
+    """
+    One decoding step of a beam given the models' logits on its nodes.
+    Fills in the picked node, branching into the top-k choices if it is the first bb (rxn) chosen.
+    Returns the node and the new beams, in the stack's format (sk, or (sk, next_node) for topological).
+    """
+    logits = {}
+    if args.strategy == 'topological':
+        frontier_nodes = [next_node[0]]
+    else:
+        frontier_nodes = [n for n in set(sk.frontier_nodes) if not sk.mask[n]]
+    for n in frontier_nodes:
+        if sk.rxns[n]:
+            logits[n] = logits_rxn[n]
+        else:                
+            assert sk.leaves[n]               
+            logits[n] = logits_bb[n]        
+    if args.strategy =='topological':        
+        n = next_node.pop(0)
+    else:
+        (n,) = pick_node(sk, logits, bb_emb)
+    logits_n = logits[n].clone()
+    first_bb = sk.leaves[n] and (sk.leaves)[sk.mask == 1].sum() == 0
+    first_rxn = sk.rxns[n] and (sk.rxns)[sk.mask == 1].sum() == 0
+    if args.top_k > 1 and first_bb: # first bb
+        tops = [{'top_bb': k} for k in range(1, 1+args.top_k)]
+    elif args.top_k_rxn > 1 and first_rxn:
+        tops = [{'top_rxn': k} for k in range(1, 1+args.top_k_rxn)]
+    else:
+        tops = [{'top_bb': 1}]
+    beams = []
+    for top in tops:
+        sk_n = deepcopy(sk)
+        fill_in(args, sk_n, n, logits_n, bb_emb, rxn_templates, bblocks, bblock_inds=bblock_inds, **top)
+        if next_node is None:
+            beams.append(sk_n)
+        else:
+            beams.append((sk_n, deepcopy(next_node) if len(tops) > 1 else next_node))
+    return n, beams
+
+
+@torch.no_grad()
+def wrapper_decoder(args, sk, model_rxn, model_bb, bb_emb, rxn_templates, bblocks, bblock_inds=None, skviz=None):
+    """Generate a filled-in skeleton given the input which is only filled with the target."""
+    model_rxn.eval()
+    model_bb.eval()
+    # Following how SynNet reports reconstruction accuracy, we decode top-3 reactants, 
+    # corresponding to the first bb chosen
+    # To make the code more general, we implement this with a stack
+    sks = init_beams(args, sk)
+    fps = {}
     if args.mermaid:
         # set ids so don't forget
         for sk in sks:
@@ -742,92 +817,39 @@ def wrapper_decoder(args, sk, model_rxn, model_bb, bb_emb, rxn_templates, bblock
             """        
             # print(f"decode step {sk.mask}")
             # prediction problem        
-            _, X, _ = sk.get_state(rxn_target_down_bb=True, rxn_target_down=True)
-            for i in range(len(X)):
-                if i != sk.tree_root and not sk.rxns[i] and not sk.leaves[i]:
-                    X[i] = 0
-            
-            edges = sk.tree_edges
-            tree_edges = np.concatenate((edges, edges[::-1]), axis=-1)
-            edge_input = torch.tensor(tree_edges, dtype=torch.int64)        
-            if model_rxn.layers[0].in_channels != X.shape[1]:
-                pe = PtrDataset.positionalencoding1d(32, len(X))
-                x_input_rxn = np.concatenate((X, pe), axis=-1)
-            else:
-                x_input_rxn = X
-            if model_bb.layers[0].in_channels != X.shape[1]:
-                pe = PtrDataset.positionalencoding1d(32, len(X))
-                x_input_bb = np.concatenate((X, pe), axis=-1)            
-            else:
-                x_input_bb = X
-            data_rxn = Data(edge_index=edge_input, x=torch.Tensor(x_input_rxn))
-            data_bb = Data(edge_index=edge_input, x=torch.Tensor(x_input_bb))
+            X = decoder_features(sk, fps)
+            data_rxn = decoder_data(sk, X, model_rxn)
+            data_bb = decoder_data(sk, X, model_bb)
+            edge_input = data_rxn.edge_index
             if skviz is not None and args.attn_weights:
                 logits_rxn, rxn_attns = model_rxn(data_rxn, return_attention=True)
                 logits_bb, bb_attns= model_bb(data_bb, return_attention=True)
             else:
                 logits_rxn = model_rxn(data_rxn)
                 logits_bb = model_bb(data_bb)
-            logits = {}
-            if args.strategy == 'topological':
-                frontier_nodes = [next_node[0]]
-            else:
-                frontier_nodes = [n for n in set(sk.frontier_nodes) if not sk.mask[n]]
-            for n in frontier_nodes:
-                if sk.rxns[n]:
-                    logits[n] = logits_rxn[n]
-                else:                
-                    assert sk.leaves[n]               
-                    logits[n] = logits_bb[n]        
-            if args.strategy =='topological':        
-                poss_n = [next_node.pop(0)]
-            else:
-                poss_n = pick_node(sk, logits, bb_emb)
-            for n in poss_n:
-                logits_n = logits[n].clone()
-                sk_n = deepcopy(sk)
-                first_bb = sk_n.leaves[n] and (sk_n.leaves)[sk_n.mask == 1].sum() == 0
-                first_rxn = sk_n.rxns[n] and (sk_n.rxns)[sk_n.mask == 1].sum() == 0
-                if top_k_bb > 1 and first_bb: # first bb                
-                    for k in range(1, 1+top_k_bb):
-                        sk_copy = deepcopy(sk_n)
-                        fill_in(args, sk_copy, n, logits_n, bb_emb, rxn_templates, bblocks, top_bb=k, bblock_inds=bblock_inds)
-                        if next_node is None:
-                            sks.append(sk_copy)
+            n, beams = expand_beam(args, sk, next_node, logits_rxn, logits_bb, bb_emb, rxn_templates, bblocks, bblock_inds=bblock_inds)
+            sks += beams
+            if skviz is not None:
+                for sk_n in beams:
+                    if isinstance(sk_n, tuple):
+                        sk_n = sk_n[0]
+                    skviz_n = skviz(sk_n, skviz_version)                                              
+                    mermaid_txt = skviz_n.write(node_mask=sk_n.mask)             
+                    mask_str = ''.join(map(str,sk_n.mask))
+                    outfile = skviz_n.path / f"skeleton_{sk_n.uuid}_{sk_n.index}_{mask_str}.md"  
+                    SynTreeWriter(prefixer=SkeletonPrefixWriter()).write(mermaid_txt).to_file(outfile)
+                    if args.attn_weights:
+                        # mask = edge_input[1] == n
+                        mask = np.ones((len(edge_input[-1]),), dtype='bool')
+                        if sk.rxns[n]:                                
+                            attns = torch.stack([rxn_attns[layer][mask] for layer in range(len(rxn_attns))], dim=0).mean(axis=0)
                         else:
-                            sks.append((sk_copy, deepcopy(next_node)))
-                elif top_k_rxn > 1 and first_rxn:
-                    for k in range(1, 1+top_k_rxn):
-                        sk_copy = deepcopy(sk_n)
-                        fill_in(args, sk_copy, n, logits_n, bb_emb, rxn_templates, bblocks, top_rxn=k, bblock_inds=bblock_inds)
-                        if next_node is None:
-                            sks.append(sk_copy)
-                        else:
-                            sks.append((sk_copy, deepcopy(next_node)))                    
-                else:
-                    fill_in(args, sk_n, n, logits_n, bb_emb, rxn_templates, bblocks, top_bb=1, bblock_inds=bblock_inds)
-                    if next_node is None:
-                        sks.append(sk_n)
-                    else:
-                        sks.append((sk_n, next_node))
-                    if skviz is not None:  
-                        skviz_n = skviz(sk_n, skviz_version)                                              
-                        mermaid_txt = skviz_n.write(node_mask=sk_n.mask)             
-                        mask_str = ''.join(map(str,sk_n.mask))
-                        outfile = skviz_n.path / f"skeleton_{sk_n.uuid}_{sk_n.index}_{mask_str}.md"  
-                        SynTreeWriter(prefixer=SkeletonPrefixWriter()).write(mermaid_txt).to_file(outfile)
-                        if args.attn_weights:
-                            # mask = edge_input[1] == n
-                            mask = np.ones((len(edge_input[-1]),), dtype='bool')
-                            if sk.rxns[n]:                                
-                                attns = torch.stack([rxn_attns[layer][mask] for layer in range(len(rxn_attns))], dim=0).mean(axis=0)
-                            else:
-                                attns = torch.stack([bb_attns[layer][mask] for layer in range(len(bb_attns))], dim=0).mean(axis=0)
-                            attns = attns.mean(axis=-1)
-                            fpath = os.path.join(outfile.parent, f"{outfile.stem}.png")
-                            sk.visualize(fpath, attn=(edge_input[:, mask], attns), node_to_highlight=[n for n in sk.frontier_nodes if not sk.mask[n]])
-                            # one time hack to save the attn weights for later     
-                        print(f"Generated markdown file.", os.path.join(os.getcwd(), outfile))            
+                            attns = torch.stack([bb_attns[layer][mask] for layer in range(len(bb_attns))], dim=0).mean(axis=0)
+                        attns = attns.mean(axis=-1)
+                        fpath = os.path.join(outfile.parent, f"{outfile.stem}.png")
+                        sk.visualize(fpath, attn=(edge_input[:, mask], attns), node_to_highlight=[n for n in sk.frontier_nodes if not sk.mask[n]])
+                        # one time hack to save the attn weights for later     
+                    print(f"Generated markdown file.", os.path.join(os.getcwd(), outfile))            
 
         else:
             if args.mermaid:
@@ -844,6 +866,54 @@ def wrapper_decoder(args, sk, model_rxn, model_bb, bb_emb, rxn_templates, bblock
     return final_sks
 
 
+
+@torch.no_grad()
+def wrapper_decoder_batch(args, batch, bb_emb, rxn_templates, bblocks, bblock_inds=None):
+    """
+    wrapper_decoder for a list of (sk, model_rxn, model_bb), advancing all their beams in lockstep.
+    Each step runs every model once, on the Batch of the beams using it, instead of once per beam.
+    Returns the final beams of each input in the order wrapper_decoder returns them.
+    """
+    for _, model_rxn, model_bb in batch:
+        model_rxn.eval()
+        model_bb.eval()
+    fps = {}
+    beams = [(i, beam) for i, (sk, _, _) in enumerate(batch) for beam in init_beams(args, sk)]
+    final_sks = [[] for _ in batch]
+    while len(beams):
+        active = []
+        for i, beam in beams:
+            sk = beam[0] if isinstance(beam, tuple) else beam
+            if ((~sk.mask) & (sk.rxns | sk.leaves)).any():
+                active.append((i, beam))
+            else:
+                final_sks[i].append(sk)
+        groups = {}
+        for b, (i, _) in enumerate(active):
+            _, model_rxn, model_bb = batch[i]
+            groups.setdefault((id(model_rxn), id(model_bb)), []).append(b)
+        logits = [None for _ in active]
+        for bs in groups.values():
+            _, model_rxn, model_bb = batch[active[bs[0]][0]]
+            sks = [active[b][1][0] if isinstance(active[b][1], tuple) else active[b][1] for b in bs]
+            Xs = [decoder_features(sk, fps) for sk in sks]
+            data_rxn = Batch.from_data_list([decoder_data(sk, X, model_rxn) for sk, X in zip(sks, Xs)])
+            data_bb = Batch.from_data_list([decoder_data(sk, X, model_bb) for sk, X in zip(sks, Xs)])
+            logits_rxn = model_rxn(data_rxn)
+            logits_bb = model_bb(data_bb)
+            ptr = data_rxn.ptr.tolist()
+            for j, b in enumerate(bs):
+                logits[b] = (logits_rxn[ptr[j]:ptr[j+1]], logits_bb[ptr[j]:ptr[j+1]])
+        beams = []
+        for (i, beam), (logits_rxn, logits_bb) in zip(active, logits):
+            sk, next_node = beam if isinstance(beam, tuple) else (beam, None)
+            _, new_beams = expand_beam(args, sk, next_node, logits_rxn, logits_bb, bb_emb, rxn_templates, bblocks, bblock_inds=bblock_inds)
+            beams += [(i, new_beam) for new_beam in new_beams]
+    # every beam of an input fills the same number of nodes, so they finish on the same step
+    # and reversing the breadth-first order gives wrapper_decoder's depth-first one
+    return [sks[::-1] for sks in final_sks]
+
+
 def test_correct(sk, sk_true, rxns, method='preorder', forcing=False):
     if method == 'preorder':
         if forcing:
@@ -877,7 +947,7 @@ def test_correct(sk, sk_true, rxns, method='preorder', forcing=False):
 
         sk.reconstruct(rxns)
         smis = sk_true.tree.nodes[sk_true.tree_root]['smiles'].split(DELIM)
-        smis = [Chem.CanonSmiles(smi) for smi in smis]
+        smis = [canon_smiles(smi) for smi in smis]
         correct = smi2 in smis
     else:
         assert method == 'reconstruct'
@@ -887,7 +957,7 @@ def test_correct(sk, sk_true, rxns, method='preorder', forcing=False):
             if 'smiles' in sk.tree.nodes[n]:
                 if sk.tree.nodes[n]['smiles']:
                     smiles += sk.tree.nodes[n]['smiles'].split(DELIM)
-        smi2 = Chem.CanonSmiles(sk_true.tree.nodes[sk_true.tree_root]['smiles'])
+        smi2 = canon_smiles(sk_true.tree.nodes[sk_true.tree_root]['smiles'])
         sims = tanimoto_similarity(mol_fp(smi2, 2, 4096), smiles)
         correct = max(sims)
     return correct
@@ -908,7 +978,7 @@ def load_data(args, logger=None):
     rxn_templates = ReactionTemplateFileHandler().load(args.rxn_templates_file)    
 
     # # ... building blocks
-    bblocks = BuildingBlockFileHandler().load(args.building_blocks_file)
+    bblocks = BuildingBlockRegistry(BuildingBlockFileHandler().load(args.building_blocks_file))
     if args.top_bbs_file:
         bblock_inds = [bblocks.index(l.rstrip('\n')) for l in open(args.top_bbs_file).readlines()]
         globals()['bblock_inds'] = bblock_inds
@@ -927,16 +997,19 @@ def load_data(args, logger=None):
         logger.info(f"Successfully read {args.embeddings_knn_file}.")    
         logger.info("...loading data completed.")            
     # remember indices of bblocks
-    bb_index_lookup = dict(zip(bblocks, range(len(bblocks))))
+    compat = ReactantCompatibility.load(list(bblocks), rxn_templates)
     for i, r in tqdm(enumerate(rxns)):
-        bblock_mask = []
-        for j in range(len(r.available_reactants)):
-            mask = [False for _ in bblocks]            
-            for k in range(len(r.available_reactants[j])):
-                bb_index = bb_index_lookup[r.available_reactants[j][k]]
-                mask[bb_index] = True
-            bblock_mask.append(np.argwhere(mask).flatten())
+        if compat is not None and i < compat.n_rxns:
+            bblock_mask = [compat.indices(i, j) for j in range(len(r.available_reactants))]
+            # the collection may have been built from a filtered set of bblocks
+            if all(len(m) == len(a) for m, a in zip(bblock_mask, r.available_reactants)):
+                setattr(r, 'bblock_mask', bblock_mask)
+                continue
+        bblock_mask = [np.unique(ids).astype(np.int64) for ids in r.available_reactant_ids(bblocks)]
         setattr(r, 'bblock_mask', bblock_mask)
+    # normalized once, with the building blocks of each reactant slot gathered for fill_in
+    bb_index = EmbeddingIndex.open(bb_emb, quantize=getattr(args, 'bb_quantize', None))
+    bb_index.add_rxn_subsets(rxns)
     globals()['rxns'] = rxns
     globals()['rxn_templates'] = rxn_templates    
     globals()['bblocks'] = bblocks
@@ -1001,7 +1074,7 @@ def reconstruct(sk, smi):
     if isinstance(smi, np.ndarray):
         sims = tanimoto_similarity(smi, smiles)
     else:
-        smi2 = Chem.CanonSmiles(smi)
+        smi2 = canon_smiles(smi)
         sims = tanimoto_similarity(mol_fp(smi2, 2, 4096), smiles)
     correct = max(sims)                    
     best_smi = smiles[np.argmax(sims)]
@@ -0,0 +1,168 @@
+"""Local cost-aware task scheduler with a durable SQLite ledger, used by `scripts/build-hash-table.py`."""
+import logging
+import os
+import pickle
+import sqlite3
+import time
+from contextlib import closing
+
+import multiprocessing as mp
+from tqdm import tqdm
+
+logger = logging.getLogger('global_logger')
+
+
+class TaskLedger:
+    """Records, per job (e.g. `"2_run"`), each task's cost, status and where its result was saved.
+
+    Results are pickled to `result_dir/{job}/{task_id}.pkl` before the task is marked done,
+    so after a crash a job resumes with only the tasks that did not finish.
+    """
+
+    def __init__(self, db_path: str, result_dir: str):
+        self.db_path = db_path
+        self.result_dir = result_dir
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        con = sqlite3.connect(self.db_path, timeout=600)
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "job TEXT, task_id INTEGER, cost REAL, status TEXT, seconds REAL, result_path TEXT, "
+            "PRIMARY KEY (job, task_id))"
+        )
+        return con
+
+    def add(self, job: str, costs: list[float]):
+        """Registers tasks 0..len(costs)-1, tasks already in the ledger keep their status."""
+        with closing(self._connect()) as con, con:
+            (n,) = con.execute("SELECT COUNT(*) FROM tasks WHERE job = ?", (job,)).fetchone()
+            if n and n != len(costs):
+                raise ValueError(f"ledger has {n} tasks for {job}, got {len(costs)}")
+            con.executemany(
+                "INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, 'pending', NULL, NULL)",
+                [(job, i, float(c)) for i, c in enumerate(costs)],
+            )
+
+    def done(self, job: str) -> dict[int, str]:
+        with closing(self._connect()) as con:
+            rows = con.execute("SELECT task_id, result_path FROM tasks WHERE job = ? AND status = 'done'", (job,))
+            return {task_id: result_path for task_id, result_path in rows if os.path.exists(result_path)}
+
+    def save_result(self, job: str, task_id: int, result, seconds: float):
+        os.makedirs(os.path.join(self.result_dir, job), exist_ok=True)
+        result_path = os.path.join(self.result_dir, job, f"{task_id}.pkl")
+        with open(f"{result_path}.tmp", 'wb+') as f:
+            pickle.dump(result, f)
+        os.replace(f"{result_path}.tmp", result_path)
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "UPDATE tasks SET status = 'done', seconds = ?, result_path = ? WHERE job = ? AND task_id = ?",
+                (seconds, result_path, job, task_id),
+            )
+
+    def result_paths(self) -> list[str]:
+        """The saved results of every job, e.g. to keep the product maps they reference."""
+        with closing(self._connect()) as con:
+            rows = con.execute("SELECT result_path FROM tasks WHERE status = 'done'").fetchall()
+        return [result_path for (result_path,) in rows if os.path.exists(result_path)]
+
+    def load_result(self, result_path: str):
+        return pickle.load(open(result_path, 'rb'))
+
+    def summary(self, job: str) -> dict:
+        with closing(self._connect()) as con:
+            n, n_done, cost, cost_done, seconds = con.execute(
+                "SELECT COUNT(*), SUM(status = 'done'), SUM(cost), SUM(CASE WHEN status = 'done' THEN cost ELSE 0 END), "
+                "SUM(seconds) FROM tasks WHERE job = ?",
+                (job,),
+            ).fetchone()
+        return {"tasks": n, "done": n_done or 0, "cost": cost or 0, "cost_done": cost_done or 0, "task_seconds": seconds or 0}
+
+
+class Throughput:
+    """Tasks/s and cost/s since the job (re)started, logged at most every `log_every` seconds."""
+
+    def __init__(self, job: str, num_tasks: int, total_cost: float, log_every: float = 60):
+        self.job = job
+        self.num_tasks = num_tasks
+        self.total_cost = total_cost
+        self.log_every = log_every
+        self.start = self.last_log = time.time()
+        self.tasks = 0
+        self.cost = 0.0
+
+    def update(self, cost: float) -> dict:
+        self.tasks += 1
+        self.cost += cost
+        elapsed = max(time.time() - self.start, 1e-9)
+        stats = {"tasks/s": self.tasks / elapsed, "cost/s": self.cost / elapsed}
+        if time.time() - self.last_log >= self.log_every or self.tasks == self.num_tasks:
+            eta = (self.total_cost - self.cost) / max(stats["cost/s"], 1e-9)
+            logger.info(
+                f"{self.job}: {self.tasks}/{self.num_tasks} tasks, {self.cost:.3g}/{self.total_cost:.3g} cost, "
+                f"{stats['tasks/s']:.3g} tasks/s, {stats['cost/s']:.3g} cost/s, eta {eta:.0f}s"
+            )
+            self.last_log = time.time()
+        return stats
+
+
+def _init_worker(func):
+    globals()["task_func"] = func
+
+
+def _run_task(item):
+    task_id, task = item
+    start = time.time()
+    return task_id, task_func(task), time.time() - start
+
+
+def run_tasks(
+    func,
+    tasks: list,
+    costs: list[float],
+    ledger: TaskLedger,
+    job: str,
+    processes: int = 1,
+    serial_cost: float = float("inf"),
+    log_every: float = 60,
+) -> list:
+    """Runs `func(task)` for every task and returns the results in task order.
+
+    Tasks are handed out most expensive first from the pool's shared queue, so idle workers
+    keep taking the next task and cheap tasks fill in at the end instead of waiting for a fixed batch.
+    Tasks costing more than `serial_cost` run afterwards in this process, as they parallelize
+    internally (e.g. `Program.run_rxn_tree`) and pool workers cannot start pools of their own.
+    """
+    assert len(tasks) == len(costs)
+    ledger.add(job, costs)
+    done = ledger.done(job)
+    results = [None for _ in tasks]
+    for task_id, result_path in done.items():
+        results[task_id] = ledger.load_result(result_path)
+    todo = sorted((i for i in range(len(tasks)) if i not in done), key=lambda i: -costs[i])
+    pooled = [i for i in todo if costs[i] <= serial_cost]
+    serial = [i for i in todo if costs[i] > serial_cost]
+    logger.info(f"{job}: {len(done)} tasks done, running {len(pooled)} pooled and {len(serial)} serial tasks")
+
+    throughput = Throughput(job, len(todo), sum(costs[i] for i in todo), log_every=log_every)
+    pbar = tqdm(total=len(todo), desc=job)
+
+    def finish(task_id, result, seconds):
+        ledger.save_result(job, task_id, result, seconds)
+        results[task_id] = result
+        pbar.set_postfix(throughput.update(costs[task_id]))
+        pbar.update()
+
+    if pooled and processes > 1:
+        with mp.Pool(processes, initializer=_init_worker, initargs=(func,)) as pool:
+            for task_id, result, seconds in pool.imap_unordered(_run_task, ((i, tasks[i]) for i in pooled), chunksize=1):
+                finish(task_id, result, seconds)
+    else:
+        serial = pooled + serial
+    _init_worker(func)
+    for i in serial:
+        finish(*_run_task((i, tasks[i])))
+    pbar.close()
+    logger.info(f"{job}: {ledger.summary(job)}")
+    return results
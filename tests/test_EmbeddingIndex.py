@@ -0,0 +1,79 @@
+"""
+Unit tests for the cosine nearest-neighbour search over building-block embeddings.
+"""
+import unittest
+from types import SimpleNamespace
+import numpy as np
+
+try:
+    import torch
+    from synnet.utils.embedding_index import EmbeddingIndex
+except ImportError:
+    torch = None
+
+
+def nn_search_list(y, X, top_k=1):
+    """
+    The search EmbeddingIndex replaced (synnet.models.mlp.nn_search_list): index of the top_k-th most cosine-similar row.
+    """
+    sims = (y @ X.T) / (torch.norm(y, dim=-1)[:, None] @ torch.norm(X, dim=-1)[None])
+    return torch.kthvalue(sims, sims.shape[-1]+1-top_k, dim=-1, keepdim=True).indices
+
+
+@unittest.skipIf(torch is None, "requires torch")
+class TestEmbeddingIndex(unittest.TestCase):
+    """
+    Tests the float search and reaction subsets against nn_search_list, and the recall of the quantized indexes.
+    """
+    def setUp(self):
+        torch.manual_seed(137)
+        self.X = torch.randn(500, 128)
+        self.targets = torch.randint(len(self.X), (64,))
+        # predicted embeddings are close to a building block's
+        self.y = self.X[self.targets] + 0.1 * torch.randn(len(self.targets), self.X.shape[1])
+
+    def test_search(self):
+        """
+        Tests the top-k of the float index, best first, against the k nn_search_list calls.
+        """
+        k = 5
+        index = EmbeddingIndex(self.X)
+        scores, inds = index.search(self.y, k)
+        self.assertEqual(tuple(inds.shape), (len(self.y), k))
+        for j in range(k):
+            self.assertTrue(torch.equal(inds[:, j:j+1], nn_search_list(self.y, self.X, top_k=j+1)))
+        self.assertTrue((scores[:, :-1] >= scores[:, 1:]).all())
+        self.assertTrue(torch.equal(index.search(self.y[0], 1)[1], nn_search_list(self.y[:1], self.X)))
+
+    def test_rxn_subsets(self):
+        """
+        Tests searching the building blocks of a reaction slot, registered by add_rxn_subsets.
+        """
+        rng = np.random.default_rng(137)
+        rxns = [
+            SimpleNamespace(bblock_mask=[np.sort(rng.choice(len(self.X), size, replace=False)) for size in sizes])
+            for sizes in [(40,), (7, 120)]
+        ]
+        index = EmbeddingIndex(self.X)
+        index.add_rxn_subsets(rxns)
+        for i, rxn in enumerate(rxns):
+            for slot, bbs in enumerate(rxn.bblock_mask):
+                bbs = torch.as_tensor(bbs)
+                _, inds = index.search(self.y, 3, subset=(i, slot))
+                for j in range(3):
+                    self.assertTrue(torch.equal(inds[:, j:j+1], bbs[nn_search_list(self.y, self.X[bbs], top_k=j+1)]))
+                # same as passing the indices
+                self.assertTrue(torch.equal(index.search(self.y, 3, subset=bbs)[1], inds))
+
+    def test_quantized_recall(self):
+        """
+        Tests that the int8 and binary indexes still find the building block each prediction is close to.
+        """
+        for quantize in ["int8", "binary"]:
+            _, inds = EmbeddingIndex(self.X, quantize=quantize).search(self.y, 1)
+            recall = (inds[:, 0] == self.targets).float().mean().item()
+            self.assertGreaterEqual(recall, 0.95, quantize)
+
+
+if __name__ == '__main__':
+    unittest.main()
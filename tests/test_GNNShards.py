@@ -0,0 +1,116 @@
+"""
+Unit tests for the bit-packed, mmapped GNN feature shards.
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from synnet.config import NUM_POSS
+from synnet.utils.gnn_shards import FingerprintTable, GNNShards
+
+
+def random_batch(rng, num_samples, n=5, nbits=16, y_dim=24):
+    """
+    A batch laid out like Skeleton.get_state: per node [node fp | target fp | rxn one-hot], filled at masked nodes,
+    fingerprints drawn from a small pool so samples share them.
+    """
+    pool = rng.integers(0, 2, size=(6, nbits))
+    node_masks = rng.integers(0, 2, size=(num_samples, n))
+    X = np.zeros((num_samples, n, 2 * nbits + NUM_POSS), dtype=np.float32)
+    for s in range(num_samples):
+        target = pool[rng.integers(len(pool))]
+        for j in np.flatnonzero(node_masks[s]):
+            if rng.random() < 0.5:
+                X[s, j, :nbits] = pool[rng.integers(len(pool))]
+            else:
+                X[s, j, 2 * nbits + rng.integers(NUM_POSS)] = 1
+            X[s, j, nbits : 2 * nbits] = target
+    y = rng.integers(0, 2, size=(num_samples, n, y_dim)).astype(np.float32)
+    smiles = np.array(["C" * (s + 1) + "O" for s in range(num_samples)])
+    return node_masks, X.reshape(num_samples * n, -1), y.reshape(num_samples * n, -1), smiles
+
+
+class TestGNNShards(unittest.TestCase):
+    """
+    Tests that write() then reading the shards gives back the batch, densely and as fingerprint ids.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(137)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def assert_round_trip(self, shards, node_masks, X, y, smiles):
+        n = node_masks.shape[1]
+        self.assertEqual(len(shards), len(node_masks))
+        for i in range(len(shards)):
+            node_mask, X_i, y_i, smi = shards[i]
+            np.testing.assert_array_equal(node_mask, node_masks[i])
+            np.testing.assert_array_equal(X_i, X[i * n : (i + 1) * n])
+            np.testing.assert_array_equal(y_i, y[i * n : (i + 1) * n])
+            self.assertEqual(smi, smiles[i])
+        np.testing.assert_array_equal(shards.node_masks(), node_masks)
+        node_masks_all, X_all, y_all, smiles_all = shards.load()
+        np.testing.assert_array_equal(X_all.reshape(X.shape), X)
+        np.testing.assert_array_equal(y_all.reshape(y.shape), y)
+        self.assertEqual(list(smiles_all), list(smiles))
+
+    def test_dense(self):
+        """
+        Tests the bit-packed X over several shards, also after pickling (as for DataLoader workers).
+        """
+        batch = random_batch(self.rng, 23)
+        base = os.path.join(self.root, "1_0")
+        self.assertEqual(GNNShards.write(base, *batch, shard_size=10), 3)
+        shards = pickle.loads(pickle.dumps(GNNShards(base)))
+        self.assertFalse(shards.has_fp_ids)
+        self.assert_round_trip(shards, *batch)
+
+    def test_fp_ids(self):
+        """
+        Tests fingerprint-id shards, and that a FingerprintTable of several batches rebuilds their features.
+        """
+        bases = [os.path.join(self.root, f"1_{k}") for k in range(2)]
+        batches = [random_batch(self.rng, 17), random_batch(self.rng, 9)]
+        for base, batch in zip(bases, batches):
+            GNNShards.write(base, *batch, shard_size=8, fp_ids=True)
+            shards = GNNShards(base)
+            self.assertTrue(shards.has_fp_ids)
+            self.assertNotIn("X", shards.shard(0))
+            self.assert_round_trip(shards, *batch)
+
+        table = FingerprintTable(bases)
+        for base, (node_masks, X, _, _) in zip(bases, batches):
+            shards = GNNShards(base)
+            n, x_dim = shards.dims[:2]
+            nbits = (x_dim - NUM_POSS) // 2
+            for i in range(len(shards)):
+                fp_ids, target_id, rxn_ids = shards.ids(i)
+                X_i = GNNShards.ids_to_X(
+                    table.fps, fp_ids + table.offsets[base], target_id + table.offsets[base], rxn_ids, node_masks[i], nbits
+                )
+                np.testing.assert_array_equal(X_i, X[i * n : (i + 1) * n])
+
+    def test_fp_ids_invalid(self):
+        """
+        Tests that features not laid out like Skeleton.get_state are rejected, keeping the previous shards,
+        and that a FingerprintTable refuses dense batches.
+        """
+        base = os.path.join(self.root, "1_0")
+        batch = random_batch(self.rng, 5)
+        GNNShards.write(base, *batch)
+        node_masks, X, y, smiles = batch
+        X = X.copy()
+        X[0, -2:] = 1 # two reactions at one node
+        with self.assertRaises(ValueError):
+            GNNShards.write(base, node_masks, X, y, smiles, fp_ids=True)
+        self.assert_round_trip(GNNShards(base), *batch)
+        with self.assertRaises(ValueError):
+            FingerprintTable([base])
+
+
+if __name__ == '__main__':
+    unittest.main()
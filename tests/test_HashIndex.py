@@ -0,0 +1,71 @@
+"""
+Unit tests for the compact index of a hash directory.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from synnet.config import DELIM
+from synnet.utils.data_utils import BuildingBlockRegistry
+from synnet.utils.hash_index import HashIndex
+
+BUILDING_BLOCKS = ["CCO", "CC#N", "N#Cc1ccccc1", "CC(=O)Cl", "OCCO"]
+FILES = {
+    "a1.json": {"bbs": {"0": [["CCO", "OCCO"], ["CC(=O)Cl"]]}},
+    "b2.json": {"bbs": {"1": [["CC#N", "N#Cc1ccccc1"]], f"0{DELIM}1": [["CCO"]]}},
+    os.path.join("b2", "c3.json"): {"bbs": {"2": [["OCCO"], ["CC#N", "CCO"]]}},
+    "d4.json": {"bbs": {}},
+}
+
+
+class TestHashIndex(unittest.TestCase):
+    """
+    Tests that lookups through index.npz match the os.path.exists / json.load fallback.
+    """
+    def setUp(self):
+        self.hash_dir = tempfile.mkdtemp()
+        for name, data in FILES.items():
+            os.makedirs(os.path.dirname(os.path.join(self.hash_dir, name)), exist_ok=True)
+            json.dump(data, open(os.path.join(self.hash_dir, name), 'w'))
+        self.paths = [os.path.join(self.hash_dir, name) for name in FILES]
+        self.missing = os.path.join(self.hash_dir, "e5.json")
+        self.slots = [
+            (self.paths[0], 0, 0), (self.paths[0], 0, 1), (self.paths[1], 1, 0),
+            (self.paths[1], 0, 1), (self.paths[2], 2, 0), (self.paths[2], 2, 1),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.hash_dir)
+
+    def test_lookups(self):
+        """
+        Tests exists() and bbs() (as SMILES and as registry ids) before and after building the index.
+        """
+        registry = BuildingBlockRegistry(BUILDING_BLOCKS)
+        queries = self.paths + [self.missing, '']
+        fallback = HashIndex.open(self.hash_dir)
+        self.assertFalse(fallback.indexed)
+        exists = fallback.exists(queries)
+        self.assertEqual(exists.tolist(), [True] * len(self.paths) + [False, False])
+        smis = [fallback.bbs(*slot).tolist() for slot in self.slots]
+        ids = [fallback.bbs(*slot, registry=registry).tolist() for slot in self.slots]
+
+        self.assertEqual(HashIndex.build(self.hash_dir), len(FILES))
+        index = HashIndex.open(self.hash_dir)
+        self.assertIsNot(index, fallback)
+        self.assertTrue(index.indexed)
+        np.testing.assert_array_equal(index.exists(queries), exists)
+        self.assertEqual([index.bbs(*slot).tolist() for slot in self.slots], smis)
+        self.assertEqual([index.bbs(*slot, registry=registry).tolist() for slot in self.slots], ids)
+        self.assertEqual(smis[0], ["CCO", "OCCO"])
+        self.assertEqual(ids[3], [0])
+        with self.assertRaises(FileNotFoundError):
+            index.bbs(self.missing, 0, 0)
+        with self.assertRaises(KeyError):
+            index.bbs(self.paths[3], 0, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
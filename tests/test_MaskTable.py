@@ -0,0 +1,75 @@
+"""
+Unit tests for the per-class tables of valid masks.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from synnet.utils.data_utils import Skeleton, inds_to_masks, valid_mask_inds
+from synnet.utils.mask_tables import MaskTable
+from tests.test_Skeleton import example_trees
+
+CRITERIA = ['rxn_target_down', 'rxn_target_down_bb', 'all_leaves', 'leaf_up_2', 'bfs']
+
+
+class TestMaskTable(unittest.TestCase):
+    """
+    Tests the tables against valid_mask_inds / inds_to_masks, saving them and keying them on the topology.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.skeleton_file = os.path.join(self.root, "skeletons.pkl")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def assert_matches(self, table, sk, min_r_set, criterion):
+        inds = np.sort(valid_mask_inds(sk, min_r_set, criterion))
+        np.testing.assert_array_equal(table.inds(sk, min_r_set, criterion), inds)
+        masks = inds_to_masks(inds, len(sk.tree), min_r_set)
+        np.testing.assert_array_equal(
+            np.sort(MaskTable.to_bitmasks(table.masks(sk, min_r_set, criterion))), np.sort(MaskTable.to_bitmasks(masks))
+        )
+        self.assertTrue(table.contains(sk, min_r_set, criterion, masks).all())
+
+    def test_masks(self):
+        """
+        Tests every criterion on a few topologies, before and after a save, with one or more anchors.
+        """
+        table = MaskTable(MaskTable.path(self.skeleton_file))
+        cases = []
+        for index, st in enumerate(example_trees()):
+            sk = Skeleton(st, index)
+            for min_r_set in [[sk.tree_root], [sk.tree_root, 0]]:
+                for criterion in CRITERIA:
+                    self.assert_matches(table, sk, min_r_set, criterion)
+                    cases.append((sk, min_r_set, criterion))
+        self.assertEqual(table.unsaved, len(cases))
+        table.save()
+        self.assertEqual(table.unsaved, 0)
+        reopened = MaskTable(MaskTable.path(self.skeleton_file))
+        for sk, min_r_set, criterion in cases:
+            self.assert_matches(reopened, sk, min_r_set, criterion)
+        self.assertEqual(reopened.unsaved, 0)
+
+    def test_topology(self):
+        """
+        Tests that a class index whose saved table was computed for another topology is computed again.
+        """
+        first, second = list(example_trees())[:2]
+        table = MaskTable(MaskTable.path(self.skeleton_file))
+        sk = Skeleton(first, 0)
+        table.bitmasks(sk, [sk.tree_root], 'rxn_target_down')
+        table.save()
+        moved = Skeleton(second, 0) # e.g. the skeleton file was regenerated and the classes renumbered
+        self.assertNotEqual(MaskTable.topology(sk), MaskTable.topology(moved))
+        reopened = MaskTable(MaskTable.path(self.skeleton_file))
+        self.assert_matches(reopened, moved, [moved.tree_root], 'rxn_target_down')
+        self.assertEqual(reopened.unsaved, 1)
+        self.assert_matches(reopened, sk, [sk.tree_root], 'rxn_target_down')
+        self.assertEqual(reopened.unsaved, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
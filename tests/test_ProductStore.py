@@ -0,0 +1,78 @@
+"""
+Unit tests for the ref-counted, content-addressed product store.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import networkx as nx
+from synnet.utils.data_utils import Program, ProductMapLink, ProductStore
+from synnet.utils.program_catalog import ProgramCatalog
+
+
+def write_text(text, fpath):
+    with open(fpath, 'w') as f:
+        f.write(text)
+
+
+def linked_program(fpaths):
+    """
+    A depth-1 program whose product map links to fpaths, as after Program.migrate.
+    """
+    tree = nx.DiGraph()
+    tree.add_node(0, rxn_id=0, depth=1)
+    p = Program(tree)
+    p.keep_prods = 1
+    p.product_map = ProductMapLink(dict(enumerate(fpaths)))
+    return p
+
+
+class TestProductStore(unittest.TestCase):
+    """
+    Tests that put() deduplicates and counts references, and sweep() removes exactly the unreferenced files.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ProductStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def stored_files(self):
+        return sorted(f for f in os.listdir(self.root) if f.endswith(".json"))
+
+    def test_put_and_sweep(self):
+        """
+        Tests that identical maps share one file, and that dropping one map's reference only sweeps its file.
+        """
+        a = self.store.put(write_text, '{"a": 1}', "json")
+        self.assertEqual(self.store.put(write_text, '{"a": 1}', "json"), a)
+        b = self.store.put(write_text, '{"b": 2}', "json")
+        self.assertEqual(self.store.count(a), 2)
+        self.assertEqual(self.store.count(b), 1)
+        self.assertEqual(self.stored_files(), sorted([os.path.basename(a), os.path.basename(b)]))
+
+        self.store.decref([b])
+        self.assertEqual(self.store.sweep(), 1)
+        self.assertFalse(os.path.exists(b))
+        self.assertTrue(os.path.exists(a))
+        self.assertEqual(self.store.count(a), 2)
+        self.assertEqual(self.store.sweep(), 0)
+
+    def test_recount_catalog(self):
+        """
+        Tests that recounting over the cataloged programs keeps their files and sweeps the rest.
+        """
+        a, b, c = [self.store.put(write_text, f'{{"{k}": 0}}', "json") for k in "abc"]
+        catalog = ProgramCatalog(os.path.join(self.root, "programs.db"))
+        catalog.add("run", 1, [linked_program([a]), linked_program([a, b])])
+        self.store.recount(catalog.files())
+        self.assertEqual(self.store.count(a), 2)
+        self.assertEqual(self.store.count(b), 1)
+        self.assertEqual(self.store.count(c), 0)
+        self.assertEqual(self.store.sweep(), 1)
+        self.assertEqual(self.stored_files(), sorted([os.path.basename(a), os.path.basename(b)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
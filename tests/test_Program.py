@@ -0,0 +1,169 @@
+"""
+Unit tests for the vectorized reactant bookkeeping and the hashing of the Program class.
+"""
+import hashlib
+import json
+import unittest
+from copy import copy, deepcopy
+from types import SimpleNamespace
+import networkx as nx
+import numpy as np
+from synnet.utils.data_utils import Program
+
+
+def random_rxn_map(rng, num_rxns=4, max_reactants=5):
+    """
+    Stand-ins for Reaction with only available_reactants, half of them bimolecular.
+    """
+    rxn_map = {}
+    for r in range(num_rxns):
+        num_reactant = 1 + r % 2
+        rxn_map[r] = SimpleNamespace(available_reactants=tuple(
+            [f"R{r}_{k}_{i}" for i in range(rng.integers(1, max_reactants+1))] for k in range(num_reactant)
+        ))
+    return rxn_map
+
+
+def reference_reindex(entries, all_reactant_counts, rxn_map):
+    """
+    The former re-indexing loop of init_rxns/run_rxn_tree: [0, 0, 1, 0, 1, 0, 1] -> [-1, -1, 0, -1, 1, -1, 2],
+    appending each used reactant to a fresh list in a copy of rxn_map.
+    """
+    all_reactant_indices = [[list(idxes) for idxes in e] for e in all_reactant_counts]
+    new_rxn_map = deepcopy(rxn_map)
+    for i, e in enumerate(entries):
+        if isinstance(e, tuple):
+            e, idx = e
+            reactant_indices = [idx]
+        else:
+            reactant_indices = range(len(all_reactant_indices[i]))
+        available_reactants = list(new_rxn_map[e].available_reactants)
+        for j in reactant_indices:
+            available_reactants[j] = []
+        new_rxn_map[e].available_reactants = tuple(available_reactants)
+        for idx, j in enumerate(reactant_indices):
+            c = 0
+            idxes = all_reactant_indices[i][idx]
+            for k in range(len(idxes)):
+                if idxes[k]:
+                    new_rxn_map[e].available_reactants[j].append(rxn_map[e].available_reactants[j][k])
+                    idxes[k] = c
+                    c += 1
+                else:
+                    idxes[k] = -1
+    return all_reactant_indices, new_rxn_map
+
+
+def random_rxn_tree(rng, n):
+    """
+    A random binary tree of reaction nodes rooted at n-1, with the attributes of Program.rxn_tree
+    and some that hash() ignores. rxn_id is -1 (unfilled) for some nodes, and rxn_id_forcing is set for some.
+    Nodes are added root first, or in id order like most callers do.
+    """
+    tree = nx.DiGraph()
+    tree.add_node(n-1, depth=1)
+    for i in range(n-2, -1, -1):
+        parents = [j for j in tree if tree.out_degree(j) < 2]
+        parent = parents[rng.integers(len(parents))]
+        tree.add_node(i, depth=tree.nodes[parent]['depth']+1, child='left' if tree.out_degree(parent) == 0 else 'right')
+        tree.add_edge(parent, i)
+    for i in tree:
+        tree.nodes[i]['rxn_id'] = int(rng.integers(-1, 91))
+        tree.nodes[i]['smiles'] = 'CCO'
+        if rng.random() < 0.3:
+            tree.nodes[i]['rxn_id_forcing'] = int(rng.integers(-1, 91))
+    if rng.random() < 0.5:
+        sorted_tree = nx.DiGraph()
+        sorted_tree.add_nodes_from(sorted(tree.nodes(data=True)))
+        sorted_tree.add_edges_from(tree.edges)
+        tree = sorted_tree
+    return tree
+
+
+def reference_hash(tree, mask, attrs=('rxn_id', 'depth', 'child')):
+    """
+    The former Program.hash: md5 of the sorted json of a copy of the tree with only attrs, and no rxn_id outside mask.
+    """
+    tree = deepcopy(tree)
+    for n in tree:
+        for k in list(tree.nodes[n]):
+            if k not in attrs or (k == 'rxn_id' and not mask[n]):
+                tree.nodes[n].pop(k)
+    json_data = nx.tree_data(tree, len(tree)-1)
+    return hashlib.md5(json.dumps(json_data, sort_keys=True).encode()).hexdigest()
+
+
+def example_entries():
+    """
+    Entries as in Program.entries: whole reactions, or (rxn, reactant index) for one slot of a bimolecular reaction.
+    """
+    return [[0], [1], [0, 1], [(1, 0), 2], [3, (1, 1), 0], [(3, 0), (1, 1)]]
+
+
+class TestProgram(unittest.TestCase):
+    """
+    Tests the vectorized Program helpers against their per-index / per-reactant originals.
+    """
+    def test_infer_product_indices(self):
+        """
+        Tests infer_product_indices against infer_product_index(..., return_idx=True) on every combination index.
+        """
+        rng = np.random.default_rng(137)
+        for _ in range(5):
+            rxn_map = random_rxn_map(rng)
+            for entries in example_entries():
+                radices = Program.entry_radices(entries, rxn_map)
+                interm_counts = [
+                    int(np.prod([radix for j, _, radix in radices if j == e])) for e in range(len(entries))
+                ]
+                count = int(np.prod(interm_counts))
+                entry_indices = Program.infer_product_indices(np.arange(count), entries, rxn_map)
+                for i in range(count):
+                    ref = Program.infer_product_index(i, interm_counts, entries, rxn_map, return_idx=True)
+                    self.assertEqual([[int(idx[i]) for idx in idxes] for idxes in entry_indices], ref)
+
+    def test_reindex_reactants(self):
+        """
+        Tests reindex_reactants against re-indexing by appending one used reactant at a time,
+        into a copy of the rxn_map (run_rxn_tree) and in place (init_rxns).
+        """
+        rng = np.random.default_rng(137)
+        for _ in range(5):
+            rxn_map = random_rxn_map(rng)
+            for entries in example_entries():
+                radices = Program.entry_radices(entries, rxn_map)
+                counts = [[] for _ in entries]
+                for j, _, radix in radices:
+                    counts[j].append(rng.integers(0, 3, size=radix) * rng.integers(0, 2, size=radix))
+                ref_indices, ref_map = reference_reindex(entries, counts, rxn_map)
+                copied_map = {n: copy(rxn) for n, rxn in rxn_map.items()}
+                in_place_map = deepcopy(rxn_map)
+                for old_rxn_map, new_rxn_map in [(rxn_map, copied_map), (in_place_map, in_place_map)]:
+                    all_reactant_indices = deepcopy(counts)
+                    Program.reindex_reactants(entries, all_reactant_indices, old_rxn_map, new_rxn_map)
+                    self.assertEqual([[idxes.tolist() for idxes in e] for e in all_reactant_indices], ref_indices)
+                    for n in rxn_map:
+                        self.assertEqual(list(new_rxn_map[n].available_reactants), list(ref_map[n].available_reactants))
+
+    def test_hash(self):
+        """
+        Tests hash() and get_paths() against md5-ing the json of a stripped copy of the tree, as hash() did before.
+        """
+        rng = np.random.default_rng(137)
+        for _ in range(300):
+            tree = random_rxn_tree(rng, int(rng.integers(1, 7)))
+            p = Program(tree)
+            mask = (rng.random(len(tree)) < 0.5).tolist()
+            self.assertEqual(p.hash(mask), reference_hash(tree, mask))
+            node = int(rng.integers(len(tree)))
+            rxn_ids = [-1] + rng.integers(0, 91, size=5).tolist()
+            got = p.get_paths(node, rxn_ids)
+            paths = []
+            for rxn_id in rxn_ids:
+                tree.nodes[node]['rxn_id'] = rxn_id
+                paths.append(f"{reference_hash(tree, Program(tree).path_mask())}.json")
+            self.assertEqual(got, paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+Unit tests for the SQLite catalog of enumerated programs.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import networkx as nx
+from synnet.utils.data_utils import Program, ProductMapLink, Reaction
+from synnet.utils.program_catalog import ProgramCatalog
+
+TEMPLATE = "[CH0;$(C-[#6]):1]#[NH0:2]>>[C:1]1=[N:2]-N-N=N-1"
+BUILDING_BLOCKS = ["CC#N", "N#Cc1ccccc1", "CCO", "CC(=O)Cl"]
+
+
+def fingerprint(code):
+    """
+    As get_fingerprint in build-hash-table.py, the stamp of a stage includes the code version.
+    """
+    return Program.hash_json({"bblocks": BUILDING_BLOCKS, "code": code})
+
+
+class TestProgramCatalog(unittest.TestCase):
+    """
+    Tests storing programs by stage as build-hash-table's save_stage/load_stage do.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.catalog = ProgramCatalog(os.path.join(self.root, "programs.db"))
+        self.fpaths = []
+        for k in range(3):
+            fpath = os.path.join(self.root, f"{k}.json")
+            open(fpath, 'w').close()
+            self.fpaths.append(fpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def programs(self):
+        rxn = Reaction(template=TEMPLATE)
+        rxn.set_available_reactants(BUILDING_BLOCKS)
+        progs = []
+        for fpaths in [self.fpaths[:1], self.fpaths[1:]]:
+            tree = nx.DiGraph()
+            tree.add_node(0, rxn_id=0, depth=1)
+            p = Program(tree)
+            p.rxn_map = {0: rxn}
+            p.keep_prods = 1
+            p.product_map = ProductMapLink(dict(enumerate(fpaths)))
+            progs.append(p)
+        return progs
+
+    def test_round_trip(self):
+        """
+        Tests that cataloged programs load back with their tree, reactions and product map files.
+        """
+        progs = self.programs()
+        self.catalog.add("run", 1, progs, fingerprint=fingerprint(Program.code_version()))
+        self.assertTrue(self.catalog.has("run", 1, fingerprint(Program.code_version())))
+        self.assertEqual(self.catalog.stages(), [("run", 1)])
+        loaded = self.catalog.programs("run", 1)
+        self.assertEqual(len(loaded), len(progs))
+        for p, q in zip(progs, loaded):
+            self.assertEqual(nx.tree_data(q.rxn_tree, 0), nx.tree_data(p.rxn_tree, 0))
+            self.assertEqual(q.rxn_map[0].available_reactants, p.rxn_map[0].available_reactants)
+            self.assertEqual(q.product_map.files(), p.product_map.files())
+        self.assertEqual(loaded.files(), self.fpaths)
+        self.assertEqual(self.catalog.files(), self.fpaths)
+        self.assertEqual(loaded.input_lengths().tolist(), [float(Program.input_length(p)) for p in progs])
+        self.assertEqual(loaded[1:].files(), self.fpaths[1:])
+
+    def test_code_version(self):
+        """
+        Tests that rows written by another code version are stale, and replaced when the stage is cataloged again.
+        """
+        self.catalog.add("run", 1, self.programs(), fingerprint=fingerprint("older code version"))
+        self.assertFalse(self.catalog.has("run", 1, fingerprint(Program.code_version())))
+        self.catalog.add("run", 1, self.programs()[:1], fingerprint=fingerprint(Program.code_version()))
+        self.assertTrue(self.catalog.has("run", 1, fingerprint(Program.code_version())))
+        self.assertEqual(len(self.catalog.programs("run", 1)), 1)
+        self.assertEqual(self.catalog.files(), self.fpaths[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
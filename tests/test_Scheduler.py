@@ -0,0 +1,69 @@
+"""
+Unit tests for resuming jobs from the task ledger.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from synnet.utils.scheduler import TaskLedger, run_tasks
+
+CALLS = []
+
+
+def square(x):
+    CALLS.append(x)
+    return x * x
+
+
+class TestTaskLedger(unittest.TestCase):
+    """
+    Tests that a reopened ledger only re-issues the tasks that did not finish.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        CALLS.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def ledger(self):
+        return TaskLedger(os.path.join(self.root, "tasks.db"), os.path.join(self.root, "tasks"))
+
+    def test_resume(self):
+        """
+        Tests that after some tasks are done, run_tasks on a reopened ledger only runs the pending ones,
+        and that a job with a new fingerprint suffix (see run_local in build-hash-table.py) runs everything.
+        """
+        tasks = list(range(6))
+        costs = [1, 5, 2, 4, 3, 6]
+        job = "2_run_0123abcd"
+        ledger = self.ledger()
+        ledger.add(job, costs)
+        for task_id in [1, 4]:
+            ledger.save_result(job, task_id, square(tasks[task_id]), 0.1)
+        CALLS.clear()
+
+        results = run_tasks(square, tasks, costs, self.ledger(), job)
+        self.assertEqual(results, [x * x for x in tasks])
+        self.assertEqual(sorted(CALLS), [0, 2, 3, 5])
+        self.assertEqual(self.ledger().summary(job)["done"], len(tasks))
+
+        CALLS.clear()
+        self.assertEqual(run_tasks(square, tasks, costs, self.ledger(), job), [x * x for x in tasks])
+        self.assertEqual(CALLS, [])
+
+        self.assertEqual(run_tasks(square, tasks, costs, self.ledger(), "2_run_4567ef01"), [x * x for x in tasks])
+        self.assertEqual(sorted(CALLS), tasks)
+
+    def test_changed_tasks(self):
+        """
+        Tests that a job cannot be resumed with a different number of tasks.
+        """
+        ledger = self.ledger()
+        ledger.add("1_init_0123abcd", [1, 2, 3])
+        with self.assertRaises(ValueError):
+            self.ledger().add("1_init_0123abcd", [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Unit tests for the vectorized mask criteria of the Skeleton class.
+"""
+import unittest
+import numpy as np
+from synnet.utils.data_utils import SyntheticTree, Skeleton, inds_to_masks, inds_to_i, get_bool_mask
+
+
+def reference_criteria(sk):
+    """
+    The criteria as the Skeleton.mask setter computed them node by node, before Skeleton.criteria.
+    """
+    res = {}
+    mask = sk.mask
+    src = mask[sk.non_root_tree_edges[0]]
+    dest = mask[sk.non_root_tree_edges[1]]
+    res['leaves_up'] = not (src > dest).any()
+    res['all_leaves'] = mask[sk.leaves].all()
+    non_mask_rxns = ~(mask == 1) & sk.rxns
+    src_in_mask = mask[sk.bidir_edges.T[:, 0]]
+    frontier_nodes = sk.bidir_edges.T[src_in_mask == 1][:, 1]
+    res['rxn_frontier'] = non_mask_rxns[frontier_nodes].any()
+    res['bb_frontier'] = mask.sum() < len(mask)
+    src = mask[sk.tree_edges[0]]
+    dest = mask[sk.tree_edges[1]]
+    res['target_down'] = (src >= dest).all()
+    non_target_interms = (mask & ~sk.rxns)
+    non_target_interms[sk.tree_root] = 0
+    rxn_target_down = not non_target_interms.any()
+    non_target_interms[sk.leaves] = 0
+    rxn_target_down_bb = not non_target_interms.any()
+    rxn_target_down_interm = not non_target_interms.any()
+    for n in np.argwhere((mask & sk.rxns)).flatten().tolist():
+        if sk.pred(n) == sk.tree_root: continue
+        parent_rxn = sk.pred(sk.pred(n))
+        if not (mask & sk.rxns)[parent_rxn]:
+            rxn_target_down = rxn_target_down_bb = rxn_target_down_interm = False
+    interm_or_bb = ~sk.rxns
+    interm_or_bb[sk.tree_root] = 0
+    for n in np.argwhere((mask & interm_or_bb)).flatten().tolist():
+        if not mask[sk.pred(n)]:
+            if sk.leaves[n]:
+                rxn_target_down_bb = False
+            rxn_target_down_interm = False
+    res['rxn_target_down'] = rxn_target_down
+    res['rxn_target_down_bb'] = rxn_target_down_bb
+    res['rxn_target_down_interm'] = rxn_target_down_interm
+    mask_inds = np.argwhere(mask).flatten().tolist()
+    res['leaf_up_2'] = mask_inds == sk.correct_bottom_2_mask
+    res['bfs'] = sorted(mask_inds) == sorted(sk.correct_bfs_mask[:len(mask_inds)])
+    return res
+
+
+def example_trees():
+    """
+    A linear tree with a bimolecular step, and two trees with a bimolecular step joining two branches.
+    """
+    st = SyntheticTree()
+    st.update(0, 3, 'CCO', 'CC(=O)O', 'CCOC(C)=O')
+    st.update(1, 4, 'CCOC(C)=O', 'CCN', 'CCNC(C)=O')
+    st.update(1, 5, 'CCNC(C)=O', None, 'CCNC(C)O')
+    st.update(3, None, None, None, None)
+    yield st
+    st = SyntheticTree()
+    st.update(0, 3, 'CCO', 'CC(=O)O', 'CCOC(C)=O')
+    st.update(0, 5, 'c1ccccc1', None, 'Brc1ccccc1')
+    st.update(2, 7, 'CCOC(C)=O', 'Brc1ccccc1', 'CCOC(=O)Cc1ccccc1')
+    st.update(1, 9, 'CCOC(=O)Cc1ccccc1', None, 'O=C(O)Cc1ccccc1')
+    st.update(3, None, None, None, None)
+    yield st
+    st = SyntheticTree()
+    st.update(0, 3, 'CCO', None, 'CC=O')
+    st.update(0, 4, 'CCC', 'CCN', 'CCCNCC')
+    st.update(2, 5, 'CC=O', 'CCCNCC', 'CCCN(CC)C(C)O')
+    st.update(1, 6, 'CCCN(CC)C(C)O', 'CCCl', 'CCCN(CC)C(C)OCCC')
+    st.update(3, None, None, None, None)
+    yield st
+
+
+class TestSkeleton(unittest.TestCase):
+    """
+    Tests Skeleton.criteria and inds_to_masks against brute-force references on every mask of small trees.
+    """
+    def test_criteria(self):
+        """
+        Tests that criteria() over all masks matches the node-by-node setter, and the attributes the setter sets.
+        """
+        for st in example_trees():
+            sk = Skeleton(st, 0)
+            n = len(sk.tree)
+            masks = np.array([[(i >> j) & 1 for j in range(n)] for i in range(2**n)])
+            batch = sk.criteria(masks)
+            for i, mask in enumerate(masks):
+                sk.reset()
+                sk.mask = list(np.flatnonzero(mask))
+                ref = reference_criteria(sk)
+                for criterion, value in ref.items():
+                    self.assertEqual(bool(batch[criterion][i]), bool(value), (criterion, mask))
+                    self.assertEqual(getattr(sk, criterion), bool(value), (criterion, mask))
+
+    def test_inds_to_masks(self):
+        """
+        Tests inds_to_masks against filling the zero indices with get_bool_mask, and the round trip with inds_to_i.
+        """
+        for st in example_trees():
+            sk = Skeleton(st, 0)
+            n = len(sk.tree)
+            for min_r_set in [[sk.tree_root], [sk.tree_root, 0, 3]]:
+                m = n - len(min_r_set)
+                masks = inds_to_masks(range(2**m - 1), n, min_r_set)
+                for i in range(2**m - 1):
+                    sk.reset(min_r_set)
+                    zero_inds = np.where(sk.mask == 0)[0]
+                    bool_mask = get_bool_mask(i)
+                    sk.mask = zero_inds[-len(bool_mask):][bool_mask]
+                    np.testing.assert_array_equal(sk.mask, masks[i])
+                    if i:
+                        self.assertEqual(inds_to_i(np.flatnonzero(masks[i]), n, min_r_set), i)
+
+
+if __name__ == '__main__':
+    unittest.main()